@@ -28,6 +28,8 @@ from argparse import ArgumentParser
 
 import dsn_reduce_params as par
 import bandpass_threshold as bp_zap
+import fb_linefind
+from fb_utils import MappedFilterbank
 
 
 def get_inbase(infile):
@@ -95,7 +97,7 @@ def get_comma_strings(f0, nharm, width):
     for ii in range(N):
         f0_str += "%.3f," %(f0[ii])
         nh_str += "%d," %(nharm[ii])
-        ww_str += "%.1f," %(width[ii])
+        ww_str += "%.2f," %(width[ii])
 
     f0_str = f0_str[:-1]
     nh_str = nh_str[:-1]
@@ -104,6 +106,61 @@ def get_comma_strings(f0, nharm, width):
     return f0_str, nh_str, ww_str
 
 
+def io_opts():
+    """
+    Return the --memBudget, --prefetch, --scratchDirs, 
+    --compression, and --stagingBackend options for the filter
+    scripts (empty if not set in the param file)
+    """
+    opt_str = ""
+    if par.mem_budget is not None:
+        opt_str += "--memBudget %d " %(par.mem_budget)
+    if par.io_prefetch:
+        opt_str += "--prefetch %d " %(par.io_prefetch)
+    if len(par.scratch_dirs):
+        opt_str += "--scratchDirs %s " %(",".join(par.scratch_dirs))
+    if par.staging_compression is not None:
+        opt_str += "--compression %s " %(par.staging_compression)
+    if par.staging_backend != "hdf5":
+        opt_str += "--stagingBackend %s " %(par.staging_backend)
+    return opt_str
+
+
+def choose_filter_engine(infile, nharm):
+    """
+    Pick the notch engine for the frequency filter from 
+    par.filter_engine.  For "auto", use the FFT engine once the 
+    number of notches reaches par.filter_fft_min_notches, since 
+    its cost does not grow with the number of notches.  Sets with 
+    nharm = -1 are done by the comb filter and are not counted.  
+    With par.filter_line_snr set, "auto" stays with "sos", which 
+    only runs each notch on the channels it is found in, as it 
+    does with par.filter_stream (only "sos" streams).  "auto" 
+    also stays with "sos" if par.mem_budget cannot hold the FFT 
+    work buffers (about 24 bytes per sample) of filter_nproc 
+    channels of infile, since the FFT engine only runs as many 
+    channels in parallel as it holds.
+    """
+    if par.filter_engine != "auto":
+        return par.filter_engine
+
+    if par.filter_line_snr is not None or par.filter_stream:
+        return "sos"
+
+    nnotch = np.sum(nharm[nharm >= 0] + 1)
+    if nnotch < par.filter_fft_min_notches:
+        return "sos"
+
+    if par.mem_budget is not None:
+        mapFile = MappedFilterbank(infile)
+        nspec = mapFile.nspec
+        mapFile.close()
+        if par.mem_budget // (24.0 * nspec) < par.filter_nproc:
+            return "sos"
+
+    return "fft"
+
+
 def filter_freqs(infile, f0, nharm, width, outfile=None):
     """
     Filter out RFI signals and harmonics
@@ -128,6 +185,15 @@ def filter_freqs(infile, f0, nharm, width, outfile=None):
                  "--nharm %s " %nh_str +\
                  "--width %s " %ww_str +\
                  "--numProcessors %d " %nproc +\
+                 "--stagingDtype %s " %par.filter_staging_dtype +\
+                 "--engine %s " %choose_filter_engine(infile, nharm) +\
+                 "--backend %s " %par.filter_backend +\
+                 "--stream " * bool(par.filter_stream) +\
+                 "--precision %s " %par.filter_precision +\
+                 "--f32Tol %g " %par.filter_f32_tol +\
+                 ("--lineSnr %g " %par.filter_line_snr 
+                  if par.filter_line_snr is not None else "") +\
+                 io_opts() +\
                  "--clean"
     
     print(filter_cmd)
@@ -139,6 +205,38 @@ def filter_freqs(infile, f0, nharm, width, outfile=None):
     return outfile, tdur
 
 
+def find_zap(infile, zaplist=[]):
+    """
+    Search the zero-DM power spectrum of infile for periodic 
+    RFI lines and return them as -z style "f0,nh,width" strings 
+    (an empty list if none are found).  Lines whose f0 is within 
+    the width of an f0 already in zaplist (the -z sets) are 
+    dropped, so they are not notched twice.
+    """
+    tstart = time.time()
+    
+    families = fb_linefind.detect_lines(infile, nfft=par.autozap_nfft, 
+                                        chan_step=par.autozap_chan_step, 
+                                        snr=par.autozap_snr, 
+                                        fmin=par.autozap_fmin, 
+                                        mem_budget=par.mem_budget, 
+                                        max_spec=par.autozap_max_spec)
+    
+    known = [ [ float(xx) for xx in zz.split(',') ] for zz in zaplist ]
+    new_families = []
+    for f0, nh, ww in families:
+        if any([ abs(f0 - kf0) <= kww for kf0, knh, kww in known ]):
+            print("autozap: %.3f Hz is already zapped, skipping it" %(f0))
+        else:
+            new_families.append((f0, nh, ww))
+    autolist = fb_linefind.zap_strings(new_families)
+    
+    tstop = time.time()
+    dt = tstop - tstart
+    
+    return autolist, dt
+
+
 def bandpass(infile, outdir, outbase, ra_str, dec_str):
     """
     Bandpass correct data
@@ -228,6 +326,8 @@ def filter_avg(infile, tconst):
               "--outputFilename %s " %avg1_file +\
               "--timeConstLong %.2f " %avg_tconst +\
               "--numProcessors %d " %avg_nproc +\
+              "--stream " * bool(par.avg_filter_stream) +\
+              io_opts() +\
               "--clean "
     print(avg_cmd)
     call(avg_cmd, shell=True)
@@ -412,8 +512,15 @@ def parse_input():
                 'center frequency, the number of harmonics beyond ' +\
                 'fundamental, and width in Hz (e.g., \'60.0,5,1.0\' to '+\
                 '60Hz signal and 5 harmonics with width 1.0Hz.  To zap '+\
-                'multiple frequencies, repeat this argument',
+                'multiple frequencies, repeat this argument.  A '+\
+                'harmonic count of -1 removes all harmonics up to '+\
+                'Nyquist with one comb filter',
            action='append', required=False, default=[])
+    parser.add_argument('-a', '--autozap', 
+           help='Search the zero-DM power spectrum for periodic RFI '+\
+                'lines and add them to the -z list (also on if '+\
+                'autozap is set in the param file)', 
+           action='store_true', required=False, default=False)
 
     args = parser.parse_args()
 
@@ -424,9 +531,10 @@ def parse_input():
     src = args.src
     tconst = args.tconst
     zaplist = args.zap
+    autozap = args.autozap or par.autozap
 
     #return indir, outdir, infile, outbase, src
-    return outdir, infile, outbase, src, tconst, zaplist
+    return outdir, infile, outbase, src, tconst, zaplist, autozap
 
 
 
@@ -441,7 +549,7 @@ def main():
     tstart = time.time()
 
     # Parse input
-    outdir, infile, outbase, src, tconst, zaplist = parse_input()
+    outdir, infile, outbase, src, tconst, zaplist, autozap = parse_input()
 
     # Get source info from source_info.txt
     src_name, ra_str, dec_str, obs_type = get_info(src)
@@ -456,6 +564,7 @@ def main():
     print("dec: %s" %dec_str)
     print("tconst: %.2f" %tconst)
     print("zap: %s" %( "; ".join(zaplist)))
+    print("autozap: %s" %autozap)
     print("") 
     #print(zaplist)
 
@@ -468,6 +577,15 @@ def main():
     if par.copy_par:
         shutil.copy(par.par_file, outdir)
 
+    # Look for periodic RFI lines, so the filter only runs when 
+    # there is something to remove
+    if autozap:
+        autolist, search_time = find_zap(infile, zaplist)
+        print("autozap: %s" %( "; ".join(autolist)))
+        zaplist = zaplist + autolist
+    else:
+        search_time = 0.0
+
     # Filter out RFI frequencies if specified
     if len(zaplist):
         print(zaplist)
@@ -500,6 +618,7 @@ def main():
     print("##              TIME SUMMARY                    ##")
     print("##################################################")
     print("")    
+    print("Line search:        %.1f minutes" %(search_time/60.))
     print("Filter:             %.1f minutes" %(filter_time/60.))
     print("Bandpass:           %.1f minutes" %(bpass_time/60.))
     print("Baseline:           %.1f minutes" %(avg_time/60.))
@@ -37,16 +37,142 @@ rfi_clip2    = 0.0  # after avg filter
 rfi_freqsig  = 16.0 
 
 
+######################
+##  Memory and I/O  ##
+######################
+
+# Memory (bytes) each filter script may use.  It sizes the blocks 
+# read from / written to the filterbank files (the number of 
+# spectra per block is worked out from this and the file's nchans 
+# and nbits), and also caps the working sets of the filter and 
+# norm stages: the frequency filter's batches of channels (and 
+# "auto"'s choice of the FFT engine), its stream chunks, the norm 
+# stage's blocks of channels and stream blocks, and the autozap 
+# line search.  None (the default) uses the scripts' defaults 
+# (BLOCKSIZE spectra for the I/O blocks, BATCH_BYTES = 1 GiB for 
+# the working sets).  Set it, e.g. to 4.0e9, to cap them all.
+mem_budget = None
+
+# Number of blocks read ahead / written behind in a background 
+# thread so disk I/O overlaps the conversion, e.g. 2.  0 (the 
+# default) turns it off.
+io_prefetch = 0
+
+# Fast scratch directories to try (in order) for the .hdf5 copies 
+# made by the filter scripts, e.g. ["/dev/shm", "/tmp"] (note that 
+# /dev/shm is RAM).  The first with enough free space is used, 
+# else (and by default) the copy goes next to the input file.
+scratch_dirs = []
+
+# Compression for those .hdf5 copies: None, "lzf", or "gzip".
+# Saves scratch space / I/O at the cost of CPU; noisy float32 data 
+# compress much less than 8-bit data.  The .corr files themselves 
+# stay uncompressed since prepfil and rfifind read them.
+staging_compression = None
+
+# Staging store for the filter stages: "hdf5" (one .hdf5 file) or 
+# "sharded" (a directory of channel-group files that nproc 
+# processes fill in parallel, and that several processes can 
+# modify at once)
+staging_backend = "hdf5"
+
+######################
+##  Line Detection  ##
+######################
+
+# Search the zero-DM power spectrum for periodic RFI (mains, 
+# cryocooler) and add the lines found to the -z list, so the 
+# frequency filter only runs when there are lines to remove 
+# (see fb_linefind.py).  Also turned on by dsn_reduce.py -a.
+autozap = False
+
+# Welch segment length (samples), detection threshold, lowest 
+# frequency (Hz) searched, sum every autozap_chan_step-th channel, 
+# and only use the first autozap_max_spec spectra (None: all).  
+# The threshold is the Gaussian sigma of the false alarm chance 
+# for the whole spectrum; no lines are reported from fewer than 
+# 8 Welch segments (nspec < 4.5 autozap_nfft).
+autozap_nfft = 2**16
+autozap_snr = 8.0
+autozap_fmin = 1.0
+autozap_chan_step = 1
+autozap_max_spec = None
+
 #########################
 ##  Frequency  Filter  ##
 #########################
 
 filter_nproc     = 30
 
+# dtype of the .hdf5 copy the filter works on.  "float32", or 
+# "native" to keep the input's dtype (4x smaller for 8-bit data; 
+# each channel is converted to float only while being filtered).  
+# "native" falls back to "float32" when the filter makes more than 
+# one pass (per-harmonic passes, or comb sets plus other notches), 
+# so the data are only rounded once.
+filter_staging_dtype = "float32"
+
+# Notch engine: "sos" (cascaded Butterworth bandstops run with 
+# sosfiltfilt, cost grows with the number of notches), "fft" 
+# (one forward / inverse FFT per channel whatever the number of 
+# notches), or "auto" to use "fft" once there are at least 
+# filter_fft_min_notches notches.  Sets with nharm = -1 use a 
+# comb filter for all of the harmonics and are not counted.  The 
+# comb's only lag is fs / f0 samples, so it is used only when that 
+# is an integer: 60 Hz at 64 us sampling (260.4 samples) is not, 
+# and such a set is filtered by the FFT engine instead (or, with 
+# filter_stream, by separate notches up to Nyquist, which is slow).  
+# The FFT engine holds about 24 bytes per sample of each channel 
+# it transforms, so on long scans mem_budget may only hold a few 
+# channels (and threads) at a time; "auto" then stays with "sos".  
+# The threshold of 4 notches was measured on short in-memory 
+# channels, so "sos" stays the default until it is re-measured on 
+# full-length scans.  
+# "subtract" estimates the lines once from the band average and 
+# subtracts a fitted copy from each channel: much cheaper, but only 
+# for interference common to all channels (check the residual 
+# line power it reports in the filter log).
+filter_engine = "sos"
+filter_fft_min_notches = 4
+
+# How the filter spreads channels over filter_nproc: "batch" 
+# (2D slabs of channels sized from mem_budget, filtered along 
+# time by filter_nproc threads), "thread" (one thread per 
+# channel), or "process" for a process pool sharing batches of 
+# channels through shared memory (not serialised by the GIL / 
+# h5py; see 'fb_bench.py scaling')
+filter_backend = "batch"
+
+# Stream the filter straight from the input file to the output a 
+# chunk of time at a time (no staging copy; memory fixed by 
+# mem_budget whatever the scan length), using the SOS cascade
+filter_stream = False
+
+# Run the SOS notches in "float32" (float32 data, float64 states; 
+# half the memory traffic of "float64") if a sample of channels 
+# agrees with float64 to within filter_f32_tol of the rms
+filter_precision = "float64"
+filter_f32_tol = 1e-3
+
+# Only run each notch on the channels where its line is detected 
+# at more than filter_line_snr sigma (measured on a few stretches 
+# of each channel), e.g. 5.0 when the pickup is confined to part 
+# of the band.  It is the chi-squared test of autozap_snr, applied 
+# to each channel and notch rather than to the whole spectrum.  
+# None filters every channel.  Used by the "sos" engine; "auto" 
+# then stays with "sos".
+filter_line_snr = None
+
 #############################
 ##  Moving Average Filter  ##
 #############################
 
 avg_filter_nproc     = 30
 
+# Detrend + normalise straight from the input file to the output, a 
+# block of spectra at a time (no staging copy; memory of about 
+# nchans x (window + block), set by mem_budget), reading the input 
+# twice
+avg_filter_stream = False
+
 
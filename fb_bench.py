@@ -0,0 +1,819 @@
+"""
+fb_bench.py
+
+Benchmarks for the filterbank staging and processing helpers.
+Everything runs on synthetic data written to a scratch directory,
+so no observation files are needed.  Since the page cache is not
+dropped between passes, use an nspec large enough that the staging
+file does not fit in memory if you want disk rather than cache rates.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+from argparse import ArgumentParser
+from numba import set_num_threads
+from numba.core.runtime import rtsys, _nrt_python
+
+import fb_utils
+import fb_linefind
+import m_fb_freq_filter_parallel_new as freq_filter
+import m_fb_filter_norm_jit as norm_filter
+from scipy import signal, stats
+
+
+def parse_int_list(opt_str):
+    """
+    Parse comma separated string into list of ints
+    """
+    return [ int(float(xx)) for xx in opt_str.split(',') ]
+
+
+def chunk_geometries(nchans, nspec, blocksize):
+    """
+    Chunk shapes to compare.  None is the old contiguous layout.
+    """
+    geoms = [ ("contiguous", None),
+              ("default", fb_utils.stagingChunks(nchans, nspec, blocksize)),
+              ("1 x B/16", (1, max(blocksize // 16, 1))),
+              ("16 x B/64", (16, max(blocksize // 64, 1))),
+              ("h5py auto", True) ]
+    return geoms
+
+
+def bench_chunks(args):
+    """
+    Time block writes (all channels x blocksize spectra, as in
+    readFilterbank) and per-channel row reads / writes (as in the
+    per-channel workers) for several chunk geometries.
+    """
+    nspec = args.nspec
+    blocksize = min(args.blocksize, nspec)
+    rdcc = args.rdcc
+    h5_path = "%s/fb_bench_chunks.hdf5" %(args.scratch)
+
+    print("nspec = %d,  blocksize = %d,  rdcc = %.1f MB" %(\
+          nspec, blocksize, rdcc / 2.0**20))
+    print("")
+    print("%8s  %-12s  %16s  %12s  %12s  %12s" %(\
+          "nchans", "layout", "chunk", "write MB/s",
+          "row rd MB/s", "row wr MB/s"))
+
+    for nchans in parse_int_list(args.nchans):
+        block = np.random.standard_normal(
+                    (nchans, blocksize)).astype(np.float32)
+        nbytes = 4.0 * nchans * nspec
+
+        for name, chunks in chunk_geometries(nchans, nspec, blocksize):
+            h5pyFile = fb_utils.h5py.File(h5_path, "w", rdcc_nbytes=rdcc,
+                                          rdcc_w0=1.0)
+            dset = h5pyFile.create_dataset("data", (nchans, nspec),
+                                           dtype="float32", chunks=chunks)
+
+            # Block writes
+            tstart = time.time()
+            for lobin in range(0, nspec, blocksize):
+                hibin = min(lobin + blocksize, nspec)
+                dset[:, lobin:hibin] = block[:, :hibin-lobin]
+            h5pyFile.flush()
+            t_write = time.time() - tstart
+
+            # Per channel reads + writes
+            nrows = min(args.nrows, nchans)
+            rows = np.linspace(0, nchans-1, nrows).astype(int)
+            t_read = 0.0
+            t_rwrite = 0.0
+            for ichan in rows:
+                tstart = time.time()
+                row = dset[ichan]
+                t_read += time.time() - tstart
+
+                tstart = time.time()
+                dset[ichan] = row
+                t_rwrite += time.time() - tstart
+            h5pyFile.flush()
+
+            chunk_str = "%s" %(str(dset.chunks))
+            h5pyFile.close()
+            os.remove(h5_path)
+
+            row_bytes = 4.0 * nspec * nrows
+            print("%8d  %-12s  %16s  %12.1f  %12.1f  %12.1f" %(\
+                  nchans, name, chunk_str,
+                  nbytes / t_write / 2.0**20,
+                  row_bytes / t_read / 2.0**20,
+                  row_bytes / t_rwrite / 2.0**20))
+        print("")
+
+    return
+
+
+def bench_transpose(args):
+    """
+    Compare the old transposed-view copy (the C-order copy that
+    h5py / append_spectra make of a .T view) with the tiled
+    fb_utils.transposeBlock into a preallocated buffer, for the
+    read (time-major native -> channel-major float32) and write
+    (channel-major float32 -> time-major float32) directions.
+    """
+    nspec = args.nspec
+    ntrial = args.ntrial
+
+    print("nspec = %d,  tile = %d" %(nspec, args.tile))
+    print("")
+    print("%8s  %-6s  %-6s  %12s  %12s  %8s" %(\
+          "nchans", "dir", "dtype", ".T (MB/s)", "tiled (MB/s)", "speedup"))
+
+    for nchans in parse_int_list(args.nchans):
+        for nbits in parse_int_list(args.nbits):
+            dtype = { 8 : np.uint8, 16 : np.uint16, 32 : np.float32 }[nbits]
+            raw = (np.random.random_sample((nspec, nchans)) * 100).astype(dtype)
+            chan = np.empty((nchans, nspec), dtype=np.float32)
+            tmaj = np.empty((nspec, nchans), dtype=np.float32)
+
+            # Read direction
+            tstart = time.time()
+            for ii in range(ntrial):
+                old = np.ascontiguousarray(raw.T, dtype=np.float32)
+            t_old = (time.time() - tstart) / ntrial
+
+            tstart = time.time()
+            for ii in range(ntrial):
+                fb_utils.transposeBlock(raw, chan, tile=args.tile)
+            t_new = (time.time() - tstart) / ntrial
+
+            if not np.array_equal(old, chan):
+                print("Tiled transpose does not match!")
+
+            mbytes = raw.nbytes / 2.0**20
+            print("%8d  %-6s  %-6s  %12.1f  %12.1f  %8.2f" %(\
+                  nchans, "read", np.dtype(dtype).name,
+                  mbytes / t_old, mbytes / t_new, t_old / t_new))
+
+            # Write direction (staging data are always float32)
+            if nbits != 32:
+                continue
+            tstart = time.time()
+            for ii in range(ntrial):
+                old = np.ascontiguousarray(chan.T)
+            t_old = (time.time() - tstart) / ntrial
+
+            tstart = time.time()
+            for ii in range(ntrial):
+                fb_utils.transposeBlock(chan, tmaj, tile=args.tile)
+            t_new = (time.time() - tstart) / ntrial
+
+            mbytes = chan.nbytes / 2.0**20
+            print("%8d  %-6s  %-6s  %12.1f  %12.1f  %8.2f" %(\
+                  nchans, "write", "float32",
+                  mbytes / t_old, mbytes / t_new, t_old / t_new))
+        print("")
+
+    return
+
+
+def parse_float_list(opt_str):
+    """
+    Parse comma separated string into array of floats
+    """
+    return np.array([ float(xx) for xx in opt_str.split(',') ])
+
+
+def bench_notch(args):
+    """
+    Time the per-harmonic notch filtering (one sosfiltfilt per
+    harmonic, rounding to float32 in between, as fb_filter_harms
+    does) against the fused cascade of fb_filter_fused (in float64
+    and float32), the FFT engine of fb_filter_fft and the common-mode
+    subtraction of fb_filter_common on synthetic channels with mains
+    lines, and report how much the outputs differ away from the
+    ends of the series.  The lines are the same in every channel, so
+    this is the best case for the subtraction.
+    """
+    tsamp = args.tsamp
+    fs = 1.0 / tsamp
+    nyq = 0.5 * fs
+    f0 = parse_float_list(args.f0)
+    nharm = parse_int_list(args.nharm)
+    width = parse_float_list(args.width)
+
+    starts, stops = freq_filter.notch_bands(f0, nharm, width, nyq)
+    sos_list = [ freq_filter.butter_bandstop(nyq, f_start, f_stop)
+                 for f_start, f_stop in zip(starts, stops) ]
+    sos = freq_filter.fused_sos(nyq, starts, stops)
+    freq_filter.notch_attenuation(sos, fs, starts, stops)
+
+    tt = np.arange(args.nspec) * tsamp
+    lines = np.zeros(args.nspec)
+    for fc in 0.5 * (starts + stops):
+        lines += np.sin(2 * np.pi * fc * tt)
+    data = (np.random.standard_normal((args.nchans, args.nspec)) +
+            lines).astype(np.float32)
+
+    tstart = time.time()
+    old = np.empty_like(data)
+    for ichan in range(args.nchans):
+        chan = data[ichan]
+        for sos_ii in sos_list:
+            chan = signal.sosfiltfilt(sos_ii, chan).astype(np.float32)
+        old[ichan] = chan
+    t_old = time.time() - tstart
+
+    tstart = time.time()
+    new = np.empty_like(data)
+    for ichan in range(args.nchans):
+        new[ichan] = signal.sosfiltfilt(sos, data[ichan])
+    t_new = time.time() - tstart
+
+    args32 = freq_filter.float32_sos_args(sos)
+    freq_filter.sos_filtfilt_f32(data[:1, :1000], *args32)
+    tstart = time.time()
+    f32_out = np.empty_like(data)
+    for ichan in range(args.nchans):
+        f32_out[ichan] = freq_filter.sos_filtfilt_f32(data[ichan], *args32)
+    t_f32 = time.time() - tstart
+
+    tstart = time.time()
+    fft_out = np.empty_like(data)
+    notcher = freq_filter.FFTNotch(args.nspec, fs, starts, stops,
+                                   nbatch=args.nchans, workers=args.workers)
+    for ichan in range(args.nchans):
+        notcher.load(ichan, data[ichan])
+    fft_out[:] = notcher.filter(args.nchans)
+    t_fft = time.time() - tstart
+
+    tstart = time.time()
+    zeroDM = np.mean(data, axis=0, dtype=np.float64)
+    templates, c_starts, c_stops = freq_filter.common_mode_templates(
+        zeroDM, fs, f0, nharm, width)
+    gramInv = np.linalg.pinv(np.dot(templates, templates.T))
+    sub_out = freq_filter.common_mode_rows(data, templates,
+                                           gramInv).astype(np.float32)
+    t_sub = time.time() - tstart
+
+    # Edge transients differ, so compare the middle of the series
+    edge = min(args.edge, args.nspec // 4)
+    diff = np.abs(old[:, edge:-edge] - new[:, edge:-edge]).max()
+    diff_fft = np.abs(new[:, edge:-edge] - fft_out[:, edge:-edge]).max()
+    diff_sub = np.abs(new[:, edge:-edge] - sub_out[:, edge:-edge]).max()
+
+    print("%d notches, %d chans x %d spectra" %(\
+          len(starts), args.nchans, args.nspec))
+    print("  per-harmonic : %8.2f s" %(t_old))
+    print("  fused        : %8.2f s  (%.2fx)" %(t_new, t_old / t_new))
+    print("  fused f32    : %8.2f s  (%.2fx)" %(t_f32, t_old / t_f32))
+    print("  fft          : %8.2f s  (%.2fx)" %(t_fft, t_old / t_fft))
+    print("  subtract     : %8.2f s  (%.2fx)" %(t_sub, t_old / t_sub))
+    print("  max |diff| beyond %d samples of the ends (data rms %.3g):" %(\
+          edge, np.std(data)))
+    print("    fused vs per-harmonic : %.3g" %(diff))
+    print("    fused f32 vs fused    : %.3g" %(\
+          np.abs(new - f32_out).max()))
+    print("    fft vs fused          : %.3g" %(diff_fft))
+    print("    subtract vs fused     : %.3g  (the notches also take out" %(\
+          diff_sub))
+    print("                                    the noise in their bands)")
+
+    return
+
+
+def bench_scaling(args):
+    """
+    Scaling of the channel filtering with the number of workers
+    for the thread, batch (2D slabs) and process (shared memory)
+    backends of apply_channels, on synthetic in-memory channels
+    with the fused notch cascade.  Speedups (and the process backend's
+    parallel efficiency) are against the thread backend at the
+    first worker count, so start the list at 1.
+    """
+    tsamp = args.tsamp
+    fs = 1.0 / tsamp
+    nyq = 0.5 * fs
+    starts, stops = freq_filter.notch_bands(parse_float_list(args.f0),
+                                            parse_int_list(args.nharm),
+                                            parse_float_list(args.width),
+                                            nyq)
+    sos = freq_filter.fused_sos(nyq, starts, stops)
+    data = np.random.standard_normal(
+               (args.nchans, args.nspec)).astype(np.float32)
+    devnull = open(os.devnull, "w")
+
+    print("%d notches, %d chans x %d spectra, %d cpus" %(\
+          len(starts), args.nchans, args.nspec, os.cpu_count()))
+    print("")
+    print("%6s  %10s  %8s  %10s  %8s  %11s  %8s  %10s" %(\
+          "nproc", "thread (s)", "speedup", "batch (s)", "speedup",
+          "process (s)", "speedup", "efficiency"))
+
+    t_one = None
+    for nproc in parse_int_list(args.nproc):
+        times = []
+        for backend in ["thread", "batch", "process"]:
+            fb_data = data.copy()
+            tstart = time.time()
+            freq_filter.apply_channels(freq_filter.sos_filtfilt_row, (sos,),
+                                       fb_data, nproc, "bench",
+                                       backend=backend, logFile=devnull)
+            times.append(time.time() - tstart)
+        if t_one is None:
+            t_one = times[0]
+        print("%6d  %10.2f  %8.2f  %10.2f  %8.2f  %11.2f  %8.2f  %10.2f" %(\
+              nproc, times[0], t_one / times[0], times[1],
+              t_one / times[1], times[2], t_one / times[2],
+              t_one / times[2] / nproc))
+
+    devnull.close()
+
+    return
+
+
+def bench_stream(args):
+    """
+    Check the chunked zero-phase filter (StreamingFiltFilt) against
+    a full-length sosfiltfilt of the same synthetic channels, for
+    several chunk lengths, and time both.
+    """
+    tsamp = args.tsamp
+    fs = 1.0 / tsamp
+    nyq = 0.5 * fs
+    starts, stops = freq_filter.notch_bands(parse_float_list(args.f0),
+                                            parse_int_list(args.nharm),
+                                            parse_float_list(args.width),
+                                            nyq)
+    sos = freq_filter.fused_sos(nyq, starts, stops)
+
+    tt = np.arange(args.nspec) * tsamp
+    lines = np.zeros(args.nspec)
+    for fc in 0.5 * (starts + stops):
+        lines += np.sin(2 * np.pi * fc * tt)
+    data = np.random.standard_normal((args.nchans, args.nspec)) + lines
+
+    tstart = time.time()
+    full = signal.sosfiltfilt(sos, data, axis=1)
+    t_full = time.time() - tstart
+
+    overlap = freq_filter.settle_length(sos, tol=args.tol)
+    rms = np.std(full)
+    print("%d notches, %d chans x %d spectra, overlap %d spectra (tol %.0e)" %(\
+          len(starts), args.nchans, args.nspec, overlap, args.tol))
+    print("full sosfiltfilt: %.2f s" %(t_full))
+    print("")
+    print("%10s  %10s  %12s  %12s" %(\
+          "chunk", "time (s)", "max |diff|", "diff / rms"))
+
+    def read(lobin, hibin):
+        return data[:, lobin:hibin].copy()
+
+    for chunk in parse_int_list(args.chunks):
+        stream = freq_filter.StreamingFiltFilt(sos, read, args.nspec,
+                                               args.nchans, chunk,
+                                               overlap=overlap)
+        out = np.empty_like(data)
+        tstart = time.time()
+        for lobin, hibin, filtered in stream.chunks():
+            out[:, lobin:hibin] = filtered
+        t_stream = time.time() - tstart
+
+        diff = np.abs(out - full).max()
+        print("%10d  %10.2f  %12.3g  %12.3g" %(\
+              chunk, t_stream, diff, diff / rms))
+
+    return
+
+
+def synthetic_lines(nspec, tsamp, lines, amp, nfft, rng):
+    """
+    Welch spectrum (fb_linefind.WelchAccumulator) of unit white 
+    noise plus sinusoids of amplitude amp at the frequencies in lines
+
+    Returns freqs, psd, nseg, dof
+    """
+    welch = fb_linefind.WelchAccumulator(nfft)
+    blocksize = 1000000
+    for lobin in range(0, nspec, blocksize):
+        tt = np.arange(lobin, min(lobin + blocksize, nspec)) * tsamp
+        data = rng.standard_normal(len(tt))
+        for fc in lines:
+            data += amp * np.sin(2 * np.pi * fc * tt)
+        welch.add(data)
+    freqs = np.fft.rfftfreq(nfft, d=tsamp)
+    return freqs, welch.spectrum(), welch.nseg, welch.dof()
+
+
+def bench_lines(args):
+    """
+    Check the line search of fb_linefind on synthetic zero-DM time 
+    series: a ~1 Hz line must not swallow a mains family as high 
+    harmonics, and pure noise must give no lines, including with 
+    only a few Welch segments.  The frequency filter's per-channel 
+    test (chan_line_power, --lineSnr) must find a line in exactly 
+    the channels that have it and give noise false alarms at the 
+    rate the threshold claims.  Exits with status 1 if any check 
+    fails.
+    """
+    rng = np.random.default_rng(args.seed)
+    tsamp = args.tsamp
+    nfft = args.nfft
+    df = 1.0 / (nfft * tsamp)
+    failed = []
+
+    def check(ok, msg):
+        print("%-64s %s" %(msg, "ok" if ok else "FAILED"))
+        if not ok:
+            failed.append(msg)
+
+    # Grouping alone
+    fams = fb_linefind.harmonic_families([1.2, 60.0, 120.0], [0.12] * 3, df)
+    check(sorted([ nh for f0, nh, ww in fams ]) == [0, 1],
+          "1.2, 60, 120 Hz -> 1.2 Hz alone, 60 Hz nharm 1: %s" %(\
+          ", ".join([ "%.1f/%d" %(f0, nh) for f0, nh, ww in fams ])))
+
+    # ~1 Hz line plus a mains family with only odd harmonics
+    lines = [1.4, 60.0, 180.0, 300.0]
+    freqs, psd, nseg, dof = synthetic_lines(args.nspec, tsamp, lines,
+                                            args.amp, nfft, rng)
+    centers, widths, peaks = fb_linefind.find_lines(freqs, psd, dof,
+                                                    snr=args.snr)
+    fams = fb_linefind.harmonic_families(centers, widths, df)
+    found = ", ".join([ "%.2f/%d" %(f0, nh) for f0, nh, ww in fams ])
+    check(len(centers) == len(lines),
+          "%d of %d lines found (%d segments)" %(len(centers), len(lines), nseg))
+    mains = [ nh for f0, nh, ww in fams if abs(f0 - 60.0) < df ]
+    check((len(fams) == 2) and (mains == [4]),
+          "1.4 Hz + 60, 180, 300 Hz -> 1.4 Hz alone, 60 Hz nharm 4: %s" %(\
+          found))
+
+    # Pure noise, with down to MIN_NSEG segments
+    for nseg_want in [fb_linefind.MIN_NSEG, 11, 30]:
+        nspec = (nseg_want + 1) * nfft // 2
+        nfalse = 0
+        for itrial in range(args.ntrial):
+            freqs, psd, nseg, dof = synthetic_lines(nspec, tsamp, [], 0.0,
+                                                    nfft, rng)
+            centers, widths, peaks = fb_linefind.find_lines(freqs, psd, dof,
+                                                            snr=args.snr)
+            nfalse += len(centers)
+        check(nfalse == 0,
+              "noise, %d segments (%.1f dof): %d false lines in %d trials" %(\
+              nseg, dof, nfalse, args.ntrial))
+
+    # The filter's per-channel test (--lineSnr) on the same statistic:
+    # a 60 Hz line in half of the channels, noise in the other bands
+    nchans = 256
+    chans = rng.standard_normal((nchans, 140000)).astype(np.float32)
+    tt = np.arange(chans.shape[1]) * tsamp
+    chans[:nchans // 2] += args.amp * np.sin(2 * np.pi * 60.0 * tt)
+    starts = np.array([59.5, 119.5, 333.0, 1000.0, 1500.0, 2000.0, 2500.0])
+    ratio, dof, baseDof = freq_filter.chan_line_power(chans, 1.0 / tsamp,
+                                                      starts, starts + 1.0)
+    thresh = fb_linefind.line_threshold(args.snr, dof, base_dof=baseDof)
+    hits = (ratio[:, 0] > thresh[0])
+    check(np.all(hits[:nchans // 2]) and not np.any(hits[nchans // 2:]),
+          "per channel, 60 Hz at %.1f sigma: %d of %d line channels, %d others" %(\
+          args.snr, np.sum(hits[:nchans // 2]), nchans // 2,
+          np.sum(hits[nchans // 2:])))
+    rate = np.mean(ratio[:, 1:] > fb_linefind.line_threshold(2.0, dof[1:],
+                                                            base_dof=baseDof[1:]))
+    nominal = stats.norm.sf(2.0)
+    check(abs(rate - nominal) < 0.5 * nominal,
+          "per channel, noise over 2 sigma: %.2f%% (expect %.2f%%)" %(\
+          100.0 * rate, 100.0 * nominal))
+
+    if failed:
+        print("")
+        print("%d check(s) failed" %(len(failed)))
+        sys.exit(1)
+
+    return
+
+
+def nrt_allocations():
+    """
+    Number of allocations made so far by numba compiled code
+    """
+    return rtsys.get_allocation_stats().alloc
+
+
+def bench_alloc(args):
+    """
+    Check that the norm stage's block kernels allocate nothing per
+    channel once compiled.  numba's allocation counter is read around
+    kernel calls on blocks of 1 and nchans channels: the difference
+    is the per-channel allocation, and what is left is the fixed
+    cost of starting the parallel loop.  movingAverage, which returns
+    a new array, is counted too to show the counter works.  Then
+    tracemalloc follows a whole detrendNormalize_Parallel pass over
+    several blocks, whose peak should only be the block buffer and
+    scratch that runBlocks / workScratch make up front (plus
+    args.slack kB).  Exits with status 1 if a block kernel allocates
+    per channel, movingAverage does not (the counter is not working),
+    or the peak is over.
+    """
+    # numba only counts if NUMBA_NRT_STATS is set, or when asked
+    _nrt_python.memsys_enable_stats()
+
+    nchans = args.nchans
+    nspec = args.nspec
+    tconsts = parse_float_list(args.tconst)
+    windows = np.array([ norm_filter.windowSize(tc, args.tsamp)
+                         for tc in tconsts ])
+    nthreads = norm_filter.blockThreads(args.nproc)
+    set_num_threads(nthreads)
+
+    data = np.random.standard_normal((nchans, nspec)).astype(np.float32)
+    scratch1 = norm_filter.workScratch(args.nproc, 1, nspec)
+    scratch2 = norm_filter.workScratch(args.nproc, 2, nspec)
+    means = np.zeros(nchans)
+    m2s = np.zeros(nchans)
+
+    def run_detrend(block):
+        norm_filter.detrendBlock(block, windows[0], scratch1,
+                                 means[:len(block)], m2s[:len(block)])
+
+    def run_normalize(block):
+        norm_filter.detrendNormalizeBlock(block, windows, scratch2)
+
+    def run_average(block):
+        for row in block:
+            norm_filter.movingAverage(row, windows[0])
+
+    print("%d chans x %d spectra, windows of %s spectra, %d threads" %(\
+          nchans, nspec, ", ".join([ "%d" % ww for ww in windows ]),
+          nthreads))
+    print("")
+    print("%-22s  %14s  %14s  %12s" %(\
+          "numba allocations", "1 chan / call", "%d / call" % nchans,
+          "per chan"))
+
+    perChan = {}
+    for name, run in [ ("detrendBlock", run_detrend),
+                       ("detrendNormalizeBlock", run_normalize),
+                       ("movingAverage", run_average) ]:
+        run(data[:1].copy())
+        counts = []
+        for nrows in [1, nchans]:
+            block = data[:nrows].copy()
+            before = nrt_allocations()
+            for ii in range(args.repeat):
+                run(block)
+            counts.append((nrt_allocations() - before) / float(args.repeat))
+        perChan[name] = (counts[1] - counts[0]) / max(nchans - 1, 1)
+        print("%-22s  %14.1f  %14.1f  %12.3g" %(\
+              name, counts[0], counts[1], perChan[name]))
+
+    # A budget for about args.nblocks blocks of channels
+    nbatch = -(-nchans // args.nblocks)
+    memBudget = nthreads * 2 * 8.0 * nspec + nbatch * 4.0 * nspec
+    nbatch = norm_filter.blockChannels(nchans, nspec, args.nproc,
+                                       memBudget=memBudget)
+    header = {"tsamp": args.tsamp, "nsamples": nspec}
+    devnull = open(os.devnull, "w")
+
+    spectra = data.copy()
+    tracemalloc.start()
+    norm_filter.detrendNormalize_Parallel(spectra, header, tconsts,
+                                          args.nproc, memBudget=memBudget,
+                                          logFile=devnull)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    devnull.close()
+
+    fixed = nbatch * nspec * 4.0 + scratch2.nbytes
+    print("")
+    print("detrendNormalize_Parallel, %d blocks of %d chans:" %(\
+          -(-nchans // nbatch), nbatch))
+    print("    tracemalloc peak        : %8.2f MB" %(peak / 1e6))
+    print("    block buffer + scratch  : %8.2f MB" %(fixed / 1e6))
+    print("    rest                    : %8.2f kB" %((peak - fixed) / 1e3))
+
+    failed = []
+    def check(ok, msg):
+        print("%-64s %s" %(msg, "ok" if ok else "FAILED"))
+        if not ok:
+            failed.append(msg)
+
+    print("")
+    for name in ["detrendBlock", "detrendNormalizeBlock"]:
+        check(perChan[name] <= 0,
+              "%s: %.3g allocations per channel" %(name, perChan[name]))
+    check(perChan["movingAverage"] > 0,
+          "movingAverage allocations counted: %.3g per channel" %(\
+          perChan["movingAverage"]))
+    check(peak - fixed <= args.slack * 1e3,
+          "tracemalloc peak within %g kB of buffer + scratch" %(\
+          args.slack))
+
+    if failed:
+        print("")
+        print("%d check(s) failed" %(len(failed)))
+        sys.exit(1)
+
+    return
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Benchmarks for filterbank staging / processing"
+    parser = ArgumentParser(description=prog_desc)
+    subparsers = parser.add_subparsers(dest='bench')
+
+    # Staging chunk geometry
+    p_chunk = subparsers.add_parser('chunks',
+                  help='hdf5 staging chunk geometry read/write rates')
+    p_chunk.add_argument('-c', '--nchans',
+                         help='Comma separated channel counts (def: 2048,4096,8192)',
+                         required=False, default='2048,4096,8192')
+    p_chunk.add_argument('-n', '--nspec',
+                         help='Number of spectra (def: 250000)',
+                         required=False, type=int, default=250000)
+    p_chunk.add_argument('-b', '--blocksize',
+                         help='Spectra per block write (def: 125000)',
+                         required=False, type=int, default=125000)
+    p_chunk.add_argument('-r', '--nrows',
+                         help='Channels to time row access on (def: 64)',
+                         required=False, type=int, default=64)
+    p_chunk.add_argument('--rdcc',
+                         help='Chunk cache size in bytes (def: fb_utils.RDCC_BYTES)',
+                         required=False, type=int,
+                         default=fb_utils.RDCC_BYTES)
+    p_chunk.add_argument('-s', '--scratch',
+                         help='Scratch directory (def: .)',
+                         required=False, default='.')
+    p_chunk.set_defaults(func=bench_chunks)
+
+    # Transpose kernel
+    p_trans = subparsers.add_parser('transpose',
+                  help='tiled transpose vs transposed view copy')
+    p_trans.add_argument('-c', '--nchans',
+                         help='Comma separated channel counts (def: 2048,4096,8192)',
+                         required=False, default='2048,4096,8192')
+    p_trans.add_argument('-b', '--nbits',
+                         help='Comma separated input bit depths (def: 8,32)',
+                         required=False, default='8,32')
+    p_trans.add_argument('-n', '--nspec',
+                         help='Spectra per block (def: 50000)',
+                         required=False, type=int, default=50000)
+    p_trans.add_argument('-t', '--tile',
+                         help='Tile edge (def: fb_utils.TRANSPOSE_TILE)',
+                         required=False, type=int,
+                         default=fb_utils.TRANSPOSE_TILE)
+    p_trans.add_argument('--ntrial',
+                         help='Repeats per timing (def: 3)',
+                         required=False, type=int, default=3)
+    p_trans.set_defaults(func=bench_transpose)
+
+    # Fused notch cascade
+    p_notch = subparsers.add_parser('notch',
+                  help='per-harmonic vs fused notch filtering')
+    p_notch.add_argument('--f0',
+                         help='Comma separated fundamentals in Hz (def: 60,50)',
+                         required=False, default='60,50')
+    p_notch.add_argument('--nharm',
+                         help='Comma separated harmonic counts (def: 5,3)',
+                         required=False, default='5,3')
+    p_notch.add_argument('--width',
+                         help='Comma separated notch widths in Hz (def: 1,2)',
+                         required=False, default='1,2')
+    p_notch.add_argument('-c', '--nchans',
+                         help='Number of channels (def: 8)',
+                         required=False, type=int, default=8)
+    p_notch.add_argument('-n', '--nspec',
+                         help='Spectra per channel (def: 1000000)',
+                         required=False, type=int, default=1000000)
+    p_notch.add_argument('-t', '--tsamp',
+                         help='Sample time in s (def: 6.4e-5)',
+                         required=False, type=float, default=6.4e-5)
+    p_notch.add_argument('--edge',
+                         help='Samples at each end left out of the comparison (def: 100000)',
+                         required=False, type=int, default=100000)
+    p_notch.add_argument('-w', '--workers',
+                         help='scipy.fft threads for the fft engine (def: 1)',
+                         required=False, type=int, default=1)
+    p_notch.set_defaults(func=bench_notch)
+
+    # Thread vs process backend scaling
+    p_scale = subparsers.add_parser('scaling',
+                  help='thread / batch / process backend scaling with nproc')
+    p_scale.add_argument('-p', '--nproc',
+                         help='Comma separated worker counts (def: 1,2,4,8,16,32)',
+                         required=False, default='1,2,4,8,16,32')
+    p_scale.add_argument('--f0',
+                         help='Comma separated fundamentals in Hz (def: 60,50)',
+                         required=False, default='60,50')
+    p_scale.add_argument('--nharm',
+                         help='Comma separated harmonic counts (def: 2,1)',
+                         required=False, default='2,1')
+    p_scale.add_argument('--width',
+                         help='Comma separated notch widths in Hz (def: 1,2)',
+                         required=False, default='1,2')
+    p_scale.add_argument('-c', '--nchans',
+                         help='Number of channels (def: 64)',
+                         required=False, type=int, default=64)
+    p_scale.add_argument('-n', '--nspec',
+                         help='Spectra per channel (def: 1000000)',
+                         required=False, type=int, default=1000000)
+    p_scale.add_argument('-t', '--tsamp',
+                         help='Sample time in s (def: 6.4e-5)',
+                         required=False, type=float, default=6.4e-5)
+    p_scale.set_defaults(func=bench_scaling)
+
+    # Chunked zero-phase filter check
+    p_stream = subparsers.add_parser('stream',
+                  help='chunked vs full-length zero-phase filtering')
+    p_stream.add_argument('--chunks',
+                          help='Comma separated chunk lengths (def: 50000,200000,1000000)',
+                          required=False, default='50000,200000,1000000')
+    p_stream.add_argument('--f0',
+                          help='Comma separated fundamentals in Hz (def: 60,50)',
+                          required=False, default='60,50')
+    p_stream.add_argument('--nharm',
+                          help='Comma separated harmonic counts (def: 2,1)',
+                          required=False, default='2,1')
+    p_stream.add_argument('--width',
+                          help='Comma separated notch widths in Hz (def: 1,2)',
+                          required=False, default='1,2')
+    p_stream.add_argument('-c', '--nchans',
+                          help='Number of channels (def: 8)',
+                          required=False, type=int, default=8)
+    p_stream.add_argument('-n', '--nspec',
+                          help='Spectra per channel (def: 2000000)',
+                          required=False, type=int, default=2000000)
+    p_stream.add_argument('-t', '--tsamp',
+                          help='Sample time in s (def: 6.4e-5)',
+                          required=False, type=float, default=6.4e-5)
+    p_stream.add_argument('--tol',
+                          help='Settling tolerance for the overlap (def: 1e-10)',
+                          required=False, type=float, default=1e-10)
+    p_stream.set_defaults(func=bench_stream)
+
+    # Line search checks
+    p_lines = subparsers.add_parser('lines',
+                  help='check the fb_linefind line search on synthetic data')
+    p_lines.add_argument('-n', '--nspec',
+                         help='Spectra in the series with lines (def: 2000000)',
+                         required=False, type=int, default=2000000)
+    p_lines.add_argument('--nfft',
+                         help='Welch segment length (def: 65536)',
+                         required=False, type=int, default=2**16)
+    p_lines.add_argument('-t', '--tsamp',
+                         help='Sample time in s (def: 6.4e-5)',
+                         required=False, type=float, default=6.4e-5)
+    p_lines.add_argument('-a', '--amp',
+                         help='Line amplitude / noise rms (def: 0.1)',
+                         required=False, type=float, default=0.1)
+    p_lines.add_argument('-s', '--snr',
+                         help='Detection threshold (def: 8.0)',
+                         required=False, type=float, default=8.0)
+    p_lines.add_argument('--ntrial',
+                         help='Pure noise spectra per segment count (def: 10)',
+                         required=False, type=int, default=10)
+    p_lines.add_argument('--seed',
+                         help='Random seed (def: 1)',
+                         required=False, type=int, default=1)
+    p_lines.set_defaults(func=bench_lines)
+
+    # Norm stage kernel allocations
+    p_alloc = subparsers.add_parser('alloc',
+                  help='allocations made by the norm stage block kernels')
+    p_alloc.add_argument('--tconst',
+                         help='Comma separated time constants in s (def: 1.0,0.2)',
+                         required=False, default='1.0,0.2')
+    p_alloc.add_argument('-c', '--nchans',
+                         help='Number of channels (def: 64)',
+                         required=False, type=int, default=64)
+    p_alloc.add_argument('-n', '--nspec',
+                         help='Spectra per channel (def: 200000)',
+                         required=False, type=int, default=200000)
+    p_alloc.add_argument('-t', '--tsamp',
+                         help='Sample time in s (def: 6.4e-5)',
+                         required=False, type=float, default=6.4e-5)
+    p_alloc.add_argument('-p', '--nproc',
+                         help='Number of threads (def: 1)',
+                         required=False, type=int, default=1)
+    p_alloc.add_argument('-b', '--nblocks',
+                         help='Blocks of channels in the full pass (def: 4)',
+                         required=False, type=int, default=4)
+    p_alloc.add_argument('-r', '--repeat',
+                         help='Kernel calls per count (def: 3)',
+                         required=False, type=int, default=3)
+    p_alloc.add_argument('-s', '--slack',
+                         help='kB the peak may exceed buffer + scratch (def: 8)',
+                         required=False, type=float, default=8.0)
+    p_alloc.set_defaults(func=bench_alloc)
+
+    args = parser.parse_args()
+
+    if args.bench is None:
+        parser.print_help()
+        sys.exit(2)
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_input()
+    args.func(args)
@@ -0,0 +1,354 @@
+"""
+fb_linefind.py
+
+Find periodic RFI (mains, cryocooler, ...) in a filterbank file
+and turn it into the f0 / nharm / width sets used by the
+frequency filter (m_fb_freq_filter_parallel_new.py, and the -z
+option of dsn_reduce.py).
+
+The zero-DM time series (the sum over channels, or over every
+chan_step-th channel) is read once, a block at a time, and its
+power spectrum is averaged with a streaming Welch estimator.
+Narrow lines are bins well above a running median of the
+spectrum, and lines are grouped into harmonic families.
+"""
+
+import numpy as np
+from scipy import ndimage, stats
+from argparse import ArgumentParser
+
+from fb_utils import MappedFilterbank, blockPlan, blockRanges
+
+# Fewest Welch segments a line search is trusted with
+MIN_NSEG = 8
+
+# A harmonic k f0 matches a line within one bin plus k times the 
+# error on f0 (HARM_DF0 bins), and never more than HARM_FRAC f0
+HARM_DF0 = 0.5
+HARM_FRAC = 0.05
+
+# Most harmonics (beyond f0) a family can take in
+MAX_NHARM = 16
+
+
+class WelchAccumulator(object):
+    """
+    Streaming Welch power spectrum: Hann windowed, 50% overlapped
+    segments of nfft samples, fed any number of samples at a time
+    with add().  Samples that do not yet fill a segment are kept
+    for the next call.
+    """
+    def __init__(self, nfft):
+        self.nfft = int(nfft)
+        self.step = self.nfft // 2
+        self.window = np.hanning(self.nfft)
+        self.psd = np.zeros(self.nfft // 2 + 1)
+        self.nseg = 0
+        self.tail = np.zeros(0)
+
+    def add(self, data):
+        data = np.concatenate((self.tail, data))
+        nn = len(data)
+        lo = 0
+        while (lo + self.nfft <= nn):
+            seg = data[lo : lo + self.nfft]
+            seg = (seg - np.mean(seg)) * self.window
+            self.psd += np.abs(np.fft.rfft(seg))**2
+            self.nseg += 1
+            lo += self.step
+        self.tail = data[lo:]
+
+    def spectrum(self):
+        """
+        Mean power per segment (arbitrary units)
+        """
+        return self.psd / max(self.nseg, 1)
+
+    def dof(self):
+        """
+        Equivalent degrees of freedom of each bin of spectrum() for 
+        Gaussian noise (see welch_dof)
+        """
+        return welch_dof(self.window, self.nseg, self.step)
+
+
+def welch_dof(window, nseg, step):
+    """
+    Equivalent degrees of freedom of each bin of the mean of nseg 
+    periodograms, windowed with window and step samples apart, for 
+    Gaussian noise: 2 per segment, less for the correlation of 
+    overlapping segments (Percival & Walden eq. 292b)
+    """
+    nseg = max(int(nseg), 1)
+    nfft = len(window)
+    norm = np.sum(window**2)
+    corr = 0.0
+    for mm in range(1, nseg):
+        lag = int(mm * step)
+        if (lag >= nfft):
+            break
+        rho = np.sum(window[:-lag] * window[lag:]) / norm
+        corr += (1.0 - mm / float(nseg)) * rho**2
+    return 2.0 * nseg / (1.0 + 2.0 * corr)
+
+
+def band_dof(window, dof, nbins):
+    """
+    Equivalent degrees of freedom of the mean of nbins adjacent 
+    bins that each have dof, less for the correlation the window 
+    causes between neighbouring bins (2/3 in amplitude for Hann)
+    """
+    nbins = max(int(nbins), 1)
+    nfft = len(window)
+    w2 = window**2
+    phase = 2.0 * np.pi * np.arange(nfft) / nfft
+    corr = 0.0
+    for kk in range(1, nbins):
+        rho = np.abs(np.sum(w2 * np.exp(-1j * kk * phase))) / np.sum(w2)
+        corr += (1.0 - kk / float(nbins)) * rho**2
+    return dof * nbins / (1.0 + 2.0 * corr)
+
+
+def line_threshold(snr, dof, ntrials=1, base_dof=None):
+    """
+    Power ratio (to the continuum) above which a bin with dof 
+    degrees of freedom is a line: its chi2(dof) / dof probability 
+    is the one-sided Gaussian tail of snr sigma, divided by the 
+    ntrials bins searched (Bonferroni).  If the continuum is itself 
+    an estimate with base_dof degrees of freedom, the ratio is F 
+    distributed instead.
+    """
+    prob = stats.norm.sf(snr) / ntrials
+    if base_dof is None:
+        return stats.chi2.isf(prob, dof) / dof
+    return stats.f.isf(prob, dof, base_dof)
+
+
+def median_ratio(dof):
+    """
+    Median of chi2(dof) / dof, the factor by which a running 
+    median sits below the true continuum
+    """
+    return stats.chi2.median(dof) / dof
+
+
+def median_dof(dof):
+    """
+    Degrees of freedom of the median of bins whose mean would have 
+    dof (band_dof): a median of many samples is as noisy as the 
+    mean of 2 / pi as many
+    """
+    return 2.0 * dof / np.pi
+
+
+def zero_dm_spectrum(infile, nfft=2**16, chan_step=1, mem_budget=None,
+                     max_spec=None):
+    """
+    Welch spectrum of the zero-DM time series of infile, summing
+    every chan_step-th channel, read a block at a time.  Only the
+    first max_spec spectra are used if given.
+
+    Returns freqs (Hz), psd, number of segments averaged, and the 
+    equivalent degrees of freedom of each bin (WelchAccumulator.dof)
+    """
+    mapFile = MappedFilterbank(infile)
+    nspec = mapFile.nspec
+    if max_spec is not None:
+        nspec = min(nspec, int(max_spec))
+    tsamp = float(mapFile.header["tsamp"])
+
+    if nspec < nfft:
+        nfft = 2**int(np.log2(nspec))
+    welch = WelchAccumulator(nfft)
+
+    blocksize, nblocks = blockPlan(mapFile.nchans, nspec, mapFile.nbits,
+                                   memBudget=mem_budget)
+    for lobin, hibin in blockRanges(nspec, blocksize):
+        block = mapFile.spectra[lobin:hibin, ::chan_step]
+        welch.add(np.sum(block, axis=1, dtype=np.float64))
+
+    mapFile.close()
+
+    freqs = np.fft.rfftfreq(welch.nfft, d=tsamp)
+    return freqs, welch.spectrum(), welch.nseg, welch.dof()
+
+
+def find_lines(freqs, psd, dof, snr=8.0, fmin=1.0, med_bins=64):
+    """
+    Find narrow lines in a Welch spectrum with dof degrees of 
+    freedom per bin.
+
+    For noise, each bin is its true power times chi2(dof) / dof.  
+    The true power is taken from a running median over med_bins 
+    bins (scaled by the median of chi2(dof) / dof), and a bin is in 
+    a line if its chi2 probability is below the one-sided Gaussian 
+    tail of snr sigma, divided by the number of bins searched 
+    (Bonferroni), so snr sets the false alarm rate of the whole 
+    spectrum.  Runs of such bins make one line, with the width taken 
+    from the bins within 20 dB of its peak.  Bins below fmin Hz (the 
+    red noise end) are ignored.
+
+    Returns arrays of line centre (power weighted, Hz), half-width 
+    (Hz, at least one bin) and peak ratio, strongest first
+    """
+    df = freqs[1] - freqs[0]
+    searched = (freqs >= fmin)
+    nbins = max(np.sum(searched), 1)
+
+    base = ndimage.median_filter(psd, size=med_bins, mode='nearest')
+    base = base / median_ratio(dof)
+    ratio = psd / np.maximum(base, 1e-30)
+    thresh = line_threshold(snr, dof, ntrials=nbins)
+
+    hot = (ratio > thresh) & searched
+    labels, nlines = ndimage.label(hot)
+
+    centers = []
+    widths = []
+    peaks = []
+    for ii in range(1, nlines + 1):
+        idx = np.where(labels == ii)[0]
+        excess = psd[idx] - base[idx]
+        # Window leakage of a strong line: width from the bins
+        # within 20 dB of the peak
+        core = idx[excess >= 0.01 * np.max(excess)]
+        centers.append(np.sum(freqs[idx] * excess) / np.sum(excess))
+        widths.append(0.5 * (freqs[core[-1]] - freqs[core[0]]) + df)
+        peaks.append(np.max(ratio[idx]))
+
+    order = np.argsort(peaks)[::-1]
+    return (np.array(centers)[order], np.array(widths)[order],
+            np.array(peaks)[order])
+
+
+def harmonic_families(centers, widths, df, tol=None, max_nharm=MAX_NHARM):
+    """
+    Group lines into harmonic families.  Lines are taken lowest 
+    frequency first as candidate fundamentals f0.  The line nearest 
+    k f0 (k = 2 ... max_nharm + 1) joins the family if it is within 
+    tol of it: by default one bin (df) plus k HARM_DF0 bins for the 
+    error on f0, and at most HARM_FRAC f0.  A line only takes in 
+    harmonics if its 2nd or 3rd is among them, so a low frequency 
+    line (a cryocooler at ~1 Hz, say) does not collect every other 
+    line as a high harmonic.  nharm is set so the filter covers f0 
+    up to the highest harmonic found.
+
+    Returns a list of (f0, nharm, width) with width the largest 
+    half-width in the family
+    """
+    order = np.argsort(centers)
+    centers = np.asarray(centers)[order]
+    widths = np.asarray(widths)[order]
+    used = np.zeros(len(centers), dtype=bool)
+
+    families = []
+    for ii in range(len(centers)):
+        if used[ii]:
+            continue
+        f0 = centers[ii]
+        used[ii] = True
+
+        members = {}
+        for kk in range(2, int(max_nharm) + 2):
+            if tol is not None:
+                dtol = tol
+            else:
+                dtol = min(df * (1.0 + kk * HARM_DF0), HARM_FRAC * f0)
+            free = np.where(~used)[0]
+            if (len(free) == 0):
+                break
+            jj = free[np.argmin(np.abs(centers[free] - kk * f0))]
+            if (abs(centers[jj] - kk * f0) <= dtol):
+                members[kk] = jj
+
+        kmax = 1
+        width = widths[ii]
+        if (2 in members) or (3 in members):
+            for kk, jj in members.items():
+                used[jj] = True
+                kmax = max(kmax, kk)
+                width = max(width, widths[jj])
+        families.append((f0, kmax - 1, width))
+
+    return families
+
+
+def detect_lines(infile, nfft=2**16, chan_step=1, snr=8.0, fmin=1.0,
+                 mem_budget=None, max_spec=None, verbose=True):
+    """
+    Find the periodic lines in infile and return them as a list
+    of (f0, nharm, width) for the frequency filter (an empty list
+    if the scan is clean)
+    """
+    freqs, psd, nseg, dof = zero_dm_spectrum(infile, nfft=nfft,
+                                             chan_step=chan_step,
+                                             mem_budget=mem_budget,
+                                             max_spec=max_spec)
+
+    if verbose:
+        print("Line search: %d segments of %d samples (%.3f Hz bins, %.1f dof)" %(\
+              nseg, len(psd) * 2 - 2, freqs[1], dof))
+
+    # Too few segments to tell lines from noise
+    if (nseg < MIN_NSEG):
+        if verbose:
+            print("  Fewer than %d segments: no lines reported (use a smaller nfft)" %(\
+                  MIN_NSEG))
+            print("")
+        return []
+
+    centers, widths, peaks = find_lines(freqs, psd, dof, snr=snr,
+                                        fmin=fmin)
+    families = harmonic_families(centers, widths, freqs[1])
+
+    if verbose:
+        print("  %d lines in %d families" %(len(centers), len(families)))
+        for f0, nh, ww in families:
+            print("  f0 = %.3f Hz, nharm = %d, width = %.2f Hz" %(f0, nh, ww))
+        print("")
+
+    return families
+
+
+def zap_strings(families):
+    """
+    Turn (f0, nharm, width) sets into dsn_reduce -z strings
+    """
+    return [ "%.3f,%d,%.2f" %(f0, nh, ww) for f0, nh, ww in families ]
+
+
+def parse_input():
+    """
+    Use argparse to parse input
+    """
+    prog_desc = "Find periodic RFI lines in a filterbank file"
+    parser = ArgumentParser(description=prog_desc)
+    parser.add_argument('infile', help='Input file name')
+    parser.add_argument('-n', '--nfft',
+                        help='Welch segment length (def: 65536)',
+                        required=False, type=int, default=2**16)
+    parser.add_argument('-c', '--chan_step',
+                        help='Sum every chan_step-th channel (def: 1)',
+                        required=False, type=int, default=1)
+    parser.add_argument('-s', '--snr',
+                        help='Detection threshold (def: 8.0)',
+                        required=False, type=float, default=8.0)
+    parser.add_argument('-f', '--fmin',
+                        help='Lowest frequency searched in Hz (def: 1.0)',
+                        required=False, type=float, default=1.0)
+    parser.add_argument('-m', '--max_spec',
+                        help='Only use the first max_spec spectra',
+                        required=False, type=int, default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_input()
+    families = detect_lines(args.infile, nfft=args.nfft,
+                            chan_step=args.chan_step, snr=args.snr,
+                            fmin=args.fmin, max_spec=args.max_spec)
+    for zz in zap_strings(families):
+        print("-z %s" %(zz))
@@ -7,44 +7,1050 @@ Modified on 12 Jan 2022 by rsw
 
 Helper functions to read/write filterbank files
 """
+import os
 import sys
 import copy
+import errno
+import time
+import queue
+import atexit
+import shutil
+import signal
+import zlib
+import json
+import multiprocessing as mp
 import numpy as np
 import filterbank
 import h5py
+from threading import Thread
+from multiprocessing import shared_memory
 
+# Default staging layout.  Chunks are CHUNK_BYTES of a single 
+# channel so a per-channel row read touches whole, contiguous 
+# chunks, and the chunk length divides the read BLOCKSIZE so the 
+# block writes never partially fill a chunk.  RDCC_BYTES is the 
+# h5py chunk cache given to the staging file.
+CHUNK_BYTES = 2**20
+RDCC_BYTES = 64 * 2**20
 
-def readFilterbank(inputFilename, logFile="", BLOCKSIZE = 1e6):
+# Tile edge (elements) for transposeBlock
+TRANSPOSE_TILE = 128
+
+# Fast scratch directories to try (in order) for the hdf5 staging 
+# file before falling back to the input file's directory, e.g. 
+# ["/dev/shm", "/local/nvme"].  A tier is only used if it has room 
+# for the staging file plus SCRATCH_HEADROOM of its total size.
+SCRATCH_DIRS = []
+SCRATCH_HEADROOM = 0.05
+
+# Target size of each channel-group file of a sharded staging store
+SHARD_BYTES = 256 * 2**20
+
+# Deflate level used when the staging data are gzip compressed
+COMPRESSION_LEVEL = 1
+
+# Staging files not yet released; removed if the process dies
+_activeStaging = []
+
+# Whether the exit / SIGTERM cleanup of _activeStaging is set up
+_cleanupRegistered = False
+
+
+def stagingChunks(nchans, nspec, BLOCKSIZE=1e6, chunkBytes=CHUNK_BYTES, 
+                  itemsize=4):
+    """
+    Pick the (chans, spectra) chunk shape for the staging dataset.
+
+    Each chunk holds one channel and BLOCKSIZE/k spectra, with k 
+    the smallest divisor of BLOCKSIZE giving a chunk of at most 
+    chunkBytes, so that block writes fill whole chunks.  If there 
+    is no such divisor up to twice the smallest k (e.g. a prime 
+    number of spectra shorter than BLOCKSIZE), the chunks are 
+    ceil(BLOCKSIZE/k) and the last one of each block is partial.  
+    Returns None (contiguous layout) if chunkBytes is 0 or None.
+    """
+    if not chunkBytes:
+        return None
+    
+    blocksize = int(min(BLOCKSIZE, nspec))
+    nsplit = max(int(np.ceil(float(blocksize * itemsize) / chunkBytes)), 1)
+    divisors = [ k for k in range(nsplit, 2 * nsplit + 1) 
+                 if (blocksize % k == 0) ]
+    if divisors:
+        nsplit = divisors[0]
+    chunkSpec = int(np.ceil(float(blocksize) / nsplit))
+    
+    return (1, max(chunkSpec, 1))
+
+
+def stagingTiers(inputFilename, nbytes, scratchDirs=None, logFile=""):
+    """
+    List the staging file paths to try, fastest first.  Each 
+    scratch directory with room for nbytes (plus headroom) gets 
+    <scratch>/<input name>.<pid>.hdf5, and the input directory 
+    (<inputFilename>.hdf5) is always the last resort.
+    """
+    if scratchDirs is None:
+        scratchDirs = SCRATCH_DIRS
+    
+    inputName = os.path.basename(inputFilename)
+    tiers = []
+    
+    for scratchDir in scratchDirs:
+        if not os.path.isdir(scratchDir):
+            continue
+        usage = shutil.disk_usage(scratchDir)
+        if (usage.free - SCRATCH_HEADROOM * usage.total >= nbytes):
+            tiers.append("%s/%s.%d.hdf5" %(scratchDir, inputName, os.getpid()))
+        else:
+            outStr = "Scratch %s too small (%.1f GB free, need %.1f GB)" %(\
+                     scratchDir, usage.free / 2.0**30, nbytes / 2.0**30)
+            if (logFile == ""):
+                print(outStr)
+            else:
+                logFile.write("%s\n" % outStr)
+    
+    tiers.append("%s.hdf5" % inputFilename)
+    
+    return tiers
+
+
+def _removeActiveStaging():
+    """
+    Remove any staging files that were never released.  Runs at 
+    exit, so a stage that fails does not leave its copy behind.
+    """
+    for h5Filename in list(_activeStaging):
+        _removeStagingPath(h5Filename)
+        _activeStaging.remove(h5Filename)
+
+
+def _removeStagingPath(stagingPath):
+    """
+    Delete a staging file (hdf5) or directory (sharded store)
+    """
+    if os.path.isdir(stagingPath):
+        print("Removing %s" % stagingPath)
+        shutil.rmtree(stagingPath)
+    elif os.path.exists(stagingPath):
+        print("Removing %s" % stagingPath)
+        os.remove(stagingPath)
+
+
+# Errors meaning the scratch device is out of space (or quota)
+SPACE_ERRNOS = [ errno.ENOSPC, getattr(errno, "EDQUOT", errno.ENOSPC) ]
+
+
+def _scratchFull(err):
+    """
+    True if an OSError means the scratch device is full.  h5py 
+    reports failed writes without setting err.errno, so its 
+    message ("errno = 28, ...") is checked as well.
+    """
+    if err.errno is not None:
+        return (err.errno in SPACE_ERRNOS)
+    msg = str(err)
+    return any([ ("errno = %d," % code) in msg for code in SPACE_ERRNOS ])
+
+
+def _exitOnTerm(signum, frame):
+    sys.exit(128 + signum)
+
+
+def registerStaging(h5Filename):
+    """
+    Track a staging file so it is removed if the process exits 
+    (including on SIGTERM) before releaseStaging is called.  The 
+    cleanup is registered with atexit once, on the first call.
+    """
+    global _cleanupRegistered
+    if not _cleanupRegistered:
+        atexit.register(_removeActiveStaging)
+        if (signal.getsignal(signal.SIGTERM) == signal.SIG_DFL):
+            signal.signal(signal.SIGTERM, _exitOnTerm)
+        _cleanupRegistered = True
+    
+    if h5Filename not in _activeStaging:
+        _activeStaging.append(h5Filename)
+
+
+def releaseStaging(stagingFile, clean=False):
+    """
+    Close the staging (h5py or sharded) or mapped file returned 
+    by readFilterbank.  The staging file is kept unless clean is 
+    set.  Call this once the stage has succeeded.
+    """
+    h5Filename = getattr(stagingFile, "filename", None)
+    stagingFile.close()
+    
+    if h5Filename in _activeStaging:
+        _activeStaging.remove(h5Filename)
+        if clean:
+            _removeStagingPath(h5Filename)
+    
+    return
+
+
+def createStaging(h5Filename, nchans, nspec, dtype="float32", 
+                  BLOCKSIZE=1e6, chunkBytes=CHUNK_BYTES, 
+                  rdccBytes=RDCC_BYTES, compression=None):
+    """
+    Create the h5py file and (nchans, nspec) "data" dataset used 
+    to stage the filterbank data.  Returns (h5pyFile, dataset).
+
+    compression = None   : uncompressed
+                  "lzf"  : lzf + byte shuffle (fast, modest ratio)
+                  "gzip" : deflate (COMPRESSION_LEVEL) + byte shuffle. 
+                           readChannel / writeChannel (de)compress 
+                           these chunks in the calling thread, so the 
+                           per-channel workers run it in parallel.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    chunks = stagingChunks(nchans, nspec, BLOCKSIZE=BLOCKSIZE, 
+                           chunkBytes=chunkBytes, itemsize=itemsize)
+    
+    if (compression == "none"):
+        compression = None
+    
+    compressOpts = {}
+    if compression is not None:
+        if chunks is None:
+            chunks = stagingChunks(nchans, nspec, BLOCKSIZE=BLOCKSIZE, 
+                                   itemsize=itemsize)
+        compressOpts["compression"] = compression
+        compressOpts["shuffle"] = True
+        if (compression == "gzip"):
+            compressOpts["compression_opts"] = COMPRESSION_LEVEL
+    
+    # Enough hash slots for ~100x the chunks that fit in the cache
+    if chunks is not None:
+        nslots = int(100 * rdccBytes / (chunks[0] * chunks[1] * itemsize)) 
+    else:
+        nslots = 521
+    nslots = max(nslots, 521)
+    
+    h5pyFile = h5py.File(h5Filename, "w", rdcc_nbytes=int(rdccBytes), 
+                         rdcc_nslots=nslots, rdcc_w0=1.0)
+    spectraData = h5pyFile.create_dataset("data", (nchans, nspec), 
+                                          dtype=dtype, chunks=chunks, 
+                                          **compressOpts)
+    
+    return h5pyFile, spectraData
+
+
+class ShardedArray(object):
+    """
+    Staging store split over several files so that separate 
+    processes can fill and modify it at the same time.
+
+    The (nchans, nspec) data are stored channel-major in groups of 
+    channels, one .npy file per group (about SHARD_BYTES each), 
+    listed in an index.json in the store directory.  Every process 
+    opens its own memory maps of the shards, and processes writing 
+    disjoint time ranges or channels never touch the same bytes, 
+    so no locking is needed.
+
+    Indexing supports what the stages use on the hdf5 dataset: 
+    data[ichan], data[c0:c1], data[:, lo:hi], and assignment to 
+    the same.  Has shape, dtype, filename and close() so it can 
+    stand in for both the dataset and the file from readFilterbank.
+    """
+    def __init__(self, shardDir, mode="r+"):
+        with open(os.path.join(shardDir, "index.json"), "r") as fin:
+            index = json.load(fin)
+        
+        self.filename = shardDir
+        self.shape = (int(index["nchans"]), int(index["nspec"]))
+        self.ndim = 2
+        self.dtype = np.dtype(index["dtype"])
+        self.chansPerShard = int(index["chansPerShard"])
+        self.shardFiles = [ os.path.join(shardDir, ff) for ff in index["shards"] ]
+        self.mode = mode
+        self._shards = [ None ] * len(self.shardFiles)
+    
+    @classmethod
+    def create(cls, shardDir, nchans, nspec, dtype="float32", 
+               shardBytes=SHARD_BYTES):
+        """
+        Make a new store in shardDir, with every shard file 
+        allocated at its full size (so running out of space 
+        raises OSError here rather than SIGBUS on a later write).
+        """
+        dtype = np.dtype(dtype)
+        rowBytes = float(nspec) * dtype.itemsize
+        chansPerShard = int(max(1, min(nchans, shardBytes // rowBytes)))
+        
+        os.makedirs(shardDir)
+        shards = []
+        for ishard, lochan in enumerate(range(0, nchans, chansPerShard)):
+            nrows = min(chansPerShard, nchans - lochan)
+            shardName = "shard%05d.npy" % ishard
+            shardPath = os.path.join(shardDir, shardName)
+            
+            shard = np.lib.format.open_memmap(shardPath, mode="w+", 
+                                              dtype=dtype, 
+                                              shape=(nrows, nspec))
+            del shard
+            fd = os.open(shardPath, os.O_RDWR)
+            try:
+                os.posix_fallocate(fd, 0, os.fstat(fd).st_size)
+            except AttributeError:
+                pass
+            finally:
+                os.close(fd)
+            shards.append(shardName)
+        
+        index = {"nchans" : int(nchans), "nspec" : int(nspec), 
+                 "dtype" : dtype.str, "chansPerShard" : chansPerShard, 
+                 "shards" : shards}
+        with open(os.path.join(shardDir, "index.json"), "w") as fout:
+            json.dump(index, fout)
+        
+        return cls(shardDir)
+    
+    def _shard(self, ishard):
+        if self._shards[ishard] is None:
+            self._shards[ishard] = np.load(self.shardFiles[ishard], 
+                                           mmap_mode=self.mode)
+        return self._shards[ishard]
+    
+    def _pieces(self, key):
+        """
+        Split an index into per-shard pieces.  Returns the channel 
+        index (int or array), the spectrum index, and a list of 
+        (ishard, shard rows, selection of output rows).
+        """
+        if isinstance(key, tuple):
+            chanKey = key[0]
+            specKey = key[1] if len(key) > 1 else slice(None)
+        else:
+            chanKey = key
+            specKey = slice(None)
+        
+        if isinstance(chanKey, (int, np.integer)):
+            ishard, row = divmod(int(chanKey) % self.shape[0], self.chansPerShard)
+            return chanKey, specKey, [(ishard, row, None)]
+        
+        chans = np.arange(self.shape[0])[chanKey]
+        shardIdx = chans // self.chansPerShard
+        pieces = []
+        for ishard in np.unique(shardIdx):
+            sel = np.where(shardIdx == ishard)[0]
+            rows = chans[sel] - ishard * self.chansPerShard
+            if np.all(np.diff(rows) == 1):
+                rows = slice(rows[0], rows[-1] + 1)
+            pieces.append((int(ishard), rows, sel))
+        
+        return chans, specKey, pieces
+    
+    def __getitem__(self, key):
+        chans, specKey, pieces = self._pieces(key)
+        
+        if (len(pieces) == 1) and (pieces[0][2] is None):
+            ishard, row, sel = pieces[0]
+            return np.array(self._shard(ishard)[row, specKey])
+        
+        parts = [ self._shard(ishard)[rows, specKey] 
+                  for ishard, rows, sel in pieces ]
+        if not parts:
+            return np.empty((0,) + np.empty(self.shape[1])[specKey].shape, 
+                            dtype=self.dtype)
+        return np.concatenate(parts, axis=0)
+    
+    def __setitem__(self, key, value):
+        chans, specKey, pieces = self._pieces(key)
+        value = np.asarray(value)
+        
+        if (len(pieces) == 1) and (pieces[0][2] is None):
+            ishard, row, sel = pieces[0]
+            self._shard(ishard)[row, specKey] = value
+            return
+        
+        if isinstance(specKey, (int, np.integer)):
+            specShape = ()
+        else:
+            specShape = (len(range(self.shape[1])[specKey]),)
+        value = np.broadcast_to(value, (len(chans),) + specShape)
+        
+        for ishard, rows, sel in pieces:
+            self._shard(ishard)[rows, specKey] = value[sel]
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def flush(self):
+        for shard in self._shards:
+            if shard is not None:
+                shard.flush()
+    
+    def close(self):
+        self.flush()
+        self._shards = [ None ] * len(self.shardFiles)
+
+
+def _fillShards(args):
+    """
+    Copy the spectra lobin:hibin of a filterbank file into a 
+    sharded store.  Run by the processes filling a store in 
+    parallel (see readFilterbank), each on its own time range 
+    (a share of a block, so the nproc chanBlocks together fit 
+    in the memory budget).
+    """
+    inputFilename, shardDir, lobin, hibin = args
+    
+    mapFile = MappedFilterbank(inputFilename)
+    spectraData = ShardedArray(shardDir)
+    
+    chanBlock = np.empty((mapFile.nchans, hibin - lobin), 
+                         dtype=spectraData.dtype)
+    transposeBlock(mapFile.spectra[lobin:hibin], chanBlock)
+    spectraData[:, lobin:hibin] = chanBlock
+    
+    spectraData.close()
+    mapFile.close()
+    
+    return hibin - lobin
+
+
+def _directChunks(spectraData):
+    """
+    True if spectraData is an hdf5 dataset with single channel, 
+    shuffle + deflate chunks that readChannel / writeChannel can 
+    handle themselves.
+    """
+    if not isinstance(spectraData, h5py.Dataset):
+        return False
+    if (spectraData.compression != "gzip") or not spectraData.shuffle:
+        return False
+    if (spectraData.chunks is None) or (spectraData.chunks[0] != 1):
+        return False
+    
+    # Filter pipeline must be exactly shuffle -> deflate
+    dcpl = spectraData.id.get_create_plist()
+    filters = [ dcpl.get_filter(ii)[0] for ii in range(dcpl.get_nfilters()) ]
+    
+    return (filters == [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE])
+
+
+def readChannel(spectraData, ichan):
+    """
+    Read one channel (row) of the staging data.
+
+    For gzip compressed staging, the raw chunks are read with 
+    read_direct_chunk and inflated / unshuffled here.  zlib releases 
+    the GIL, so threads reading different channels decompress in 
+    parallel instead of queuing behind h5py's lock.  Anything else 
+    is just spectraData[ichan].
+    """
+    if not _directChunks(spectraData):
+        return spectraData[ichan]
+    
+    nspec = spectraData.shape[1]
+    chunkSpec = spectraData.chunks[1]
+    dtype = spectraData.dtype
+    chanData = np.empty(nspec, dtype=dtype)
+    
+    for lobin in range(0, nspec, chunkSpec):
+        hibin = min(lobin + chunkSpec, nspec)
+        filterMask, raw = spectraData.id.read_direct_chunk((ichan, lobin))
+        
+        # A set mask bit means that filter was skipped for the chunk
+        if not (filterMask & 2):
+            raw = zlib.decompress(raw)
+        raw = np.frombuffer(raw, dtype=np.uint8)
+        if not (filterMask & 1):
+            raw = raw.reshape((dtype.itemsize, -1)).T
+        
+        chunkData = np.ascontiguousarray(raw).view(dtype).ravel()
+        chanData[lobin:hibin] = chunkData[:hibin-lobin]
+    
+    return chanData
+
+
+def writeChannel(spectraData, ichan, chanData):
+    """
+    Write one channel (row) of the staging data.  For gzip 
+    compressed staging the chunks are shuffled / deflated here and 
+    written with write_direct_chunk (see readChannel).
+    """
+    if not _directChunks(spectraData):
+        spectraData[ichan] = chanData
+        return
+    
+    nspec = spectraData.shape[1]
+    chunkSpec = spectraData.chunks[1]
+    dtype = spectraData.dtype
+    chanData = np.asarray(chanData, dtype=dtype)
+    
+    for lobin in range(0, nspec, chunkSpec):
+        hibin = min(lobin + chunkSpec, nspec)
+        
+        # Chunks are always stored full size
+        chunkData = np.zeros(chunkSpec, dtype=dtype)
+        chunkData[:hibin-lobin] = chanData[lobin:hibin]
+        
+        shuffled = chunkData.view(np.uint8).reshape((-1, dtype.itemsize)).T
+        raw = zlib.compress(np.ascontiguousarray(shuffled).tobytes(), 
+                            COMPRESSION_LEVEL)
+        spectraData.id.write_direct_chunk((ichan, lobin), raw)
+    
+    return
+
+
+class MappedFilterbank(object):
+    """
+    Read-only memory map of the data in a filterbank file.
+
+    The spectra are mapped in their native (time-major) layout 
+    and exposed through self.data as a (nchans, nspec) view, so 
+    nothing is read from disk until it is indexed and values are 
+    only converted from the native dtype where they are used.
+    Has a close() method so it can stand in for the h5py file 
+    returned by readFilterbank.
+    """
+    def __init__(self, inputFilename):
+        fb = filterbank.FilterbankFile(inputFilename)
+        
+        self.filename = inputFilename
+        self.header = copy.deepcopy(fb.header)
+        self.nbits = fb.nbits
+        self.nchans = int(fb.nchans)
+        self.nspec = int(fb.nspec)
+        self.header_size = int(fb.header_size)
+        self.dtype = np.dtype(fb.dtype)
+        fb.close()
+        
+        self.spectra = np.memmap(inputFilename, dtype=self.dtype, mode="r", 
+                                 offset=self.header_size, 
+                                 shape=(self.nspec, self.nchans))
+        self.data = self.spectra.T
+    
+    def close(self):
+        # Dropping the references releases the map
+        self.spectra = None
+        self.data = None
+
+
+def mapFilterbank(inputFilename, logFile=""):
+    """
+    Memory map the filterbank file instead of copying it to 
+    an .hdf5 file.  Returns the same tuple as readFilterbank, 
+    but spectraData is a read-only (nchans, nspec) view of the 
+    input file in its native dtype.
+    """
+    if (logFile == ""):
+        print("Mapping filterbank file (%s)...\n" % inputFilename)
+    else:
+        logFile.write("Mapping filterbank file (%s)...\n\n" % inputFilename)
+    
+    mapFile = MappedFilterbank(inputFilename)
+    
+    return mapFile.data, mapFile.header, mapFile.nbits, mapFile;
+
+
+def transposeBlock(src, out, tile=TRANSPOSE_TILE):
+    """
+    Copy the transpose of the 2D array src into the preallocated 
+    array out (converting to out's dtype), one tile x tile square 
+    at a time so both the reads and the writes stay in cache.  
+    Used to go between the time-major filterbank blocks and the 
+    channel-major staging data.
+    """
+    n0, n1 = np.shape(src)
+    
+    for i0 in range(0, n0, tile):
+        i1 = min(i0 + tile, n0)
+        for j0 in range(0, n1, tile):
+            j1 = min(j0 + tile, n1)
+            out[j0:j1, i0:i1] = src[i0:i1, j0:j1].T
+    
+    return out
+
+
+class FilterbankWriter(object):
+    """
+    Writer for a filterbank file whose size is known up front.
+
+    On creation the header is written and the file is allocated to 
+    its final size (header + nspec spectra), so blocks of spectra 
+    can then be written at their own offsets with writeSpectra in 
+    any order.  Writes use os.pwrite, which has no shared file 
+    position, so several threads can write blocks at once.  Other 
+    processes can open the same file with create=False and write 
+    their own blocks.
+    """
+    def __init__(self, outputFilename, inputHeader, nbits, nspec, 
+                 create=True):
+        if create:
+            filterbank.create_filterbank_file(outputFilename, inputHeader, 
+                                              nbits=nbits)
+        header, header_size = filterbank.read_header(outputFilename)
+        
+        self.filename = outputFilename
+        self.nbits = nbits
+        self.nchans = int(inputHeader["nchans"])
+        self.nspec = int(nspec)
+        self.header_size = int(header_size)
+        self.dtype = np.dtype(filterbank.get_dtype(nbits))
+        self.bytes_per_spectrum = self.nchans * self.dtype.itemsize
+        
+        if np.issubdtype(self.dtype, np.integer):
+            self.dtype_min = np.iinfo(self.dtype).min
+            self.dtype_max = np.iinfo(self.dtype).max
+        else:
+            self.dtype_min = None
+            self.dtype_max = None
+        
+        self.fd = os.open(outputFilename, os.O_RDWR)
+        
+        if create:
+            fileSize = self.header_size + self.nspec * self.bytes_per_spectrum
+            os.ftruncate(self.fd, fileSize)
+            # Reserve the blocks too where the filesystem supports it
+            try:
+                os.posix_fallocate(self.fd, 0, fileSize)
+            except (AttributeError, OSError):
+                pass
+    
+    def writeSpectra(self, spectra, ispec):
+        """
+        Write the time-major (nspec, nchans) block spectra starting 
+        at spectrum number ispec.  Values are clipped and cast to 
+        the file's dtype as in FilterbankFile.append_spectra.
+        """
+        if self.dtype_min is not None:
+            spectra = np.clip(spectra, self.dtype_min, self.dtype_max)
+        data = np.ascontiguousarray(spectra, dtype=self.dtype)
+        
+        buf = memoryview(data.reshape(-1)).cast("B")
+        offset = self.header_size + int(ispec) * self.bytes_per_spectrum
+        
+        while len(buf):
+            nwritten = os.pwrite(self.fd, buf, offset)
+            buf = buf[nwritten:]
+            offset += nwritten
+        
+        return
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def stagingDtype(dtype, nativeDtype):
+    """
+    Staging dtype for a readFilterbank dtype option: "native" 
+    (or None) keeps the file's own dtype, anything else is used 
+    as given (e.g., "float32").
+    """
+    if (dtype is None) or (dtype == "native"):
+        return np.dtype(nativeDtype)
+    else:
+        return np.dtype(dtype)
+
+
+def castToDtype(data, dtype):
+    """
+    Convert processed (float) data to dtype for storing in the 
+    staging data.  Integer dtypes are rounded and clipped to their 
+    range instead of wrapping.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    
+    return np.asarray(data, dtype=dtype)
+
+
+# Per-process state of the SharedChannelPool workers
+_poolState = {}
+
+
+def _attachShared(shmName, shape, dtype, rowFunc, rowArgs):
+    """
+    SharedChannelPool worker initializer: map the shared block 
+    and keep the row function for _filterSharedRows.
+    """
+    shm = shared_memory.SharedMemory(name=shmName)
+    
+    _poolState["shm"] = shm
+    _poolState["rows"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _poolState["rowFunc"] = rowFunc
+    _poolState["rowArgs"] = rowArgs
+
+
+def _filterSharedRows(bounds):
+    lorow, hirow = bounds
+    rows = _poolState["rows"]
+    rowFunc = _poolState["rowFunc"]
+    rowArgs = _poolState["rowArgs"]
+    
+    for irow in range(lorow, hirow):
+        rows[irow] = rowFunc(rows[irow], *rowArgs)
+    
+    return hirow - lorow
+
+
+class SharedChannelPool(object):
+    """
+    Process pool that applies rowFunc(row, *rowArgs) to the rows 
+    of a block of channels held in shared memory.
+
+    The parent copies up to nrows channels into .rows (an 
+    (nrows, nspec) array in a multiprocessing.shared_memory 
+    block), calls run(n), and copies the results back out.  The 
+    workers map the same block, so no channel data are pickled, 
+    and as separate processes they filter truly in parallel, 
+    free of the GIL and h5py's lock.  rowFunc must be a module 
+    level function (it is pickled once per worker).  The block 
+    and the pool are reused for every batch until close().
+    """
+    def __init__(self, nrows, nspec, nproc, rowFunc, rowArgs=(), 
+                 dtype="float64"):
+        self.shape = (int(nrows), int(nspec))
+        self.dtype = np.dtype(dtype)
+        nbytes = int(self.shape[0] * self.shape[1] * self.dtype.itemsize)
+        
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.rows = np.ndarray(self.shape, dtype=self.dtype, 
+                               buffer=self.shm.buf)
+        self.pool = mp.Pool(int(nproc), initializer=_attachShared, 
+                            initargs=(self.shm.name, self.shape, self.dtype, 
+                                      rowFunc, tuple(rowArgs)))
+    
+    def run(self, nrows):
+        """
+        Filter rows 0 to nrows of .rows in place.
+        """
+        tasks = [ (irow, irow + 1) for irow in range(int(nrows)) ]
+        self.pool.map(_filterSharedRows, tasks, chunksize=1)
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.rows = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def sharedBatchSize(nchans, nspec, nproc, memBudget=None):
+    """
+    Channels per SharedChannelPool batch: a few per process, 
+    fewer if the float64 block plus a filtering temporary per 
+    process (about 4 channel copies each, as in sosfiltfilt) 
+    would not fit in memBudget bytes.
+    """
+    nbatch = 4 * int(nproc)
+    if memBudget is not None:
+        chanBytes = 8.0 * nspec
+        nbatch = int((memBudget - 4 * nproc * chanBytes) // chanBytes)
+    
+    return int(max(1, min(nbatch, nchans)))
+
+
+class ChannelStats(object):
+    """
+    Per-channel count, mean and sum of squared deviations (M2), 
+    accumulated a block at a time.
+
+    Blocks (of time for every channel, or of whole channels) are 
+    folded in with the pairwise update of Chan, Golub & LeVeque, 
+    so they can be added in any order, and the partial results of 
+    workers handling different stretches of time can be combined 
+    with merge().  Everything is kept in float64.
+    """
+    def __init__(self, nchans):
+        self.count = np.zeros(int(nchans))
+        self.mean = np.zeros(int(nchans))
+        self.m2 = np.zeros(int(nchans))
+    
+    def addMoments(self, count, mean, m2, lochan=0):
+        """
+        Fold in the count(s), means and M2s of channels lochan 
+        onwards.
+        """
+        hichan = lochan + len(mean)
+        na = self.count[lochan:hichan]
+        nb = np.broadcast_to(np.asarray(count, dtype=np.float64), na.shape)
+        nn = na + nb
+        frac = nb / np.maximum(nn, 1.0)
+        delta = mean - self.mean[lochan:hichan]
+        
+        self.mean[lochan:hichan] += delta * frac
+        self.m2[lochan:hichan] += m2 + delta**2 * na * frac
+        self.count[lochan:hichan] = nn
+    
+    def addSpectra(self, spectra):
+        """
+        Add a time-major (nspec, nchans) block of every channel
+        """
+        if (len(spectra) == 0):
+            return
+        mean = np.mean(spectra, axis=0, dtype=np.float64)
+        m2 = np.sum(np.square(spectra - mean), axis=0)
+        self.addMoments(len(spectra), mean, m2)
+    
+    def addChannels(self, block, lochan=0):
+        """
+        Add a channel-major (nrows, nspec) block of channels 
+        lochan to lochan + nrows
+        """
+        mean = np.mean(block, axis=1, dtype=np.float64)
+        m2 = np.sum(np.square(block - mean[:, np.newaxis]), axis=1)
+        self.addMoments(np.shape(block)[1], mean, m2, lochan=lochan)
+    
+    def merge(self, other):
+        """
+        Fold in another ChannelStats for the same channels
+        """
+        self.addMoments(other.count, other.mean, other.m2)
+        return self
+    
+    def std(self, ddof=1):
+        return np.sqrt(self.m2 / np.maximum(self.count - ddof, 1.0))
+
+
+def getBlockSize(nchans, nbits, memBudget):
+    """
+    Number of spectra per block that keeps the temporaries made 
+    while reading or writing a block under memBudget bytes.
+
+    Per spectrum a block costs the native data (nbits/8 bytes per 
+    channel), plus a float32 copy and a float32 converted (clipped 
+    or transposed) copy, so nchans * (8 + nbits/8) bytes.
+    """
+    bytesPerSpectrum = nchans * (8.0 + nbits / 8.0)
+    blocksize = int(memBudget // bytesPerSpectrum)
+    
+    return max(blocksize, 1)
+
+
+def blockPlan(nchans, nspec, nbits, BLOCKSIZE=1e6, memBudget=None, 
+              logFile=""):
+    """
+    Decide the block length (in spectra) for reading / writing and 
+    report it.  If memBudget (bytes) is given, the block length 
+    comes from getBlockSize, otherwise BLOCKSIZE is used.
+
+    Returns the block length and the number of blocks.
+    """
+    if memBudget:
+        blocksize = getBlockSize(nchans, nbits, memBudget)
+    else:
+        blocksize = int(BLOCKSIZE)
+    
+    blocksize = max(min(blocksize, int(nspec)), 1)
+    nblocks = int(np.ceil(float(nspec) / blocksize))
+    blockBytes = blocksize * nchans * (8.0 + nbits / 8.0)
+    
+    if memBudget:
+        planStr = "Block plan: %d blocks of %d spectra (%.1f MB/block, budget %.1f MB)" %(\
+                  nblocks, blocksize, blockBytes / 2.0**20, memBudget / 2.0**20)
+    else:
+        planStr = "Block plan: %d blocks of %d spectra (%.1f MB/block)" %(\
+                  nblocks, blocksize, blockBytes / 2.0**20)
+    
+    if (logFile == ""):
+        print(planStr)
+    else:
+        logFile.write("%s\n" % planStr)
+    
+    return blocksize, nblocks
+
+
+def blockRanges(nspec, blocksize):
+    """
+    Yield the (lobin, hibin) spectrum ranges of each block
+    """
+    for lobin in range(0, int(nspec), int(blocksize)):
+        hibin = min(lobin + int(blocksize), int(nspec))
+        yield lobin, hibin
+
+
+def overlapBlocks(ranges, produce, consume, buffers, background="produce"):
+    """
+    Run produce(buf, lobin, hibin) then consume(buf, lobin, hibin) 
+    for each block range, with one of the two running in a 
+    background thread so the next block is produced while the 
+    current one is consumed.  The blocks are passed through a 
+    bounded queue of the reusable arrays in buffers.
+
+    background = "produce" : read-ahead (produce is the disk read)
+                 "consume" : write-behind (consume is the disk write)
+
+    Returns a dict with the time spent in the background (I/O) 
+    stage, the time the foreground stage spent waiting on it, and 
+    the I/O time that was hidden behind the foreground stage.
+    """
+    freeQueue = queue.Queue()
+    fullQueue = queue.Queue()
+    for buf in buffers:
+        freeQueue.put(buf)
+    
+    busy = {"produce" : 0.0, "consume" : 0.0}
+    wait = {"produce" : 0.0, "consume" : 0.0}
+    errors = []
+    
+    def producer():
+        try:
+            for lobin, hibin in ranges:
+                tstart = time.time()
+                buf = freeQueue.get()
+                tready = time.time()
+                wait["produce"] += tready - tstart
+                if errors:
+                    break
+                produce(buf, lobin, hibin)
+                busy["produce"] += time.time() - tready
+                fullQueue.put((buf, lobin, hibin))
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            fullQueue.put(None)
+    
+    def consumer():
+        while True:
+            tstart = time.time()
+            item = fullQueue.get()
+            tready = time.time()
+            wait["consume"] += tready - tstart
+            if item is None:
+                break
+            buf, lobin, hibin = item
+            if not errors:
+                try:
+                    consume(buf, lobin, hibin)
+                except BaseException as err:
+                    errors.append(err)
+            busy["consume"] += time.time() - tready
+            freeQueue.put(buf)
+    
+    if (background == "produce"):
+        thread = Thread(target=producer)
+        thread.start()
+        consumer()
+        thread.join()
+        ioStage, mainStage = "produce", "consume"
+    else:
+        thread = Thread(target=consumer)
+        thread.start()
+        producer()
+        thread.join()
+        ioStage, mainStage = "consume", "produce"
+    
+    if errors:
+        raise errors[0]
+    
+    ioTime = busy[ioStage]
+    waitTime = wait[mainStage]
+    
+    return {"io" : ioTime, "wait" : waitTime, 
+            "hidden" : max(ioTime - waitTime, 0.0)}
+
+
+def reportOverlap(timing, label, logFile=""):
+    """
+    Print/log how much of the I/O time overlapBlocks hid
+    """
+    if (timing["io"] > 0):
+        frac = 100.0 * timing["hidden"] / timing["io"]
+    else:
+        frac = 0.0
+    
+    outStr = "%s I/O: %.2f s, waited %.2f s, hidden %.2f s (%.0f%%)" %(\
+             label, timing["io"], timing["wait"], timing["hidden"], frac)
+    
+    if (logFile == ""):
+        print(outStr)
+    else:
+        logFile.write("%s\n" % outStr)
+    
+    return
+
+
+def readFilterbank(inputFilename, logFile="", BLOCKSIZE = 1e6, 
+                   staging="hdf5", chunkBytes=CHUNK_BYTES, 
+                   rdccBytes=RDCC_BYTES, memBudget=None, prefetch=0, 
+                   scratchDirs=None, dtype="float32", compression=None, 
+                   nproc=1):
     """ 
     Read the filterbank file into memory. Store the data in a 
     dynamically accessible h5py file, stored in a binary .hdf5 file.
+
+    staging = "hdf5"    : writable copy in a .hdf5 file
+              "sharded" : writable copy in a directory of channel-group 
+                          files (see ShardedArray), which nproc 
+                          processes fill in parallel and which 
+                          separate processes can safely modify
+              "mmap"    : read-only map of the input (see mapFilterbank), 
+                          for stages that do not modify the data
+
+    dtype is the dtype of the hdf5 copy.  The default "float32" 
+    is what the numeric stages were written for.  "native" keeps 
+    the file's dtype (e.g. uint8), which cuts the staging size and 
+    I/O by 32/nbits for stages that only zero or copy data, or that 
+    convert to float a channel at a time and store the result back 
+    with castToDtype.
+
+    compression compresses the hdf5 copy (None, "lzf" or "gzip", 
+    see createStaging), trading CPU for fewer bytes on scratch.  
+    It does not apply to sharded staging.
+
+    chunkBytes and rdccBytes set the chunk size and chunk cache 
+    of the hdf5 staging file (see createStaging).  chunkBytes=0 
+    gives the old contiguous layout.
+
+    If memBudget (bytes) is given, the number of spectra read at 
+    a time is set from it instead of BLOCKSIZE (see blockPlan).
+
+    If prefetch > 0, the next blocks are read from disk in a 
+    background thread (up to prefetch blocks ahead) while the 
+    current one is stored (see overlapBlocks).  The memory budget 
+    is then shared between the prefetch + 1 block buffers.
+
+    The .hdf5 file (or .shards directory) goes in the first of 
+    scratchDirs (default SCRATCH_DIRS) with room for it, else next 
+    to the input file (see stagingTiers).  It is removed automatically if the process 
+    exits before releaseStaging is called on the returned file.
     """
+    if (staging == "mmap"):
+        return mapFilterbank(inputFilename, logFile=logFile)
+    
     if (logFile == ""):
         print("Reading filterbank file (%s)...\n" % inputFilename)
     else:
         logFile.write("Reading filterbank file (%s)...\n\n" % inputFilename)
     
-    fb = filterbank.FilterbankFile(inputFilename)
+    mapFile = MappedFilterbank(inputFilename)
+    
+    inputHeader = mapFile.header
+    inputNbits = mapFile.nbits
+    totalChans = mapFile.nchans
+    nspec = mapFile.nspec
+    
+    nbuffers = int(prefetch) + 1
+    if memBudget:
+        memBudget = memBudget / nbuffers
     
-    inputHeader = copy.deepcopy(fb.header)
-    inputNbits = fb.nbits
-    totalChans = fb.nchans
-    nchans = np.arange(0, fb.nchans-1, 1) # Top of the band is index 0.
-    freqs = fb.frequencies
-    startbin = 0
-    endbin = fb.nspec
-    nspec = np.subtract(endbin, startbin)
-    nblocks = int(np.divide(nspec, BLOCKSIZE))
-    remainder = nspec % BLOCKSIZE
-    totalBlocks = nblocks
+    blocksize, totalBlocks = blockPlan(totalChans, nspec, inputNbits, 
+                                       BLOCKSIZE=BLOCKSIZE, 
+                                       memBudget=memBudget, 
+                                       logFile=logFile)
     
-    if (remainder):
-        totalBlocks = nblocks + 1
+    # Time-major blocks of the raw data, and the channel-major 
+    # block (staging dtype) they are transposed into before storing
+    buffers = [ np.empty((blocksize, totalChans), dtype=mapFile.dtype) 
+                for ii in range(nbuffers) ]
+    dtype = stagingDtype(dtype, mapFile.dtype)
+    chanBlock = np.empty((totalChans, blocksize), dtype=dtype)
     
-    h5pyFile = h5py.File("%s.hdf5" % inputFilename, "w")
-    spectraData = h5pyFile.create_dataset("data", (totalChans, nspec), dtype="float32")
+    def produce(buf, lobin, hibin):
+        np.copyto(buf[:hibin-lobin], mapFile.spectra[lobin:hibin])
     
-    for iblock in np.arange(0, nblocks, 1):
+    def consume(buf, lobin, hibin):
+        iblock = lobin // blocksize
         progress = np.multiply(np.divide(iblock + 1.0, totalBlocks), 100.0)
         if (logFile == ""):
             sys.stdout.write("Reading... [%3.2f%%]\r" % progress)
@@ -52,68 +1058,146 @@ def readFilterbank(inputFilename, logFile="", BLOCKSIZE = 1e6):
         else:
             logFile.write("Reading... [%3.2f%%]\n" % progress)
         
-        lobin = int(np.add(np.multiply(iblock, BLOCKSIZE), startbin))
-        hibin = int(np.add(lobin, BLOCKSIZE))
-        read_nspec = hibin-lobin
-        spectra = fb.get_spectra(lobin, read_nspec)
-        
-        spectraData[:, lobin:hibin] = spectra[:, :]
-        
-        #for ichan in np.arange(0, totalChans, 1):
-        #    print(ichan)
-        #    spectraData[ichan, lobin:hibin] = spectra[ichan, :]
+        nread = hibin - lobin
+        transposeBlock(buf[:nread], chanBlock[:, :nread])
+        spectraData[:, lobin:hibin] = chanBlock[:, :nread]
+    
+    # Try each scratch tier in turn, spilling to the next one if 
+    # this one runs out of space part way through
+    tiers = stagingTiers(inputFilename, 
+                         float(dtype.itemsize) * totalChans * nspec, 
+                         scratchDirs=scratchDirs, logFile=logFile)
     
-    if (remainder):
-        progress = np.multiply(np.divide(iblock + 2.0, totalBlocks), 100.0)
-       
+    timing = None
+    for itier, h5Filename in enumerate(tiers):
+        if (staging == "sharded"):
+            h5Filename = "%s.shards" % h5Filename[:-len(".hdf5")]
+        
         if (logFile == ""):
-            sys.stdout.write("Reading... [%3.2f%%]\r" % progress)
-            sys.stdout.flush()
+            print("Staging to %s" % h5Filename)
         else:
-            logFile.write("Reading... [%3.2f%%]\n" % progress)
+            logFile.write("Staging to %s\n" % h5Filename)
         
-        lobin = int(np.subtract(endbin, remainder))
-        hibin = int(endbin)
-        read_nspec = hibin-lobin
-        spectra = fb.get_spectra(lobin, read_nspec)
-       
-        spectraData[:, lobin:hibin] = spectra[:, :] 
-        #for ichan in np.arange(0, totalChans, 1):
-        #    spectraData[ichan, lobin:hibin] = spectra[ichan, :]
+        registerStaging(h5Filename)
+        h5pyFile = None
+        try:
+            if (staging == "sharded"):
+                h5pyFile = ShardedArray.create(h5Filename, totalChans, nspec, 
+                                               dtype=dtype)
+                spectraData = h5pyFile
+            else:
+                h5pyFile, spectraData = createStaging(h5Filename, 
+                                                      totalChans, nspec, 
+                                                      dtype=dtype, 
+                                                      compression=compression, 
+                                                      BLOCKSIZE=blocksize, 
+                                                      chunkBytes=chunkBytes, 
+                                                      rdccBytes=rdccBytes)
+            
+            ranges = blockRanges(nspec, blocksize)
+            if (staging == "sharded") and (nproc > 1):
+                # Each process copies its own time ranges, 1 / nproc 
+                # of a block each, so that together their blocks 
+                # stay within memBudget
+                tasks = [ (inputFilename, h5Filename, lobin, hibin) 
+                          for lobin, hibin in 
+                          blockRanges(nspec, -(-blocksize // int(nproc))) ]
+                pool = mp.Pool(int(nproc))
+                try:
+                    for iblock, nread in enumerate(pool.imap(_fillShards, tasks)):
+                        progress = 100.0 * (iblock + 1.0) / len(tasks)
+                        if (logFile == ""):
+                            sys.stdout.write("Reading... [%3.2f%%]\r" % progress)
+                            sys.stdout.flush()
+                        else:
+                            logFile.write("Reading... [%3.2f%%]\n" % progress)
+                finally:
+                    pool.close()
+                    pool.join()
+            elif (prefetch > 0):
+                timing = overlapBlocks(ranges, produce, consume, buffers, 
+                                       background="produce")
+            else:
+                for lobin, hibin in ranges:
+                    produce(buffers[0], lobin, hibin)
+                    consume(buffers[0], lobin, hibin)
+            h5pyFile.flush()
+            break
+        except OSError as err:
+            if (itier == len(tiers) - 1) or not _scratchFull(err):
+                raise
+            if (logFile == ""):
+                print("\nScratch %s full, spilling to next tier" % h5Filename)
+            else:
+                logFile.write("\nScratch %s full, spilling to next tier\n" % h5Filename)
+            if h5pyFile is not None:
+                h5pyFile.close()
+            _activeStaging.remove(h5Filename)
+            _removeStagingPath(h5Filename)
+    
+    mapFile.close()
     
     if (logFile == ""):
         print("\n")
     else:
         logFile.write("\n")
     
+    if timing is not None:
+        reportOverlap(timing, "Read", logFile=logFile)
+    
     return spectraData, inputHeader, inputNbits, h5pyFile;
 
 
 
 def writeFilterbank(outputFilename, spectraData, inputHeader, inputNbits, 
-                    logFile="", BLOCKSIZE = 1e6):
+                    logFile="", BLOCKSIZE = 1e6, zeroChans=None, 
+                    memBudget=None, prefetch=0):
     """ 
     Write the filterbank data from memory to a filterbank file. 
+    The output is allocated at its full size and each block is 
+    written at its own offset (see FilterbankWriter).
+
+    zeroChans is an optional list of channel indices that are 
+    written out as zeros.  This lets read-only (mapped) data be 
+    zapped on the way out without a staging copy.
+
+    If memBudget (bytes) is given, the number of spectra written 
+    at a time is set from it instead of BLOCKSIZE (see blockPlan).
+
+    If prefetch > 0, blocks are written to disk in a background 
+    thread (up to prefetch blocks behind) while the next one is 
+    gathered from spectraData (see overlapBlocks).
     """
     if (logFile == ""):
         print("Writing filterbank file (%s)...\n" % outputFilename)
     else:
         logFile.write("Writing filterbank file (%s)...\n\n" % outputFilename)
     
-    filterbank.create_filterbank_file(outputFilename, inputHeader, nbits=inputNbits)
-    outfil = filterbank.FilterbankFile(outputFilename, mode='write')
+    totalChans, nspec = np.shape(spectraData)
     
-    startbin = 0
-    endbin = np.shape(spectraData)[1]
+    outfil = FilterbankWriter(outputFilename, inputHeader, inputNbits, nspec)
     
-    nblocks = int(np.divide(endbin, BLOCKSIZE))
-    remainder = endbin % BLOCKSIZE
-    totalBlocks = nblocks
+    nbuffers = int(prefetch) + 1
+    if memBudget:
+        memBudget = memBudget / nbuffers
     
-    if (remainder):
-        totalBlocks = nblocks + 1
+    blocksize, totalBlocks = blockPlan(totalChans, nspec, inputNbits, 
+                                       BLOCKSIZE=BLOCKSIZE, 
+                                       memBudget=memBudget, 
+                                       logFile=logFile)
     
-    for iblock in np.arange(0, nblocks, 1):
+    # Time-major blocks to hand to the writer.  Staged (hdf5 or 
+    # sharded) data are read channel-major into chanBlock and 
+    # transposed from there.
+    buffers = [ np.empty((blocksize, totalChans), dtype=spectraData.dtype) 
+                for ii in range(nbuffers) ]
+    isHDF5 = isinstance(spectraData, h5py.Dataset)
+    isStaged = not isinstance(spectraData, np.ndarray)
+    if isStaged:
+        chanBlock = np.empty((totalChans, blocksize), dtype=spectraData.dtype)
+    
+    def produce(buf, lobin, hibin):
+        iblock = lobin // blocksize
         progress = np.multiply(np.divide(iblock + 1.0, totalBlocks), 100.0)
         if (logFile == ""):
             sys.stdout.write("Writing... [%3.2f%%]\r" % progress)
@@ -121,30 +1205,41 @@ def writeFilterbank(outputFilename, spectraData, inputHeader, inputNbits,
         else:
             logFile.write("Writing... [%3.2f%%]\n" % progress)
         
-        lobin = int(np.add(np.multiply(iblock, BLOCKSIZE), startbin))
-        hibin = int(np.add(lobin, BLOCKSIZE))
-        
-        spectra = spectraData[:,lobin:hibin].T
-        outfil.append_spectra(spectra)
-
-    if (remainder):
-        progress = np.multiply(np.divide(iblock + 2.0, totalBlocks), 100.0)
-        if (logFile == ""):
-            sys.stdout.write("Writing... [%3.2f%%]\r" % progress)
-            sys.stdout.flush()
+        nwrite = hibin - lobin
+        spectra = buf[:nwrite]
+        if isStaged:
+            if isHDF5:
+                spectraData.read_direct(chanBlock, np.s_[:, lobin:hibin], 
+                                        np.s_[:, :nwrite])
+            else:
+                chanBlock[:, :nwrite] = spectraData[:, lobin:hibin]
+            transposeBlock(chanBlock[:, :nwrite], spectra)
         else:
-            logFile.write("Writing... [%3.2f%%]\n" % progress)
-        
-        lobin = int(np.subtract(endbin, remainder))
-        hibin = int(endbin)
-        
-        spectra = spectraData[:,lobin:hibin].T
-        outfil.append_spectra(spectra)
+            # Mapped data are already time-major underneath
+            np.copyto(spectra, spectraData[:,lobin:hibin].T)
+        if (zeroChans is not None):
+            spectra[:, zeroChans] = 0
+    
+    def consume(buf, lobin, hibin):
+        outfil.writeSpectra(buf[:hibin-lobin], lobin)
+    
+    ranges = blockRanges(nspec, blocksize)
+    if (prefetch > 0):
+        timing = overlapBlocks(ranges, produce, consume, buffers, 
+                               background="consume")
+    else:
+        for lobin, hibin in ranges:
+            produce(buffers[0], lobin, hibin)
+            consume(buffers[0], lobin, hibin)
+    
+    outfil.close()
     
     if (logFile == ""):
         print("\n")
     else:
         logFile.write("\n")
     
+    if (prefetch > 0):
+        reportOverlap(timing, "Write", logFile=logFile)
+    
     return;
-
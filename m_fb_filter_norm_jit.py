@@ -13,55 +13,315 @@ import os
 from subprocess import call, check_call, check_output, Popen
 
 import numpy as np
-from numba import jit
+from numba import jit, prange, set_num_threads, config
 
 import filterbank
 
 import h5py
 from scipy import signal
-from threading import Thread
+from threading import Thread, Lock
 
-from fb_utils import readFilterbank, writeFilterbank
+from fb_utils import readFilterbank, writeFilterbank, releaseStaging
+from fb_utils import readChannel, writeChannel
+from fb_utils import MappedFilterbank, FilterbankWriter, ChannelStats
 
 BLOCKSIZE = 1e6
 
+# Working memory (bytes) for a block of channels when no 
+# memBudget is given
+BATCH_BYTES = 2**30
+
+# Fewest spectra per block the stream mode will work with
+STREAM_MIN_BLOCK = 1024
+
+@jit(nopython=True, nogil=True, cache=True)
+def movingAverageInto(data, window_size, out):
+    """ 
+    Put the moving average of data (as movingAverage) in out, a 
+    float64 array of the same length given by the caller, without 
+    allocating anything.  The window sums are the differences of 
+    two running cumulative sums, which add the same values in the 
+    same order as movingAverage's cumsum, so the results are 
+    identical.  The first / last values are padded with the first / 
+    last full window's average.  out must not be data.
+    """
+    nn = len(data)
+    navg = nn - window_size + 1
+    prepend = (window_size - 1) // 2
+    
+    head = 0.0
+    for ii in range(window_size - 1):
+        head += data[ii]
+    
+    tail = 0.0
+    for ii in range(navg):
+        head += data[ii + window_size - 1]
+        if (ii > 0):
+            tail += data[ii - 1]
+        out[prepend + ii] = (head - tail) / window_size
+    
+    for ii in range(prepend):
+        out[ii] = out[prepend]
+    for ii in range(prepend + navg, nn):
+        out[ii] = out[prepend + navg - 1]
+
+
 @jit(nopython=True)
 def movingAverage(data, window_size):
     """ 
-    Compute the moving average using brute force numpy cumsum.
-    jit to make it faster 
+    Compute the moving average (see movingAverageInto) as a new 
+    float64 array.  jit to make it faster 
     """
-    movingAvg = np.cumsum(data.astype(np.float64))
-    movingAvg[window_size:] = movingAvg[window_size:] - movingAvg[:-window_size]
-    movingAvg = movingAvg[window_size - 1:] / window_size
+    movingAvg = np.empty(len(data))
+    movingAverageInto(data, window_size, movingAvg)
+    
+    return movingAvg
 
-    # Prepend/append elements to the front/end of the list.
-    appendLength = (len(data) - len(movingAvg)) / 2.0
-    if (np.mod(appendLength, 1.0) != 0.0):
-        prependArray = np.array([movingAvg[0]] * int(appendLength))
-        appendArray = np.array([movingAvg[-1]] * int(appendLength + 1))
 
-        movingAvg = np.concatenate((prependArray, movingAvg))
-        movingAvg = np.concatenate((movingAvg, appendArray))
-    else:
-        prependArray = np.array([movingAvg[0]] * int(appendLength))
-        appendArray = np.array([movingAvg[-1]] * int(appendLength))
+@jit(nopython=True, nogil=True, cache=True)
+def detrendMoments(data, window, out, scratch):
+    """
+    Set out to data - movingAverage(data, window), rounded to 
+    float32 (out may be data), with the moving average put in the 
+    float64 scratch row.  Returns the mean and M2 (sum of squared 
+    deviations) of out, summed as it is written (about its first 
+    value, in float64), in the form ChannelStats takes.
+    """
+    nn = len(data)
+    movingAverageInto(data, window, scratch)
+    shift = np.float64(np.float32(data[0] - scratch[0]))
+    
+    s1 = 0.0
+    s2 = 0.0
+    for ii in range(nn):
+        val = np.float64(np.float32(data[ii] - scratch[ii]))
+        out[ii] = val
+        dev = val - shift
+        s1 += dev
+        s2 += dev * dev
+    
+    return shift + s1 / nn, s2 - s1 * s1 / nn
 
-        movingAvg = np.concatenate((prependArray, movingAvg))
-        movingAvg = np.concatenate((movingAvg, appendArray))
 
-    return movingAvg
+@jit(nopython=True, nogil=True, cache=True)
+def detrendNormalize(chanData, windows, scratch):
+    """
+    Detrend one channel in place by each moving average window in 
+    turn (rounding to float32 in between, as when each detrend is 
+    written back to the float32 staging data), then set it to zero 
+    mean and unit standard deviation (ddof = 1).  The same result 
+    as movingAvgData_Parallel for each window then zeroMean_Parallel, 
+    from one read and one write of the channel.  scratch is two 
+    float64 rows the length of the channel (see workScratch), so 
+    nothing is allocated per channel.
+    """
+    nn = len(chanData)
+    detrended = scratch[0]
+    for ii in range(nn):
+        detrended[ii] = chanData[ii]
+    
+    # The mean and variance come out of the last detrend, so the 
+    # normalisation is a single affine pass
+    for window in windows:
+        meanData, m2 = detrendMoments(detrended, window, detrended, scratch[1])
+    stdData = np.sqrt(m2 / max(nn - 1, 1))
+    
+    if (stdData == 0.0):
+        stdData = 1.0
+    
+    for ii in range(nn):
+        chanData[ii] = (detrended[ii] - meanData) / stdData
+
+
+def windowSize(timeConstant, tsamp):
+    """
+    Moving average window (samples, made odd) for timeConstant s
+    """
+    window = int(timeConstant / tsamp)
+    
+    if (window % 2 == 0):
+        window = window + 1
+    
+    return window
 
 
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def detrendBlock(block, window, scratch, means, m2s):
+    """
+    Subtract the moving average (movingAverage) from every row 
+    (channel) of the 2D block in place.  The rows are dealt out to 
+    one worker per row of scratch (see workScratch), each reusing 
+    its own scratch for all its rows.  Each row's mean and M2 after 
+    the detrend are put in means / m2s (see detrendMoments).
+    """
+    nworkers = scratch.shape[0]
+    for iwork in prange(nworkers):
+        for irow in range(iwork, block.shape[0], nworkers):
+            means[irow], m2s[irow] = detrendMoments(block[irow], window, 
+                                                    block[irow], 
+                                                    scratch[iwork, 0])
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def affineBlock(block, means, stds):
+    """
+    Set every row of the 2D block to (row - means[irow]) / stds[irow] 
+    in place, with the rows split over numba's threads.
+    """
+    nn = block.shape[1]
+    for irow in prange(block.shape[0]):
+        row = block[irow]
+        for ii in range(nn):
+            row[ii] = (row[ii] - means[irow]) / stds[irow]
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def zeroMeanBlock(block):
+    """
+    Set every row (channel) of the 2D block to zero mean and unit 
+    standard deviation (ddof = 1) in place, with the rows split 
+    over numba's threads.  Sums are accumulated in float64.
+    """
+    nn = block.shape[1]
+    for irow in prange(block.shape[0]):
+        row = block[irow]
+        
+        total = 0.0
+        for ii in range(nn):
+            total += row[ii]
+        meanData = total / nn
+        
+        sumSq = 0.0
+        for ii in range(nn):
+            dev = row[ii] - meanData
+            sumSq += dev * dev
+        stdData = np.sqrt(sumSq / max(nn - 1, 1))
+        
+        if (stdData == 0.0):
+            stdData = 1.0
+        
+        for ii in range(nn):
+            row[ii] = (row[ii] - meanData) / stdData
+
+
+@jit(nopython=True, nogil=True, parallel=True, cache=True)
+def detrendNormalizeBlock(block, windows, scratch):
+    """
+    detrendNormalize every row (channel) of the 2D block in place, 
+    with the rows dealt out to one worker per row of scratch (as 
+    detrendBlock).
+    """
+    nworkers = scratch.shape[0]
+    for iwork in prange(nworkers):
+        for irow in range(iwork, block.shape[0], nworkers):
+            detrendNormalize(block[irow], windows, scratch[iwork])
+
+
+def blockThreads(numProcessors):
+    """
+    Number of numba threads runBlocks uses for numProcessors
+    """
+    return int(min(max(int(numProcessors), 1), config.NUMBA_NUM_THREADS))
+
+
+def workScratch(numProcessors, nrows, nspec):
+    """
+    float64 scratch for the block kernels: nrows rows of nspec 
+    values for each of runBlocks' threads.  Made once per pass and 
+    reused for every channel.
+    """
+    return np.empty((blockThreads(numProcessors), nrows, int(nspec)))
+
+
+def blockChannels(nchans, nspec, numProcessors, memBudget=None):
+    """
+    Channels per block for runBlocks: the float32 block plus two 
+    float64 rows of scratch per thread (workScratch) fit in 
+    memBudget (default BATCH_BYTES) if they can.  A block always 
+    has at least a channel per thread, even when that goes over 
+    memBudget (runBlocks then warns with the actual footprint), 
+    so that long channels still use every thread.
+    """
+    if memBudget is None:
+        memBudget = BATCH_BYTES
+    nthreads = max(int(numProcessors), 1)
+    blockBytes = max(memBudget - nthreads * 2 * 8.0 * nspec, 0.0)
+    nbatch = int(blockBytes // (4.0 * nspec))
+    
+    return int(max(min(nbatch, nchans), min(nthreads, nchans), 1))
+
+
+def runBlocks(spectraData, kernel, kernelArgs, numProcessors, label, 
+              chanArgs=(), memBudget=None, logFile=""):
+    """
+    Read blocks of channels of spectraData as float32 2D slabs, 
+    run kernel(block, *kernelArgs, *chanArgs) on each (a numba 
+    kernel that works on the rows in place with prange, on 
+    numProcessors threads), and write them back.  chanArgs are 
+    per-channel arrays, passed as views of the block's channels 
+    (so the kernel can also fill them in).  Python only moves the 
+    blocks, so there is no per-channel thread start up and the 
+    work is not serialised by the GIL.  The blocks are read into 
+    one buffer, allocated once (as is any scratch the kernel is 
+    given in kernelArgs), so the steady state allocates nothing 
+    per channel or per block.
+    """
+    nchans, nspec = np.shape(spectraData)
+    nbatch = blockChannels(nchans, nspec, numProcessors, memBudget=memBudget)
+    set_num_threads(blockThreads(numProcessors))
+    
+    isHDF5 = isinstance(spectraData, h5py.Dataset)
+    blockBuf = np.empty((nbatch, nspec), dtype=np.float32)
+    
+    # The block and the kernel's scratch
+    footprint = blockBuf.nbytes + sum([ arr.nbytes for arr in kernelArgs 
+                                        if isinstance(arr, np.ndarray) ])
+    budget = BATCH_BYTES if (memBudget is None) else memBudget
+    if (footprint > budget):
+        msg = "Warning: %s blocks of %d channels and scratch need %.3g bytes, over the memBudget of %.3g bytes" %(\
+              label, nbatch, footprint, budget)
+        if (logFile == ""):
+            print(msg + "\n")
+        else:
+            logFile.write(msg + "\n\n")
+    
+    for lochan in range(0, nchans, nbatch):
+        hichan = min(lochan + nbatch, nchans)
+        block = blockBuf[:hichan - lochan]
+        if isHDF5:
+            spectraData.read_direct(block, np.s_[lochan:hichan])
+        else:
+            block[:] = spectraData[lochan:hichan]
+        blockArgs = tuple([ arr[lochan:hichan] for arr in chanArgs ])
+        kernel(block, *(tuple(kernelArgs) + blockArgs))
+        spectraData[lochan:hichan] = block
+        
+        progress = np.multiply(np.divide(hichan, float(nchans)), 100.0)
+        
+        if (logFile == ""):
+            print("%s: Channels %i-%i [%3.2f%%]" % (label, nchans - lochan, nchans - hichan + 1, progress))
+        else:
+            logFile.write("%s: Channels %i-%i [%3.2f%%]\n" % (label, nchans - lochan, nchans - hichan + 1, progress))
+    
+    if (logFile == ""):
+        print("\n")
+    else:
+        logFile.write("\n")
+    
+    return spectraData;
+
 
 def movingAvgData_Parallel(spectraData, inputHeader, timeConstant, 
-                           numProcessors, logFile=""):
+                           numProcessors, memBudget=None, stats=None, 
+                           logFile=""):
     """ 
     Remove variations in the data by calculating a moving average 
     in each channel of the filterbank file and subtracting this moving 
     average from the data. The window size of the moving average is 
     defined by the timeConstant input by the user. Modified to run 
-    in parallel over multiple filterbank channels. 
+    in parallel over multiple filterbank channels (see runBlocks). 
+    If a ChannelStats is given as stats, the mean and variance of 
+    each detrended channel are added to it.
     """
     
     if (logFile == ""):
@@ -78,75 +338,34 @@ def movingAvgData_Parallel(spectraData, inputHeader, timeConstant,
         nsamples = float(inputHeader["nsamples"])
     
     tsamp = float(inputHeader["tsamp"])
-    nchans = float(inputHeader["nchans"])
     
-    window = int(timeConstant / tsamp)
+    window = windowSize(timeConstant, tsamp)
     
-    if (window % 2 == 0):
-        window = window + 1
+    nchans, nspec = np.shape(spectraData)
+    means = np.zeros(nchans)
+    m2s = np.zeros(nchans)
     
-    def worker(ichan):
-        chanData = np.array(spectraData[ichan])
-        movingAvg = movingAverage(chanData, window)
-        chanData_detrend = np.subtract(chanData, movingAvg)
-        spectraData[ichan] = chanData_detrend
-    
-    ichan = 0
-    
-    for iBatch in np.arange(0, int(nchans / numProcessors), 1):
-        threads = []
-        for iProcess in np.arange(0, numProcessors, 1):
-            ichan = int(iProcess + (iBatch * numProcessors))
-            
-            t = Thread(target=worker, args=(ichan,))
-            threads.append(t)
-            
-            progress = np.multiply(np.divide(ichan + 1.0, nchans), 100.0)
-            
-            if (logFile == ""):
-                print("Detrending: Channel %i [%3.2f%%]" % (nchans - ichan, progress))
-            else:
-                logFile.write("Detrending: Channel %i [%3.2f%%]\n" % (nchans - ichan, progress))
-        
-        for x in threads:
-            x.start()
-        
-        for x in threads:
-            x.join()
+    scratch = workScratch(numProcessors, 1, nspec)
     
-    if (nchans % numProcessors):
-        threads = []
-        for ichan2 in np.arange(ichan + 1, int(nchans), 1):
-            t = Thread(target=worker, args=(ichan2,))
-            threads.append(t)
-            
-            progress = np.multiply(np.divide(ichan2 + 1.0, nchans), 100.0)
-            
-            if (logFile == ""):
-                print("Detrending: Channel %i [%3.2f%%]" % (nchans - ichan2, progress))
-            else:
-                logFile.write("Detrending: Channel %i [%3.2f%%]\n" % (nchans - ichan2, progress))
-        
-        for x in threads:
-            x.start()
-        
-        for x in threads:
-            x.join()
+    spectraData = runBlocks(spectraData, detrendBlock, (window, scratch), 
+                            numProcessors, "Detrending", 
+                            chanArgs=(means, m2s), memBudget=memBudget, 
+                            logFile=logFile)
     
-    if (logFile == ""):
-        print("\n")
-    else:
-        logFile.write("\n")
+    if (stats != None):
+        stats.addMoments(nspec, means, m2s)
     
     return spectraData;
 
 
 def zeroMean_Parallel(spectraData, inputHeader, numProcessors, 
-                      logFile=""):
+                      memBudget=None, stats=None, logFile=""):
     """ 
     Make sure the time-series in each channel of the filterbank file 
     has a zero mean. Modified to run in parallel over multiple 
-    filterbank channels. 
+    filterbank channels (see runBlocks).  If the channels' 
+    ChannelStats were collected in an earlier pass (stats), this is 
+    a single affine pass over each channel. 
     """
     if (logFile == ""):
         print("Setting zero mean in filterbank data...\n")
@@ -155,6 +374,40 @@ def zeroMean_Parallel(spectraData, inputHeader, numProcessors,
     
     nsamples = []
 
+    try:
+        nsamples = float(inputHeader["nsamples"])
+    except:
+        inputHeader["nsamples"] = np.shape(spectraData)[1]
+        nsamples = float(inputHeader["nsamples"])
+    
+    if (stats == None):
+        return runBlocks(spectraData, zeroMeanBlock, (), numProcessors, 
+                         "Zero Mean", memBudget=memBudget, logFile=logFile)
+    
+    stdData = stats.std(ddof=1)
+    stdData[stdData == 0.0] = 1.0
+    
+    return runBlocks(spectraData, affineBlock, (), numProcessors, "Zero Mean", 
+                     chanArgs=(stats.mean, stdData), memBudget=memBudget, 
+                     logFile=logFile)
+
+
+def detrendNormalize_Parallel(spectraData, inputHeader, timeConstants, 
+                              numProcessors, memBudget=None, logFile=""):
+    """ 
+    Detrend each channel by the moving average for every time 
+    constant in timeConstants (s) in turn, and set it to zero mean 
+    and unit variance, with each channel read and written once 
+    (detrendNormalize).  Runs in parallel over multiple filterbank 
+    channels (see runBlocks). 
+    """
+    if (logFile == ""):
+        print("Detrending + setting zero mean in filterbank data... (timeConstants = %s s)\n" %(\
+              ", ".join([ "%.3f" % tc for tc in timeConstants ])))
+    else:
+        logFile.write("Detrending + setting zero mean in filterbank data... (timeConstants = %s s)\n\n" %(\
+                      ", ".join([ "%.3f" % tc for tc in timeConstants ])))
+    
     try:
         nsamples = float(inputHeader["nsamples"])
     except:
@@ -162,67 +415,331 @@ def zeroMean_Parallel(spectraData, inputHeader, numProcessors,
         nsamples = float(inputHeader["nsamples"])
     
     tsamp = float(inputHeader["tsamp"])
-    nchans = float(inputHeader["nchans"])
     
-    def worker(ichan):
-        chanData = spectraData[ichan]
+    windows = np.array([ windowSize(tc, tsamp) for tc in timeConstants ])
+    scratch = workScratch(numProcessors, 2, np.shape(spectraData)[1])
+    
+    return runBlocks(spectraData, detrendNormalizeBlock, (windows, scratch), 
+                     numProcessors, "Detrend + Zero Mean", 
+                     memBudget=memBudget, logFile=logFile)
+
+
+@jit(nopython=True, nogil=True, cache=True)
+def detrendRing(block, ring, wsum, lastAvg, nseen, window, last, out):
+    """
+    Moving average detrend kernel of StreamingDetrender.  block is 
+    the next time-major (nrows, nchans) input, spectra nseen 
+    onwards; ring holds the last window - 1 input spectra (spectrum 
+    t in row t % (window - 1)) and wsum their sums.  The detrended 
+    spectra that are complete are put in out, rounded to float32, 
+    and their number returned.  Spectrum i needs the input up to 
+    i + h, h = (window - 1) / 2, and the first h have the first full 
+    window's average taken off, as in movingAverage.  With last, 
+    the final h spectra (less the last full window's average) are 
+    put out too.  wsum is summed afresh from ring once per cycle of 
+    the ring, so it cannot drift.
+    """
+    nring = window - 1
+    half = nring // 2
+    nchans = block.shape[1]
+    nout = 0
+    
+    for irow in range(block.shape[0]):
+        tt = nseen + irow
+        slot = tt % nring
+        if (tt < nring):
+            for ic in range(nchans):
+                ring[slot, ic] = block[irow, ic]
+                wsum[ic] += ring[slot, ic]
+            continue
         
-        meanData = np.mean(chanData)
-        stdData = np.std(chanData, ddof=1)
+        # Full window tt - nring ... tt: its average is taken off 
+        # the centre, tt - half (and, the first time, off 0 ... half)
+        for ic in range(nchans):
+            lastAvg[ic] = (wsum[ic] + block[irow, ic]) / window
+        if (tt == nring):
+            for jj in range(half):
+                for ic in range(nchans):
+                    out[nout, ic] = np.float32(ring[jj, ic] - lastAvg[ic])
+                nout += 1
         
-        if (stdData == 0.0):
-            stdData = 1.0
-         
-        chanData = np.subtract(chanData, meanData)
-        chanData = np.divide(chanData, stdData)
+        centre = (tt - half) % nring
+        for ic in range(nchans):
+            out[nout, ic] = np.float32(ring[centre, ic] - lastAvg[ic])
+            wsum[ic] += block[irow, ic] - ring[slot, ic]
+            ring[slot, ic] = block[irow, ic]
+        nout += 1
         
-        spectraData[ichan] = chanData
-    
-    ichan = 0
-    for iBatch in np.arange(0, int(nchans / numProcessors), 1):
-        threads = []
-        for iProcess in np.arange(0, numProcessors, 1):
-            ichan = int(iProcess + (iBatch * numProcessors))
-            
-            t = Thread(target=worker, args=(ichan,))
-            threads.append(t)
-            
-            progress = np.multiply(np.divide(ichan + 1.0, nchans), 100.0)
-            
-            if (logFile == ""):
-                print("Zero Mean: Channel %i [%3.2f%%]" % (nchans - ichan, progress))
-            else:
-                logFile.write("Zero Mean: Channel %i [%3.2f%%]\n" % (nchans - ichan, progress))
+        if (slot == nring - 1):
+            for ic in range(nchans):
+                wsum[ic] = 0.0
+            for jj in range(nring):
+                for ic in range(nchans):
+                    wsum[ic] += ring[jj, ic]
+    
+    if last:
+        ntot = nseen + block.shape[0]
+        for tt in range(ntot - half, ntot):
+            for ic in range(nchans):
+                out[nout, ic] = np.float32(ring[tt % nring, ic] - lastAvg[ic])
+            nout += 1
+    
+    return nout
+
+
+class StreamingDetrender(object):
+    """
+    Moving average detrend (as movingAverage, for an odd window) of 
+    a stream of time-major (nspec, nchans) blocks, holding only the 
+    last window - 1 spectra of input in a ring buffer (detrendRing).
+
+    push(block) returns the detrended spectra (rounded to float32, 
+    as when each detrend is written to the float32 staging data) 
+    that are complete: spectrum i needs the input up to i + h, 
+    h = (window - 1) / 2, so the output lags the input by h 
+    spectra.  With last, the final h spectra are returned too.  As 
+    in movingAverage, the first and last h spectra have the first 
+    and last full window's average taken off.  The result is a view 
+    of an output buffer that is reused by the next push.
+    """
+    def __init__(self, nchans, window):
+        self.window = int(window)
+        if (self.window < 3) or (self.window % 2 == 0):
+            raise ValueError("Need an odd window of at least 3 spectra")
+        self.half = (self.window - 1) // 2
+        self.ring = np.empty((self.window - 1, int(nchans)))
+        self.wsum = np.zeros(int(nchans))
+        self.lastAvg = np.zeros(int(nchans))
+        self.out = np.empty((0, int(nchans)))
+        self.nseen = 0
+    
+    def push(self, block, last=False):
+        if (len(self.out) < len(block) + self.half):
+            self.out = np.empty((len(block) + self.half, self.ring.shape[1]))
+        if last and (self.nseen + len(block) < self.window):
+            raise ValueError("Need at least %d spectra to detrend" % self.window)
         
-        for x in threads:
-            x.start()
+        nout = detrendRing(block, self.ring, self.wsum, self.lastAvg, 
+                           self.nseen, self.window, last, self.out)
+        self.nseen += len(block)
         
-        for x in threads:
-            x.join()
+        return self.out[:nout]
+
+
+def detrendStages(stages, block, last=False):
+    """
+    Pass a time-major block through a chain of StreamingDetrenders.  
+    With last, every stage is flushed too.
+    """
+    for stage in stages:
+        block = stage.push(block, last=last)
+    
+    return block
+
+
+def detrendedSegment(mapFile, windows, lobin, hibin, blocksize):
+    """
+    Yield (ispec, spectra): the spectra lobin:hibin of mapFile, 
+    detrended by the chain of windows (detrendStages, float32 
+    values in float64), a block at a time in time order.  Reading 
+    starts half the windows' total before lobin and stops as far 
+    after hibin, so the result is the same as streaming the whole 
+    file.  The spectra are a view of the last stage's buffer, 
+    reused for the next block.
+    """
+    nspec = mapFile.nspec
+    margin = sum([ (ww - 1) // 2 for ww in windows ])
+    start = max(lobin - margin, 0)
+    stop = min(hibin + margin, nspec)
+    stages = [ StreamingDetrender(mapFile.nchans, ww) for ww in windows ]
+    
+    ispec = start
+    for lo in range(start, stop, blocksize):
+        hi = min(lo + blocksize, stop)
+        block = np.asarray(mapFile.spectra[lo:hi])
+        detrended = detrendStages(stages, block, last=(hi == nspec))
+        
+        lokeep = max(lobin, ispec)
+        hikeep = min(hibin, ispec + len(detrended))
+        if (hikeep > lokeep):
+            yield lokeep, detrended[lokeep - ispec:hikeep - ispec]
+        ispec += len(detrended)
+
+
+def streamPlan(nchans, nspec, windows, numProcessors, memBudget=None):
+    """
+    Segments (threads) and block length (spectra) for 
+    detrendNormalize_Stream.  Each segment holds, per stage, the 
+    ring of window - 1 spectra and an output of up to block + the 
+    windows' total h spectra (float64), and per block spectrum the 
+    normalised float32 copy and ChannelStats' float64 temporaries.  Segments are dropped 
+    until memBudget (default BATCH_BYTES) holds that with blocks 
+    of at least STREAM_MIN_BLOCK spectra; ValueError if even one 
+    segment does not fit.
+    """
+    if memBudget is None:
+        memBudget = BATCH_BYTES
+    
+    # Segments at least a few windows long, so the re-read margins 
+    # stay small
+    nseg = int(max(1, min(max(int(numProcessors), 1), 
+                          nspec // (4 * sum(windows)))))
+    
+    margin = sum([ (ww - 1) // 2 for ww in windows ])
+    histBytes = nchans * (8.0 * sum([ ww - 1 + margin for ww in windows ]) + 
+                          4.0 * margin)
+    specBytes = nchans * (8.0 * len(windows) + 4.0 + 16.0)
+    minBlock = min(STREAM_MIN_BLOCK, nspec)
+    
+    while (nseg > 1) and (memBudget / nseg < histBytes + minBlock * specBytes):
+        nseg -= 1
+    
+    blocksize = int((memBudget / nseg - histBytes) // specBytes)
+    if (blocksize < minBlock):
+        raise ValueError("memBudget of %.3g bytes cannot hold the windows (%.3g bytes) and a block of %d spectra (%.3g bytes)" %(\
+                         memBudget, histBytes, minBlock, minBlock * specBytes))
+    
+    return nseg, int(min(blocksize, nspec))
+
+
+def detrendNormalize_Stream(inputFilename, outputFilename, timeConstants, 
+                            numProcessors=1, memBudget=None, logFile=""):
+    """ 
+    Detrend (for each of timeConstants in turn) and set each channel 
+    to zero mean and unit variance, straight from the input file to 
+    the output, without a staging copy.
+
+    The input is memory mapped and read a block of spectra at a 
+    time through a chain of StreamingDetrenders, so only about 
+    nchans x (window + block) values are held per thread whatever 
+    the length of the observation (sized from memBudget, see 
+    streamPlan).  The time range is split between 
+    numProcessors threads (detrendedSegment).  The first pass 
+    accumulates each segment's channel statistics (ChannelStats), 
+    which are merged; the second detrends again and writes the 
+    normalised spectra with a FilterbankWriter.  The result matches 
+    detrendNormalize_Parallel to within float32 rounding.
+    """
+    mapFile = MappedFilterbank(inputFilename)
+    inputHeader = mapFile.header
+    nchans = mapFile.nchans
+    nspec = mapFile.nspec
+    tsamp = float(inputHeader["tsamp"])
     
-    if (nchans % numProcessors):
-        threads = []
-        for ichan2 in np.arange(ichan + 1, int(nchans), 1):
-            
-            t = Thread(target=worker, args=(ichan2,))
-            threads.append(t)
-            
-            progress = np.multiply(np.divide(ichan2 + 1.0, nchans), 100.0)
+    windows = [ windowSize(tc, tsamp) for tc in timeConstants ]
+    if (max(windows) > nspec):
+        raise ValueError("Window of %d spectra is longer than the data" % max(windows))
+    
+    nseg, blocksize = streamPlan(nchans, nspec, windows, numProcessors, 
+                                 memBudget=memBudget)
+    bounds = np.linspace(0, nspec, nseg + 1).astype(int)
+    
+    msg = "Stream plan: %d segments, blocks of %d spectra, windows of %s spectra" %(\
+          nseg, blocksize, ", ".join([ "%d" % ww for ww in windows ]))
+    if (logFile == ""):
+        print("Detrending + setting zero mean in filterbank data... (timeConstants = %s s)\n" %(\
+              ", ".join([ "%.3f" % tc for tc in timeConstants ])))
+        print(msg + "\n")
+    else:
+        logFile.write("Detrending + setting zero mean in filterbank data... (timeConstants = %s s)\n\n" %(\
+                      ", ".join([ "%.3f" % tc for tc in timeConstants ])))
+        logFile.write(msg + "\n\n")
+    
+    lock = Lock()
+    done = [ 0 ]
+    
+    def report(label, nn):
+        with lock:
+            done[0] += nn
+            progress = 100.0 * done[0] / float(nspec)
             if (logFile == ""):
-                print("Zero Mean: Channel %i [%3.2f%%]" % (nchans - ichan2, progress))
+                sys.stdout.write("%s [stream]... [%3.2f%%]\r" % (label, progress))
+                sys.stdout.flush()
             else:
-                logFile.write("Zero Mean: Channel %i [%3.2f%%]\n" % (nchans - ichan2, progress))
-        
+                logFile.write("%s [stream]... [%3.2f%%]\n" % (label, progress))
+    
+    def runSegments(worker):
+        done[0] = 0
+        threads = [ Thread(target=worker, args=(iseg,)) for iseg in range(nseg) ]
         for x in threads:
             x.start()
-        
         for x in threads:
             x.join()
+        
+        if (logFile == ""):
+            print("\n")
+        else:
+            logFile.write("\n")
+    
+    segStats = [ ChannelStats(nchans) for iseg in range(nseg) ]
+    
+    def statsWorker(iseg):
+        for ispec, detrended in detrendedSegment(mapFile, windows, bounds[iseg], 
+                                                 bounds[iseg + 1], blocksize):
+            segStats[iseg].addSpectra(detrended)
+            report("Statistics", len(detrended))
+    
+    runSegments(statsWorker)
+    
+    stats = segStats[0]
+    for other in segStats[1:]:
+        stats.merge(other)
+    meanData = stats.mean
+    stdData = stats.std(ddof=1)
+    stdData[stdData == 0.0] = 1.0
+    
+    outfil = FilterbankWriter(outputFilename, inputHeader, mapFile.nbits, nspec)
+    margin = sum([ (ww - 1) // 2 for ww in windows ])
+    normBufs = [ np.empty((blocksize + margin, nchans), dtype=np.float32) 
+                 for iseg in range(nseg) ]
+    
+    def writeWorker(iseg):
+        for ispec, detrended in detrendedSegment(mapFile, windows, bounds[iseg], 
+                                                 bounds[iseg + 1], blocksize):
+            np.subtract(detrended, meanData, out=detrended)
+            np.divide(detrended, stdData, out=detrended)
+            normalized = normBufs[iseg][:len(detrended)]
+            np.copyto(normalized, detrended, casting="unsafe")
+            outfil.writeSpectra(normalized, ispec)
+            report("Detrend + Zero Mean", len(detrended))
+    
+    runSegments(writeWorker)
+    
+    outfil.close()
+    mapFile.close()
+    
+    return
+
+
+def normalizeAll(spectraData, inputHeader, timeConstLong, timeConstShort, 
+                 numProcessors, perStage=False, memBudget=None, logFile=""):
+    """
+    Detrend by timeConstLong (and then timeConstShort, if given) and 
+    set every channel to zero mean, unit variance.  Done in one pass 
+    over the data (detrendNormalize_Parallel), or with perStage as 
+    a separate pass for each detrend and the zero mean, as before.  
+    Blocks of channels are sized from memBudget (see blockChannels).
+    """
+    timeConstants = [ timeConstLong ]
+    if (timeConstShort != None):
+        timeConstants.append(timeConstShort)
     
-    if (logFile == ""):
-        print("\n")
-    else:
-        logFile.write("\n")
+    if not perStage:
+        return detrendNormalize_Parallel(spectraData, inputHeader, 
+                                         timeConstants, numProcessors, 
+                                         memBudget=memBudget, logFile=logFile)
+    
+    # The last detrend collects the statistics for the zero mean
+    for timeConstant in timeConstants:
+        stats = ChannelStats(np.shape(spectraData)[0])
+        spectraData = movingAvgData_Parallel(spectraData, inputHeader, 
+                                             timeConstant, numProcessors, 
+                                             memBudget=memBudget, 
+                                             stats=stats, logFile=logFile)
+    
+    spectraData = zeroMean_Parallel(spectraData, inputHeader, numProcessors, 
+                                    memBudget=memBudget, stats=stats, 
+                                    logFile=logFile)
     
     return spectraData;
 
@@ -255,6 +772,29 @@ def usage():
                                           analysis will be stored
         [--logFile]                     : Name of the log file to store the data reduction
                                           output
+        [--memBudget]                   : Memory (bytes) to use for the blocks read from /
+                                          written to the filterbank files. Default is
+                                          BLOCKSIZE spectra.
+        [--prefetch]                    : Number of blocks to read ahead / write behind in
+                                          a background thread. Default is 0 (no overlap).
+        [--scratchDirs]                 : Comma separated list of fast scratch directories
+                                          to try (in order) for the .hdf5 staging file
+                                          before the input file's directory.
+        [--compression]                 : Compress the .hdf5 staging copy: none (default),
+                                          lzf, or gzip (deflate + shuffle, decompressed in
+                                          parallel by the channel workers).
+        [--stagingBackend]              : Staging store: hdf5 (default) or sharded (a
+                                          directory of channel-group files, filled by
+                                          numProcessors processes in parallel and safe for
+                                          several processes to modify at once).
+        [--perStage]                    : Run each detrend and the zero mean as a separate
+                                          pass over the data (the old behaviour) instead of
+                                          one pass doing all of them.
+        [--stream]                      : Detrend and normalise straight from the input file
+                                          to the output a block at a time (no staging copy,
+                                          memory of about nchans x (window + block) per
+                                          thread), reading the input twice, with the time
+                                          range split between numProcessors threads.
         [--clean]                       : Flag to clean up intermediate reduction products.
                                           Default is FALSE
         
@@ -271,11 +811,13 @@ def usage():
 def main():
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                   "inputFilename:outputFilename:timeConstLong:timeConstShort:numProcessors:outputDir:logFile:clean:",
+                                   "inputFilename:outputFilename:timeConstLong:timeConstShort:numProcessors:outputDir:logFile:memBudget:prefetch:scratchDirs:compression:stagingBackend:perStage:stream:clean:",
                                    ["help", "inputFilename=", "outputFilename=",
                                     "timeConstLong=", "timeConstShort=",
                                     "numProcessors=", "outputDir=",
-                                    "logFile=", "clean"])
+                                    "logFile=", "memBudget=", "prefetch=",
+                                    "scratchDirs=", "compression=", "stagingBackend=",
+                                    "perStage", "stream", "clean"])
     
     except getopt.GetoptError:
         # Print help information and exit.
@@ -293,6 +835,13 @@ def main():
     numProcessors=None
     outputDir=None
     logFile=None
+    memBudget=None
+    prefetch=0
+    scratchDirs=None
+    compression=None
+    staging="hdf5"
+    perStage=None
+    stream=None
     clean=None
     
     for o, a in opts:
@@ -314,6 +863,20 @@ def main():
             outputDir = a
         if o in ("--logFile"):
             logFile = a
+        if o in ("--memBudget"):
+            memBudget = float(a)
+        if o in ("--prefetch"):
+            prefetch = int(a)
+        if o in ("--scratchDirs"):
+            scratchDirs = a.split(',')
+        if o in ("--compression"):
+            compression = a
+        if o in ("--stagingBackend"):
+            staging = a
+        if o in ("--perStage"):
+            perStage = True
+        if o in ("--stream"):
+            stream = True
         if o in ("--clean"):
             clean = True
     
@@ -330,59 +893,74 @@ def main():
     
     if (numProcessors != None):
         numProcessors = float(numProcessors)
+        fillProcs = int(numProcessors)
+    else:
+        fillProcs = 1
+    
+    if stream:
+        timeConstants = [ timeConstLong ]
+        if (timeConstShort != None):
+            timeConstants.append(timeConstShort)
+        
+        writeFile = ""
+        if ((outputDir != None) & (logFile != None)):
+            writeFile = open("%s/%s" % (outputDir, logFile), "w")
+        
+        detrendNormalize_Stream(inputFilename, outputFilename, timeConstants,
+                                numProcessors=fillProcs, memBudget=memBudget,
+                                logFile=writeFile)
+        
+        if (writeFile != ""):
+            writeFile.close()
+        return
     
     if ((outputDir != None) & (logFile != None)):
         
         writeFile = open("%s/%s" % (outputDir, logFile), "w")
         
-        spectraData, inputHeader, inputNbits, h5pyFile = readFilterbank(inputFilename, logFile=writeFile, BLOCKSIZE=BLOCKSIZE)
+        spectraData, inputHeader, inputNbits, h5pyFile = readFilterbank(inputFilename, logFile=writeFile, BLOCKSIZE=BLOCKSIZE,
+                                                                        memBudget=memBudget,
+                                                                        prefetch=prefetch,
+                                                                        scratchDirs=scratchDirs,
+                                                                        compression=compression,
+                                                                        staging=staging,
+                                                                        nproc=fillProcs)
         
         if (numProcessors == None):
             numProcessors = 1
         
-        spectraData = movingAvgData_Parallel(spectraData, inputHeader, timeConstLong,
-                                             numProcessors, logFile=writeFile)
-        
-        if (timeConstShort != None):
-            spectraData = movingAvgData_Parallel(spectraData, inputHeader, timeConstShort,
-                                                 numProcessors, logFile=writeFile)
-        
-        spectraData = zeroMean_Parallel(spectraData, inputHeader, numProcessors,
-                                        logFile=writeFile)
+        spectraData = normalizeAll(spectraData, inputHeader, timeConstLong, timeConstShort,
+                                   numProcessors, perStage=(perStage == True),
+                                   memBudget=memBudget, logFile=writeFile)
         
         writeFilterbank(outputFilename, spectraData, inputHeader, inputNbits,
-                        logFile=writeFile, BLOCKSIZE=BLOCKSIZE)
+                        logFile=writeFile, BLOCKSIZE=BLOCKSIZE, memBudget=memBudget,
+                        prefetch=prefetch)
         
         writeFile.close()
     
     else:
         
-        spectraData, inputHeader, inputNbits, h5pyFile = readFilterbank(inputFilename, BLOCKSIZE=BLOCKSIZE)
+        spectraData, inputHeader, inputNbits, h5pyFile = readFilterbank(inputFilename, BLOCKSIZE=BLOCKSIZE,
+                                                                        memBudget=memBudget,
+                                                                        prefetch=prefetch,
+                                                                        scratchDirs=scratchDirs,
+                                                                        compression=compression,
+                                                                        staging=staging,
+                                                                        nproc=fillProcs)
         
         if (numProcessors == None):
             numProcessors = 1
         
-        spectraData = movingAvgData_Parallel(spectraData, inputHeader, timeConstLong,
-                                             numProcessors)
-        
-        if (timeConstShort != None):
-            spectraData = movingAvgData_Parallel(spectraData, inputHeader, timeConstShort,
-                                                 numProcessors)
+        spectraData = normalizeAll(spectraData, inputHeader, timeConstLong, timeConstShort,
+                                   numProcessors, perStage=(perStage == True),
+                                   memBudget=memBudget)
         
-        spectraData = zeroMean_Parallel(spectraData, inputHeader, numProcessors)
-        
-        writeFilterbank(outputFilename, spectraData, inputHeader, inputNbits, BLOCKSIZE=BLOCKSIZE)
-    
+        writeFilterbank(outputFilename, spectraData, inputHeader, inputNbits, BLOCKSIZE=BLOCKSIZE,
+                        memBudget=memBudget, prefetch=prefetch)
     
-    h5pyFile.close()
     
-    if (clean == True):
-        h5_path = "%s.hdf5" %(inputFilename)
-        if os.path.exists(h5_path):
-            print("Removing %s" %h5_path)
-            os.remove(h5_path)
-        else: pass
-    else: pass
+    releaseStaging(h5pyFile, clean=(clean == True))
 
     
 if __name__ == "__main__":
@@ -33,11 +33,33 @@ import h5py
 import filterbank
 
 from scipy import signal
+from scipy import fft as sp_fft
+from numba import jit
 from threading import Thread
-from fb_utils import readFilterbank, writeFilterbank
+from fb_utils import readFilterbank, writeFilterbank, releaseStaging, castToDtype
+from fb_utils import readChannel, writeChannel
+from fb_utils import SharedChannelPool, sharedBatchSize
+from fb_utils import MappedFilterbank, FilterbankWriter, transposeBlock
+from fb_linefind import welch_dof, band_dof, line_threshold, median_ratio
+from fb_linefind import median_dof
 
 BLOCKSIZE = 1e6
 
+# Working memory (bytes) for a batch of channels when no 
+# memBudget is given
+BATCH_BYTES = 2**30
+
+# Number of stretches of each channel read to measure the line 
+# power in each notch band, and the fewest bins either side of a 
+# band its continuum is taken from (see chan_line_power)
+LINE_NSEG = 16
+LINE_SIDE_BINS = 32
+
+# Values taken by --engine, --backend and --precision
+ENGINES = ["sos", "fft", "subtract"]
+BACKENDS = ["batch", "thread", "process"]
+PRECISIONS = ["float64", "float32"]
+
 def butter_bandstop(nyq, cutoff_freq_start, cutoff_freq_stop, order=3):
     """ 
     Create a butterworth bandstop filter 
@@ -81,8 +103,488 @@ def get_freqs(f0, nharms, fnyq):
     return freqs
 
 
+def notch_bands(f0, nharms, width, nyq):
+    """
+    Get the (start, stop) edges in Hz of every notch requested 
+    by the f0 / nharms / width lists.  Bands that would reach 
+    Nyquist cannot be designed and are dropped with a warning.
+    """
+    starts = []
+    stops = []
+    for ii in range(len(f0)):
+        freq_centers = get_freqs(f0[ii], nharms[ii], nyq)
+        for fc in freq_centers:
+            if (fc - width[ii] <= 0) or (fc + width[ii] >= nyq):
+                print("Skipping %.3f Hz: band reaches 0 or Nyquist" %(fc))
+                continue
+            starts.append(fc - width[ii])
+            stops.append(fc + width[ii])
+    
+    return np.array(starts), np.array(stops)
+
+
+def fused_sos(nyq, freq_starts, freq_stops, order=3):
+    """
+    Stack the bandstop for each notch into one SOS cascade, so 
+    all of them are applied in a single sosfiltfilt.
+    """
+    sos_list = [ butter_bandstop(nyq, f_start, f_stop, order=order) 
+                 for f_start, f_stop in zip(freq_starts, freq_stops) ]
+    
+    return np.vstack(sos_list)
+
+
+def notch_attenuation(sos, fs, freq_starts, freq_stops, logFile=""):
+    """
+    Report the zero-phase (forward + backward, so twice the dB 
+    of one pass) attenuation of the cascade at the centre and 
+    edges of each notch.  Returns the centre attenuations in dB.
+    """
+    freq_centers = 0.5 * (freq_starts + freq_stops)
+    freq_eval = np.concatenate((freq_starts, freq_centers, freq_stops))
+    w, h = signal.sosfreqz(sos, worN=freq_eval, fs=fs)
+    att_db = -40.0 * np.log10(np.maximum(np.abs(h), 1e-300))
+    att_db = np.minimum(att_db, 300.0)
+    nn = len(freq_centers)
+    
+    lines = ["Notch attenuation (dB, zero-phase):", 
+             "  %10s  %10s  %10s  %10s" %("center Hz", "low edge", 
+                                           "center", "high edge")]
+    for ii in range(nn):
+        lines.append("  %10.3f  %10.1f  %10.1f  %10.1f" %(\
+                     freq_centers[ii], att_db[ii], att_db[nn+ii], 
+                     att_db[2*nn+ii]))
+    
+    if (logFile == ""):
+        print("\n".join(lines) + "\n")
+    else:
+        logFile.write("\n".join(lines) + "\n\n")
+    
+    return att_db[nn:2*nn]
+
+
+def run_channels(worker, nchans, numProcessors, label, chans=None, 
+                 logFile=""):
+    """
+    Run worker(ichan) over every channel (or over the channels 
+    in chans), numProcessors threads at a time.
+    """
+    nchans = int(nchans)
+    nthreads = max(int(numProcessors), 1)
+    if chans is None:
+        chans = np.arange(nchans)
+    
+    for lo in range(0, len(chans), nthreads):
+        threads = []
+        for ii in range(lo, min(lo + nthreads, len(chans))):
+            ichan = int(chans[ii])
+            t = Thread(target=worker, args=(ichan,))
+            threads.append(t)
+            
+            progress = 100.0 * ((ii + 1.0) / len(chans)) 
+            
+            if (logFile == ""):
+                print("Filtering [%s]: Channel %i [%3.2f%%]" %(\
+                      label, nchans - ichan, progress))
+            else:
+                logFile.write("Filtering [%s]: Channel %i [%3.2f%%]\n" %(\
+                      label, nchans - ichan, progress))
+        
+        for x in threads:
+            x.start()
+        
+        for x in threads:
+            x.join()
+    
+    if (logFile == ""):
+        print("\n")
+    else:
+        logFile.write("\n")
+    
+    return
+
+
+def sos_filtfilt_row(chanData, sos):
+    """
+    Zero-phase filter one channel (or a 2D block of channels, 
+    along the last axis) with an SOS filter.
+    """
+    return signal.sosfiltfilt(sos, chanData)
+
+
+@jit(nopython=True, nogil=True)
+def sosfilt_f32(sos, x, zi, backward):
+    """
+    Run the SOS cascade over each row of the float32 array x in 
+    place (direct form II transposed), from the last sample to the 
+    first if backward.  The data stay float32, but the coefficients 
+    (sos) and states (zi, (nrows, nsections, 2), left holding the 
+    final states) are float64 and the sums are done in float64 
+    registers: with float32 states the narrow notches' poles near 
+    z = 1 amplify the rounding to ~1% of the rms.  Each sample goes 
+    through all of the sections in turn, which keeps the states in 
+    registers.  Assumes a0 = 1, as from signal.butter.
+    """
+    nrows, n = x.shape
+    nsec = sos.shape[0]
+    z = np.empty((nsec, 2))
+    for irow in range(nrows):
+        for isec in range(nsec):
+            z[isec, 0] = zi[irow, isec, 0]
+            z[isec, 1] = zi[irow, isec, 1]
+        for ii in range(n):
+            if backward:
+                ii = n - 1 - ii
+            yi = np.float64(x[irow, ii])
+            for isec in range(nsec):
+                xi = yi
+                yi = sos[isec, 0] * xi + z[isec, 0]
+                z[isec, 0] = sos[isec, 1] * xi - sos[isec, 4] * yi + z[isec, 1]
+                z[isec, 1] = sos[isec, 2] * xi - sos[isec, 5] * yi
+            x[irow, ii] = yi
+        for isec in range(nsec):
+            zi[irow, isec, 0] = z[isec, 0]
+            zi[irow, isec, 1] = z[isec, 1]
+
+
+def sos_filtfilt_f32(chanData, sos64, zi64, padlen):
+    """
+    Float32 version of sos_filtfilt_row: the same odd padding and 
+    initial conditions as sosfiltfilt, but the padded channel is a 
+    float32 array filtered forward and then backward in place by 
+    sosfilt_f32, rather than float64 copies, halving the memory 
+    traffic and temporaries.  sos64 / zi64 are the sos and 
+    sosfilt_zi(sos), padlen sosfiltfilt's default padlen (see 
+    float32_sos_args).
+    """
+    shape = np.shape(chanData)
+    x = np.asarray(chanData, dtype=np.float32).reshape(-1, shape[-1])
+    nspec = x.shape[1]
+    
+    ext = np.empty((x.shape[0], nspec + 2 * padlen), dtype=np.float32)
+    ext[:, padlen:padlen+nspec] = x
+    ext[:, :padlen] = 2 * x[:, 0:1] - x[:, padlen:0:-1]
+    ext[:, padlen+nspec:] = 2 * x[:, -1:] - x[:, -2:-padlen-2:-1]
+    
+    zi = zi64[np.newaxis, :, :] * ext[:, 0, np.newaxis, np.newaxis]
+    sosfilt_f32(sos64, ext, zi, False)
+    
+    zi = zi64[np.newaxis, :, :] * ext[:, -1, np.newaxis, np.newaxis]
+    sosfilt_f32(sos64, ext, zi, True)
+    
+    return ext[:, padlen:padlen+nspec].reshape(shape)
+
+
+def float32_sos_args(sos):
+    """
+    rowArgs for sos_filtfilt_f32 from a float64 sos.
+    """
+    nzeros = min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+    padlen = int(3 * (2 * len(sos) + 1 - nzeros))
+    sos64 = np.ascontiguousarray(sos, dtype=np.float64)
+    zi64 = np.ascontiguousarray(signal.sosfilt_zi(sos), dtype=np.float64)
+    
+    return (sos64, zi64, padlen)
+
+
+def float32_ok(fb_data, sos, tol=1e-3, nsample=4, logFile=""):
+    """
+    Accuracy guard for the float32 filter: filter nsample channels 
+    spread across the band with both sos_filtfilt_f32 and the 
+    float64 sosfiltfilt, and return True if the largest difference 
+    is within tol of the rms of the float64 result.
+    """
+    nchans, nspec = np.shape(fb_data)
+    args32 = float32_sos_args(sos)
+    maxerr = 0.0
+    
+    for ichan in np.unique(np.linspace(0, nchans - 1, nsample).astype(int)):
+        chanData = np.asarray(readChannel(fb_data, ichan), dtype=np.float64)
+        ref = signal.sosfiltfilt(sos, chanData)
+        out = sos_filtfilt_f32(chanData, *args32)
+        rms = max(np.std(ref), 1e-30)
+        maxerr = max(maxerr, np.max(np.abs(out - ref)) / rms)
+    
+    ok = (maxerr <= tol)
+    msg = "float32 check: max error %.2e of rms (tol %.1e), %s" %(\
+          maxerr, tol, "using float32" if ok else "falling back to float64")
+    if (logFile == ""):
+        print(msg + "\n")
+    else:
+        logFile.write(msg + "\n\n")
+    
+    return ok
+
+
+def report_batch(label, nchans, lochan, hichan, logFile=""):
+    """
+    Progress message for a batch of channels.
+    """
+    progress = 100.0 * (hichan / float(nchans))
+    if (logFile == ""):
+        print("Filtering [%s]: Channels %i-%i [%3.2f%%]" %(\
+              label, nchans - lochan, nchans - hichan + 1, progress))
+    else:
+        logFile.write("Filtering [%s]: Channels %i-%i [%3.2f%%]\n" %(\
+              label, nchans - lochan, nchans - hichan + 1, progress))
+
+
+def batch_size(nchans, nspec, itemsize, memBudget=None):
+    """
+    Channels per batch for the batch backend: the block itself 
+    (itemsize bytes per sample) plus about five float64 copies 
+    made by sosfiltfilt (padded input, forward and backward 
+    passes) must fit in memBudget (default BATCH_BYTES).
+    """
+    if memBudget is None:
+        memBudget = BATCH_BYTES
+    chanBytes = float(nspec) * (itemsize + 5 * 8)
+    
+    return int(max(1, min(nchans, memBudget // chanBytes)))
+
+
+def chan_batches(chans, nbatch):
+    """
+    Split the sorted channel numbers chans into runs of 
+    consecutive channels, at most nbatch long.  Yields the 
+    (lochan, hichan) range of each.
+    """
+    chans = np.asarray(chans)
+    breaks = np.where(np.diff(chans) != 1)[0] + 1
+    for run in np.split(chans, breaks):
+        for lo in range(0, len(run), nbatch):
+            hi = min(lo + nbatch, len(run))
+            yield int(run[lo]), int(run[hi - 1]) + 1
+
+
+def apply_channels(rowFunc, rowArgs, fb_data, numProcessors, label, 
+                   backend="batch", memBudget=None, chans=None, 
+                   logFile=""):
+    """
+    Replace every channel of fb_data (or just the channels in the 
+    sorted array chans) with rowFunc(channel, *rowArgs), cast back 
+    to fb_data's dtype.
+
+    backend = "batch"   : batches of channels (sized from memBudget, 
+                          see batch_size) are read as one 2D slab, 
+                          filtered along axis 1 by numProcessors 
+                          threads each taking a share of the rows, 
+                          and written back as one slab.  rowFunc 
+                          must then work along the last axis of a 
+                          2D block.  If memBudget holds fewer 
+                          channels than numProcessors, the thread 
+                          backend is used instead (which can go 
+                          over memBudget, as it always has).
+              "thread"  : numProcessors threads at a time, each 
+                          reading and writing its own channel 
+                          (see run_channels)
+              "process" : batches of channels are copied into 
+                          shared memory and filtered by a pool of 
+                          numProcessors processes (see 
+                          SharedChannelPool), so the filtering is 
+                          not serialised by the GIL or h5py.  
+                          rowFunc must then be a module level 
+                          function.
+    """
+    nchans, nspec = np.shape(fb_data)
+    if chans is None:
+        chans = np.arange(nchans)
+    
+    # Filter float staging data as is; integer (native) staging is 
+    # converted to float64 first, as the filters' odd extensions 
+    # of the channel ends would overflow in an integer dtype
+    if np.issubdtype(fb_data.dtype, np.floating):
+        workDtype = fb_data.dtype
+    else:
+        workDtype = np.dtype(np.float64)
+    
+    if (backend == "batch"):
+        nbatch = batch_size(nchans, nspec, workDtype.itemsize, 
+                            memBudget=memBudget)
+        nthreads = max(int(numProcessors), 1)
+        
+        # A batch smaller than the thread count (long channels) 
+        # would leave threads idle, so filter one channel per 
+        # thread instead, as the thread backend does
+        nrun = min(nthreads, len(chans))
+        if (nbatch < nrun):
+            msg = "Batches of %d channels for %d threads: using the " %(\
+                  nbatch, nthreads) +\
+                  "thread backend, %d channels (%.2f GB) at a time" %(\
+                  nrun, nrun * nspec * (workDtype.itemsize + 5 * 8) / 1e9)
+            if (logFile == ""):
+                print(msg + "\n")
+            else:
+                logFile.write(msg + "\n\n")
+            backend = "thread"
+    
+    if (backend == "batch"):
+        def worker(block, lorow, hirow):
+            block[lorow:hirow] = rowFunc(block[lorow:hirow], *rowArgs)
+        
+        for lochan, hichan in chan_batches(chans, nbatch):
+            block = np.asarray(fb_data[lochan:hichan], dtype=workDtype)
+            
+            # scipy's filter loops release the GIL, so the threads 
+            # filter their rows of the block in parallel
+            bounds = np.linspace(0, hichan - lochan, 
+                                 min(nthreads, hichan - lochan) + 1).astype(int)
+            threads = [ Thread(target=worker, args=(block, lorow, hirow)) 
+                        for lorow, hirow in zip(bounds[:-1], bounds[1:]) ]
+            for x in threads:
+                x.start()
+            for x in threads:
+                x.join()
+            
+            fb_data[lochan:hichan] = castToDtype(block, fb_data.dtype)
+            report_batch(label, nchans, lochan, hichan, logFile=logFile)
+        
+        if (logFile == ""):
+            print("\n")
+        else:
+            logFile.write("\n")
+        
+        return
+    
+    if (backend == "thread"):
+        def worker(ichan):
+            chanData = readChannel(fb_data, ichan).astype(workDtype, copy=False)
+            chanData = rowFunc(chanData, *rowArgs)
+            writeChannel(fb_data, ichan, castToDtype(chanData, fb_data.dtype))
+        
+        run_channels(worker, nchans, numProcessors, label, chans=chans, 
+                     logFile=logFile)
+        return
+    
+    nbatch = sharedBatchSize(nchans, nspec, numProcessors, memBudget=memBudget)
+    pool = SharedChannelPool(nbatch, nspec, numProcessors, rowFunc, rowArgs, 
+                             dtype=workDtype)
+    try:
+        for lo in range(0, len(chans), nbatch):
+            batch = chans[lo:lo + nbatch]
+            for irow, ichan in enumerate(batch):
+                pool.rows[irow] = readChannel(fb_data, ichan)
+            
+            pool.run(len(batch))
+            
+            for irow, ichan in enumerate(batch):
+                writeChannel(fb_data, ichan, 
+                             castToDtype(pool.rows[irow], fb_data.dtype))
+            
+            report_batch(label, nchans, batch[0], batch[-1] + 1, 
+                         logFile=logFile)
+    finally:
+        pool.close()
+    
+    if (logFile == ""):
+        print("\n")
+    else:
+        logFile.write("\n")
+    
+    return
+
+
+def chan_line_power(fb_data, fs, freq_starts, freq_stops, nseg=LINE_NSEG, 
+                    memBudget=None):
+    """
+    Cheap per-channel measure of the power in each notch band.
+
+    nseg stretches of every channel, spread evenly over the 
+    observation, are read (fb_data[:, lo:hi], a small part of a 
+    long scan), Hann windowed and Fourier transformed, with the 
+    stretch long enough for bins of half the narrowest notch's 
+    half-width.  For each channel and notch the mean power in the 
+    band is divided by the continuum, the median power within four 
+    half-widths (and at least LINE_SIDE_BINS bins) either side of 
+    it, scaled as in fb_linefind's find_lines.
+
+    Returns the (nchans, nnotch) power ratios and, for each notch, 
+    the degrees of freedom of the band mean (welch_dof of the 
+    stretches, band_dof of the band's bins) and of the continuum 
+    (median_dof), so that without a line a ratio is F distributed, 
+    the statistic line_threshold tests.
+    """
+    nchans, nspec = np.shape(fb_data)
+    half = 0.5 * (freq_stops - freq_starts)
+    nfft = int(2**np.ceil(np.log2(2.0 * fs / np.min(half))))
+    nfft = min(nfft, int(nspec))
+    nseg = int(max(1, min(nseg, nspec // nfft)))
+    
+    freqs = np.fft.rfftfreq(nfft, d=1.0 / fs)
+    window = np.hanning(nfft)
+    psd = np.zeros((nchans, len(freqs)))
+    nbatch = batch_size(nchans, nfft, 8, memBudget=memBudget)
+    
+    segStarts = np.linspace(0, nspec - nfft, nseg).astype(int)
+    for lobin in segStarts:
+        for lochan in range(0, nchans, nbatch):
+            hichan = min(lochan + nbatch, nchans)
+            seg = np.asarray(fb_data[lochan:hichan, lobin:lobin+nfft], 
+                             dtype=np.float64)
+            seg -= np.mean(seg, axis=1, keepdims=True)
+            seg *= window
+            psd[lochan:hichan] += np.abs(np.fft.rfft(seg, axis=1))**2
+    
+    # The stretches overlap only if the channel is short
+    binDof = welch_dof(window, nseg, np.min(np.diff(segStarts), initial=nfft))
+    
+    ratio = np.zeros((nchans, len(freq_starts)))
+    dof = np.zeros(len(freq_starts))
+    baseDof = np.zeros(len(freq_starts))
+    for ii in range(len(freq_starts)):
+        f_start = freq_starts[ii]
+        f_stop = freq_stops[ii]
+        reach = max(4 * half[ii], LINE_SIDE_BINS * freqs[1])
+        band = (freqs >= f_start) & (freqs <= f_stop)
+        side = ((freqs >= f_start - reach) & (freqs < f_start)) |\
+               ((freqs > f_stop) & (freqs <= f_stop + reach))
+        base = np.median(psd[:, side], axis=1) / median_ratio(binDof)
+        ratio[:, ii] = np.mean(psd[:, band], axis=1) / np.maximum(base, 1e-300)
+        dof[ii] = band_dof(window, binDof, np.sum(band))
+        baseDof[ii] = median_dof(band_dof(window, binDof, np.sum(side)))
+    
+    return ratio, dof, baseDof
+
+
+def select_channels(fb_data, fs, freq_starts, freq_stops, lineSnr, 
+                    memBudget=None, logFile=""):
+    """
+    Decide which channels each notch is run on: those whose power 
+    in the notch band is a line at lineSnr sigma above the 
+    surrounding continuum (chan_line_power), by the same chi2 test 
+    as fb_linefind (line_threshold, one trial per channel and 
+    notch, since a false alarm only costs a notch).  Reports how many 
+    channels each notch is applied to, and how much of the notch 
+    filtering that skips.
+
+    Returns a boolean (nchans, nnotch) mask.
+    """
+    ratio, dof, baseDof = chan_line_power(fb_data, fs, freq_starts, 
+                                          freq_stops, memBudget=memBudget)
+    mask = (ratio > line_threshold(lineSnr, dof, base_dof=baseDof))
+    nchans, nnotch = mask.shape
+    
+    lines = []
+    for ii in range(nnotch):
+        fc = 0.5 * (freq_starts[ii] + freq_stops[ii])
+        lines.append("  %.2f Hz: %d of %d channels" %(fc, np.sum(mask[:, ii]), 
+                                                    nchans))
+    lines.append("Line selection (%.1f sigma): skipping %.1f%% of the " %(\
+                 lineSnr, 100.0 * (1.0 - np.mean(mask))) +\
+                 "channel notches, %d of %d channels untouched" %(\
+                 np.sum(~np.any(mask, axis=1)), nchans))
+    msg = "\n".join(lines)
+    if (logFile == ""):
+        print(msg + "\n")
+    else:
+        logFile.write(msg + "\n\n")
+    
+    return mask
+
+
 def fb_filter_harms(fb_data, fb_header, f0, nharms, width, 
-                    numProcessors, logFile=""):
+                    numProcessors, backend="batch", memBudget=None, 
+                    lineSnr=None, logFile=""):
     """ 
     Filter out freq f0 and nharms harmonics.
     from the fb file.
@@ -93,6 +595,15 @@ def fb_filter_harms(fb_data, fb_header, f0, nharms, width,
     
     Typical attenuation is ~120-150 dB around the filtered 
     frequencies. 
+
+    Each harmonic is a separate pass over the data; see 
+    fb_filter_fused for applying them all at once.
+
+    If lineSnr is given, each harmonic is only applied to the 
+    channels where it is detected (see select_channels).
+
+    fb_data may be staged in an integer dtype, in which case each 
+    channel is filtered in floating point and rounded back.
     """
     timeRes = float(fb_header["tsamp"])
     nsamples = np.shape(fb_data)[1]
@@ -112,13 +623,19 @@ def fb_filter_harms(fb_data, fb_header, f0, nharms, width,
     freq_starts = freq_centers - freq_width
     freq_stops = freq_centers + freq_width
     
-    # Apply filter to one channel of the filterbank file.
-    def worker(ichan):
-        #fb_data[ichan] = signal.filtfilt(b, a, fb_data[ichan])
-        fb_data[ichan] = signal.sosfiltfilt(sos, fb_data[ichan])
-   
+    if lineSnr is not None:
+        mask = select_channels(fb_data, fs, freq_starts, freq_stops, lineSnr, 
+                               memBudget=memBudget, logFile=logFile)
+    else:
+        mask = np.ones((int(nchans), len(freq_centers)), dtype=bool)
+    
     # Apply to all 
     for iFilter in np.arange(0, len(freq_centers), 1):
+        chans = np.where(mask[:, iFilter])[0]
+        if (len(chans) == 0):
+            print("Skipping frequency: %.1f Hz (no channels)" %(\
+                  freq_centers[iFilter]))
+            continue
         print("Filtering frequency: %.1f Hz" %(freq_centers[iFilter]))
         f_start = freq_starts[iFilter]
         f_stop  = freq_stops[iFilter] 
@@ -127,57 +644,982 @@ def fb_filter_harms(fb_data, fb_header, f0, nharms, width,
         sos = butter_bandstop(nyq, f_start, f_stop, order=3)
         
         # Need to parallelize filtering channel by channel.
-        ichan = 0
-        for iBatch in np.arange(0, int(nchans / numProcessors), 1):
-            threads = []
-            for iProcess in np.arange(0, numProcessors, 1):
-                ichan = int(iProcess + (iBatch * numProcessors))
-                
-                t = Thread(target=worker, args=(ichan,))
-                threads.append(t)
-                
-                progress = 100.0 * ((ichan + 1.0) / nchans) 
-                
-                if (logFile == ""):
-                    print("Filtering [%.1f Hz]: Channel %i [%3.2f%%]" %(\
-                          freq_centers[iFilter], nchans - ichan, progress))
+        #fb_data[ichan] = signal.filtfilt(b, a, fb_data[ichan])
+        apply_channels(sos_filtfilt_row, (sos,), fb_data, numProcessors, 
+                       "%.1f Hz" %(freq_centers[iFilter]), backend=backend, 
+                       memBudget=memBudget, chans=chans, logFile=logFile)
+        
+    return fb_data;
+
+
+def fb_filter_fused(fb_data, fb_header, f0, nharms, width, 
+                    numProcessors, backend="batch", memBudget=None, 
+                    precision="float64", precisionTol=1e-3, lineSnr=None, 
+                    logFile=""):
+    """ 
+    Filter out every f0 / nharms / width set (arrays, as given 
+    on the command line) in one pass over the data.
+
+    The bandstops for all of the harmonics of all of the f0's are 
+    cascaded into a single SOS filter, so each channel is read, 
+    filtered forward and backward once, and written once, instead 
+    of once per harmonic.  Away from the ends of the time series 
+    this is the same filter as the per-harmonic passes (the 
+    sections commute); it also avoids rounding the data between 
+    passes.  The attenuation of the cascade at each notch is 
+    reported before filtering.
+
+    With precision = "float32" the cascade is run in float32 
+    (sos_filtfilt_f32) if a sample of channels agrees with the 
+    float64 filter to precisionTol of their rms (float32_ok), 
+    and in float64 otherwise.
+
+    If lineSnr is given, each channel only gets the notches 
+    detected in it (see select_channels): channels are grouped 
+    by their set of notches, and each group is filtered with the 
+    cascade of just those notches.
+    """
+    timeRes = float(fb_header["tsamp"])
+    nsamples = np.shape(fb_data)[1]
+    duration = np.divide(np.multiply(nsamples, timeRes), 3600.0)
+    
+    print("Time Resolution: %.6f s" % timeRes)
+    print("nsamples: %i" % nsamples)
+    print("Duration: %.2f hr\n" % duration)
+    
+    nchans = float(fb_header["nchans"])
+    
+    fs = 1.0 / timeRes
+    nyq = 0.5 * fs
+    
+    freq_starts, freq_stops = notch_bands(f0, nharms, width, nyq)
+    if (len(freq_starts) == 0):
+        print("No notches to apply\n")
+        return fb_data
+    
+    sos = fused_sos(nyq, freq_starts, freq_stops, order=3)
+    notch_attenuation(sos, fs, freq_starts, freq_stops, logFile=logFile)
+    
+    use32 = (precision == "float32") and float32_ok(fb_data, sos, 
+                                                    tol=precisionTol, 
+                                                    logFile=logFile)
+    
+    if lineSnr is not None:
+        mask = select_channels(fb_data, fs, freq_starts, freq_stops, lineSnr, 
+                               memBudget=memBudget, logFile=logFile)
+        groups, chanGroup = np.unique(mask, axis=0, return_inverse=True)
+        chanGroup = chanGroup.ravel()
+    else:
+        groups = np.ones((1, len(freq_starts)), dtype=bool)
+        chanGroup = None
+    
+    for igroup, notches in enumerate(groups):
+        if not np.any(notches):
+            continue
+        if chanGroup is None:
+            chans = None
+        else:
+            chans = np.where(chanGroup == igroup)[0]
+            sos = fused_sos(nyq, freq_starts[notches], freq_stops[notches], 
+                            order=3)
+        
+        rowFunc = sos_filtfilt_row
+        rowArgs = (sos,)
+        if use32:
+            rowFunc = sos_filtfilt_f32
+            rowArgs = float32_sos_args(sos)
+        
+        apply_channels(rowFunc, rowArgs, fb_data, numProcessors, 
+                       "%d notches" %(np.sum(notches)), backend=backend, 
+                       memBudget=memBudget, chans=chans, logFile=logFile)
+    
+    return fb_data;
+
+
+def fft_notch_gain(nfft, fs, freq_starts, freq_stops, order=3, reach=10.0):
+    """
+    Gain at each rfft bin that gives the same zero-phase notches 
+    as the SOS cascade, i.e. |H|^2 of each Butterworth bandstop.  
+    Each notch is only evaluated within reach half-widths of its 
+    centre, beyond which its gain is 1 to better than 1e-6.
+    """
+    nyq = 0.5 * fs
+    freqs = sp_fft.rfftfreq(nfft, d=1.0 / fs)
+    df = freqs[1]
+    gain = np.ones(len(freqs))
+    
+    for f_start, f_stop in zip(freq_starts, freq_stops):
+        fc = 0.5 * (f_start + f_stop)
+        half = 0.5 * (f_stop - f_start)
+        lo = max(int((fc - reach * half) / df), 0)
+        hi = min(int((fc + reach * half) / df) + 2, len(freqs))
+        sos = butter_bandstop(nyq, f_start, f_stop, order=order)
+        w, h = signal.sosfreqz(sos, worN=freqs[lo:hi], fs=fs)
+        gain[lo:hi] *= np.abs(h)**2
+    
+    return gain
+
+
+def fft_length(nspec, fs, freq_starts, freq_stops):
+    """
+    Odd extension at each end (samples) and padded FFT length 
+    FFTNotch uses for channels of nspec samples
+    """
+    min_half = np.min(0.5 * (freq_stops - freq_starts))
+    pad = int(min(int(nspec) - 1, 3.0 * fs / min_half))
+    nfft = sp_fft.next_fast_len(int(nspec) + 2 * pad, real=True)
+    
+    return pad, nfft
+
+
+def fft_batch_size(nfft, numProcessors, memBudget=None):
+    """
+    Channels FFTNotch transforms at once: numProcessors, or fewer 
+    if their work buffer, spectrum and inverse (about 24 bytes per 
+    FFT sample) would not fit in memBudget
+    """
+    nbatch = max(int(numProcessors), 1)
+    if memBudget is not None:
+        nbatch = int(max(1, min(nbatch, memBudget // (24.0 * nfft))))
+    
+    return nbatch
+
+
+class FFTNotch(object):
+    """
+    Apply a set of notches to whole channels in the frequency 
+    domain: one real FFT, a multiply by fft_notch_gain, and one 
+    inverse FFT per channel, so the cost does not depend on how 
+    many notches there are.
+
+    The channels are odd-extended at both ends (as sosfiltfilt 
+    does) by about three impulse response lengths of the 
+    narrowest notch to keep the circular wrap-around away from 
+    the data, and padded to a fast FFT length.  Channels are 
+    transformed nbatch at a time with scipy.fft using workers 
+    threads; the padded work buffer is allocated once and reused 
+    for every batch, and scipy.fft caches the plans.
+    """
+    def __init__(self, nspec, fs, freq_starts, freq_stops, nbatch=1, 
+                 workers=1, order=3):
+        self.nspec = int(nspec)
+        self.pad, self.nfft = fft_length(nspec, fs, freq_starts, freq_stops)
+        self.rpad = self.nfft - self.nspec - self.pad
+        self.nbatch = int(nbatch)
+        self.workers = int(workers)
+        self.gain = fft_notch_gain(self.nfft, fs, freq_starts, freq_stops, 
+                                   order=order)
+        self.buf = np.empty((self.nbatch, self.nfft))
+    
+    def load(self, irow, chanData):
+        """
+        Copy one channel, with its odd extensions, into row irow 
+        of the work buffer.
+        """
+        row = self.buf[irow]
+        nspec = self.nspec
+        pad = self.pad
+        rpad = min(self.rpad, nspec - 1)
+        
+        row[pad:pad+nspec] = chanData
+        row[:pad] = 2 * row[pad] - row[2*pad:pad:-1]
+        row[pad+nspec:pad+nspec+rpad] = 2 * row[pad+nspec-1] -\
+                                      row[pad+nspec-2:pad+nspec-2-rpad:-1]
+        row[pad+nspec+rpad:] = 0.0
+    
+    def filter(self, nrows):
+        """
+        Filter the first nrows rows of the work buffer in place.  
+        Returns the filtered channels (views of the buffer).
+        """
+        rows = self.buf[:nrows]
+        spec = sp_fft.rfft(rows, axis=1, workers=self.workers)
+        spec *= self.gain
+        rows[:] = sp_fft.irfft(spec, n=self.nfft, axis=1, 
+                               workers=self.workers, overwrite_x=True)
+        
+        return rows[:, self.pad:self.pad+self.nspec]
+
+
+def fb_filter_fft(fb_data, fb_header, f0, nharms, width, 
+                  numProcessors, memBudget=None, logFile=""):
+    """ 
+    Filter out every f0 / nharms / width set (arrays, as given 
+    on the command line) in the frequency domain (see FFTNotch).
+
+    The notches have the same zero-phase response as the SOS 
+    engine (fb_filter_fused), but the work per channel is fixed, 
+    so this is faster once there are many notches.  Channels are 
+    done numProcessors at a time, fewer if the (float64 + complex) 
+    work buffers would not fit in memBudget bytes (fft_batch_size).  
+    scipy.fft only runs separate transforms in parallel, so a 
+    smaller batch also uses fewer threads; this is logged, as the 
+    SOS engine may then be faster.
+    """
+    timeRes = float(fb_header["tsamp"])
+    nsamples = np.shape(fb_data)[1]
+    duration = np.divide(np.multiply(nsamples, timeRes), 3600.0)
+    
+    print("Time Resolution: %.6f s" % timeRes)
+    print("nsamples: %i" % nsamples)
+    print("Duration: %.2f hr\n" % duration)
+    
+    nchans = int(fb_header["nchans"])
+    
+    fs = 1.0 / timeRes
+    nyq = 0.5 * fs
+    
+    freq_starts, freq_stops = notch_bands(f0, nharms, width, nyq)
+    if (len(freq_starts) == 0):
+        print("No notches to apply\n")
+        return fb_data
+    
+    sos = fused_sos(nyq, freq_starts, freq_stops, order=3)
+    notch_attenuation(sos, fs, freq_starts, freq_stops, logFile=logFile)
+    
+    pad, nfft = fft_length(nsamples, fs, freq_starts, freq_stops)
+    nbatch = fft_batch_size(nfft, numProcessors, memBudget=memBudget)
+    if (nbatch < int(numProcessors)):
+        msg = "FFT batches of %d channels (%.0f MB each) fit in memBudget: " %(\
+              nbatch, 24.0 * nfft / 1e6) +\
+              "using %d of %d threads" %(nbatch, int(numProcessors))
+        if (logFile == ""):
+            print(msg + "\n")
+        else:
+            logFile.write(msg + "\n\n")
+    
+    notcher = FFTNotch(nsamples, fs, freq_starts, freq_stops, 
+                       nbatch=nbatch, workers=numProcessors)
+    
+    label = "FFT, %d notches" %(len(freq_starts))
+    for lochan in range(0, nchans, nbatch):
+        hichan = min(lochan + nbatch, nchans)
+        for ichan in range(lochan, hichan):
+            notcher.load(ichan - lochan, readChannel(fb_data, ichan))
+        
+        filtered = notcher.filter(hichan - lochan)
+        
+        for ichan in range(lochan, hichan):
+            writeChannel(fb_data, ichan, 
+                         castToDtype(filtered[ichan - lochan], fb_data.dtype))
+        
+        report_batch(label, nchans, lochan, hichan, logFile=logFile)
+    
+    if (logFile == ""):
+        print("\n")
+    else:
+        logFile.write("\n")
+    
+    return fb_data;
+
+
+def comb_filtfilt(chanData, b_comb, a_comb):
+    """
+    Zero-phase filter one channel (or a 2D block of channels, 
+    along the last axis) with an iircomb notch comb.
+
+    The comb only has taps at lags 0 and N = fs/f0, so the channel 
+    is laid out as rows of N samples and each column (every Nth 
+    sample) is filtered with the equivalent first order filter, 
+    which is O(1) per sample instead of O(N).  The mean is taken 
+    out first and put back after, since the comb also notches 0 Hz.
+    """
+    chanData = np.asarray(chanData)
+    shape = chanData.shape
+    chanData = chanData.reshape(-1, shape[-1])
+    nrows, nspec = chanData.shape
+    N = len(b_comb) - 1
+    b1 = np.array([b_comb[0], b_comb[N]])
+    a1 = np.array([a_comb[0], a_comb[N]])
+    
+    M = -(-nspec // N)
+    ntail = M * N - nspec
+    chanMean = np.mean(chanData, axis=1, dtype=np.float64, keepdims=True)
+    
+    ext = np.empty((nrows, M * N))
+    ext[:, :nspec] = chanData
+    ext[:, :nspec] -= chanMean
+    if ntail:
+        # Odd-extend to fill the last row
+        ntail_ref = min(ntail, nspec - 1)
+        ext[:, nspec:nspec+ntail_ref] = 2 * ext[:, nspec-1:nspec] -\
+                                        ext[:, nspec-1-ntail_ref:nspec-1][:, ::-1]
+        ext[:, nspec+ntail_ref:] = ext[:, nspec+ntail_ref-1:nspec+ntail_ref]
+    
+    # Pad by a few time constants of the column filter
+    padlen = int(min(M - 1, comb_padlen(b_comb, a_comb) // N))
+    rows = signal.filtfilt(b1, a1, ext.reshape(nrows, M, N), axis=1, 
+                           padlen=padlen)
+    
+    return (rows.reshape(nrows, -1)[:, :nspec] + chanMean).reshape(shape)
+
+
+def comb_padlen(b_comb, a_comb):
+    """
+    Samples the comb pads each end of a channel with: a few time 
+    constants of the first order filter each column sees, in rows 
+    of N samples
+    """
+    N = len(b_comb) - 1
+    tau = 1.0 / max(1.0 + a_comb[N] / a_comb[0], 1e-6)
+    
+    return int(3 * np.ceil(tau)) * N
+
+
+def comb_coeffs(f0, width, fs, nspec=None, logFile=""):
+    """
+    b, a of the IIR notch comb for f0 and all of its harmonics 
+    (signal.iircomb with Q = f0 / (2 width)), with its attenuation 
+    logged, or None (also logged) if fs / f0 is not an integer 
+    number of samples, the comb's only lag, or if the nspec 
+    samples of a channel are no longer than the comb's padding.
+    """
+    N = fs / f0
+    msg = None
+    if (abs(N - np.round(N)) > 1e-6 * N) or (np.round(N) < 2):
+        msg = "fs / f0 = %.4f is not an integer, no comb for %.3f Hz" %(N, f0)
+    else:
+        b_comb, a_comb = signal.iircomb(f0, f0 / (2.0 * width), 
+                                        ftype="notch", fs=fs)
+        padlen = comb_padlen(b_comb, a_comb)
+        if (nspec is not None) and (nspec <= padlen):
+            msg = "%d samples are too few for the %.3f Hz comb (pads %d), no comb" %(\
+                  nspec, f0, padlen)
+    
+    if msg is not None:
+        if (logFile == ""):
+            print(msg + "\n")
+        else:
+            logFile.write(msg + "\n\n")
+        return None
+    
+    # Zero-phase response (two passes) at a notch and its edges
+    N = int(np.round(N))
+    w, h = signal.freqz(b_comb, a_comb, worN=[ f0, f0 + width ], fs=fs)
+    att_db = -40.0 * np.log10(np.maximum(np.abs(h), 1e-300))
+    msg = "Comb: %.3f Hz, fs // f0 = %d notches at k f0, " %(f0, N) +\
+          "k = 0 (DC) to %d (1 to %d up to Nyquist), " %(N - 1, N // 2) +\
+          "attenuation %.1f dB at centre, %.1f dB at +/- %.2f Hz" %(\
+          min(att_db[0], 300.0), att_db[1], width)
+    if (logFile == ""):
+        print(msg + "\n")
+    else:
+        logFile.write(msg + "\n\n")
+    
+    return b_comb, a_comb
+
+
+def fb_filter_comb(fb_data, fb_header, f0, width, numProcessors, 
+                   backend="batch", memBudget=None, logFile=""):
+    """ 
+    Filter out f0 and all of its harmonics up to Nyquist in one 
+    pass (nharms = -1).
+
+    If fs / f0 is an integer N this is an IIR notch comb 
+    (signal.iircomb with Q = f0 / (2 width)) run forward and 
+    backward.  Each notch then spans k f0 +/- width at its 6 dB 
+    (zero-phase) points, the same edges as the Butterworth 
+    notches, but as a 2nd order notch it is narrower at depth.  
+    The comb also notches 0 Hz: the channel mean is kept, but 
+    variations slower than about 1 / width s are removed too.
+
+    Otherwise, or if the channels are no longer than the comb's 
+    padding, the harmonics are removed with the FFT engine 
+    (fb_filter_fft), whose cost also does not depend on how many 
+    there are.
+    """
+    timeRes = float(fb_header["tsamp"])
+    fs = 1.0 / timeRes
+    
+    coeffs = comb_coeffs(f0, width, fs, nspec=np.shape(fb_data)[1], 
+                         logFile=logFile)
+    if coeffs is None:
+        print("Removing the harmonics with the FFT engine\n")
+        return fb_filter_fft(fb_data, fb_header, np.array([ f0 ]), 
+                             np.array([ -1 ]), np.array([ width ]), 
+                             numProcessors, memBudget=memBudget, 
+                             logFile=logFile)
+    b_comb, a_comb = coeffs
+    
+    nsamples = np.shape(fb_data)[1]
+    duration = np.divide(np.multiply(nsamples, timeRes), 3600.0)
+    
+    print("Time Resolution: %.6f s" % timeRes)
+    print("nsamples: %i" % nsamples)
+    print("Duration: %.2f hr\n" % duration)
+    
+    apply_channels(comb_filtfilt, (b_comb, a_comb), fb_data, numProcessors, 
+                   "%.1f Hz comb" %(f0), backend=backend, 
+                   memBudget=memBudget, logFile=logFile)
+    
+    return fb_data;
+
+
+def band_average(fb_data, memBudget=None):
+    """
+    Mean over channels of fb_data (float64), read in batches of 
+    channels.
+    """
+    nchans, nspec = np.shape(fb_data)
+    nbatch = batch_size(nchans, nspec, 8, memBudget=memBudget)
+    
+    zeroDM = np.zeros(nspec)
+    for lochan in range(0, nchans, nbatch):
+        hichan = min(lochan + nbatch, nchans)
+        zeroDM += np.sum(np.asarray(fb_data[lochan:hichan]), axis=0, 
+                         dtype=np.float64)
+    
+    return zeroDM / nchans
+
+
+def common_mode_templates(zeroDM, fs, f0, nharms, width):
+    """
+    Interference templates from the band-averaged series zeroDM: 
+    for each f0 / nharms / width set, what its notch cascade would 
+    remove from zeroDM, and the Hilbert transform of that (so each 
+    channel's copy can have its own phase as well as amplitude).
+
+    Returns a (ntemplate, nspec) zero-mean float64 array, and the 
+    (start, stop) edges of all of the notches used.
+    """
+    nyq = 0.5 * fs
+    templates = []
+    all_starts = []
+    all_stops = []
+    for ii in range(len(f0)):
+        freq_starts, freq_stops = notch_bands(f0[ii:ii+1], nharms[ii:ii+1], 
+                                              width[ii:ii+1], nyq)
+        if (len(freq_starts) == 0):
+            continue
+        sos = fused_sos(nyq, freq_starts, freq_stops, order=3)
+        lines = zeroDM - signal.sosfiltfilt(sos, zeroDM)
+        templates.append(lines)
+        templates.append(np.imag(signal.hilbert(lines)))
+        all_starts.extend(freq_starts)
+        all_stops.extend(freq_stops)
+    
+    templates = np.array(templates).reshape(-1, len(zeroDM))
+    templates -= np.mean(templates, axis=1, keepdims=True)
+    
+    return templates, np.array(all_starts), np.array(all_stops)
+
+
+def common_mode_rows(chanData, templates, gramInv):
+    """
+    Subtract from one channel (or each row of a 2D block of 
+    channels) its least squares fit to the templates, with gramInv 
+    the inverse of templates @ templates.T.
+    """
+    coeffs = np.dot(np.dot(chanData, templates.T), gramInv)
+    
+    return chanData - np.dot(coeffs, templates)
+
+
+def common_mode_residual(before, after, dof, baseDof, freq_starts, 
+                         freq_stops, lineSnr=5.0, logFile=""):
+    """
+    Report, for each notch, how much of the line power above the 
+    continuum the common-mode subtraction leaves (from the 
+    chan_line_power ratios before and after, summed over the 
+    channels where the line was found at lineSnr sigma before, 
+    see select_channels).  A 
+    large residual means the interference is not common to the 
+    channels, and the notch engines (sos or fft) should be used 
+    instead.
+
+    Returns the residual fraction for each notch (NaN where no 
+    line was found).
+    """
+    found = (before > line_threshold(lineSnr, dof, base_dof=baseDof))
+    excess_before = np.sum(np.where(found, before - 1.0, 0.0), axis=0)
+    excess_after = np.sum(np.where(found, np.maximum(after - 1.0, 0.0), 0.0), 
+                          axis=0)
+    residual = np.where(np.any(found, axis=0), 
+                        excess_after / np.maximum(excess_before, 1e-30), np.nan)
+    
+    lines = [ "Common-mode residual line power:" ]
+    for ii in range(len(freq_starts)):
+        fc = 0.5 * (freq_starts[ii] + freq_stops[ii])
+        if not np.any(found[:, ii]):
+            lines.append("  %.2f Hz: no line found" %(fc))
+            continue
+        lines.append("  %.2f Hz: %.1f%% left in %d channels (worst %.2fx continuum)" %(\
+                     fc, 100.0 * residual[ii], np.sum(found[:, ii]), 
+                     np.max(after[found[:, ii], ii])))
+    msg = "\n".join(lines)
+    if (logFile == ""):
+        print(msg + "\n")
+    else:
+        logFile.write(msg + "\n\n")
+    
+    return residual
+
+
+def fb_filter_common(fb_data, fb_header, f0, nharms, width, 
+                     numProcessors, backend="batch", memBudget=None, 
+                     logFile=""):
+    """ 
+    Remove every f0 / nharms / width set by common-mode subtraction 
+    instead of notching each channel.
+
+    The interference is estimated once, from the band-averaged time 
+    series (common_mode_templates: the lines each set's notches 
+    would remove from it, plus their Hilbert transforms), and each 
+    channel then has its own least squares scaled (and phase 
+    shifted) copy of the templates subtracted (common_mode_rows), 
+    which costs a few multiply-adds per sample instead of the notch 
+    cascade.  Only the part of the interference common to all of 
+    the channels is removed, and the noise in the band average is 
+    subtracted with it, so the residual line power in each notch 
+    band is measured before and after (common_mode_residual) to 
+    show whether this is good enough.  The harmonics of a set share 
+    a template, so if their ratios differ between channels, give 
+    them as separate sets (e.g. --f0 60,120 --nharm 0,0).  Needs 
+    two float64 templates per set in memory.
+    """
+    timeRes = float(fb_header["tsamp"])
+    nsamples = np.shape(fb_data)[1]
+    duration = np.divide(np.multiply(nsamples, timeRes), 3600.0)
+    
+    print("Time Resolution: %.6f s" % timeRes)
+    print("nsamples: %i" % nsamples)
+    print("Duration: %.2f hr\n" % duration)
+    
+    fs = 1.0 / timeRes
+    
+    zeroDM = band_average(fb_data, memBudget=memBudget)
+    templates, freq_starts, freq_stops = common_mode_templates(zeroDM, fs, f0, 
+                                                               nharms, width)
+    del zeroDM
+    if (len(freq_starts) == 0):
+        print("No notches to apply\n")
+        return fb_data
+    
+    gramInv = np.linalg.pinv(np.dot(templates, templates.T))
+    
+    before, dof, baseDof = chan_line_power(fb_data, fs, freq_starts, 
+                                           freq_stops, memBudget=memBudget)
+    
+    apply_channels(common_mode_rows, (templates, gramInv), fb_data, 
+                   numProcessors, "common mode, %d templates" %(len(templates)), 
+                   backend=backend, memBudget=memBudget, logFile=logFile)
+    
+    after, dof, baseDof = chan_line_power(fb_data, fs, freq_starts, 
+                                          freq_stops, memBudget=memBudget)
+    common_mode_residual(before, after, dof, baseDof, freq_starts, 
+                         freq_stops, logFile=logFile)
+    
+    return fb_data;
+
+
+def filter_passes(nharm, perHarmonic=False):
+    """
+    Number of passes filter_all makes over each channel: one per 
+    comb set plus one for the other sets together, or one per 
+    harmonic with perHarmonic (nharm = -1 counts as at least 2).
+    """
+    if perHarmonic:
+        return int(np.sum(np.where(nharm < 0, 2, nharm + 1)))
+    
+    comb = (nharm == -1)
+    return int(np.sum(comb) + np.any(~comb))
+
+
+def filter_all(fb_data, fb_header, f0, nharm, width, numProcessors, 
+               engine="sos", perHarmonic=False, backend="batch", 
+               memBudget=None, precision="float64", precisionTol=1e-3, 
+               lineSnr=None, logFile=""):
+    """
+    Apply every f0 / nharm / width set.  Sets with nharm = -1 use 
+    the comb (fb_filter_comb), the rest are done together by the 
+    chosen engine (fb_filter_fused, fb_filter_fft, or 
+    fb_filter_common for "subtract").  With 
+    perHarmonic, every harmonic of every set is a separate pass 
+    (fb_filter_harms), as before.  backend ("batch", "thread" or 
+    "process", see apply_channels) applies to all but the FFT 
+    engine, which is multithreaded by scipy.fft.  precision and 
+    precisionTol apply to the SOS engine (see fb_filter_fused), 
+    and lineSnr (only filter the channels each notch is detected 
+    in, see select_channels) to the SOS engine and perHarmonic.
+    """
+    if perHarmonic:
+        for ii in range(len(f0)):
+            fb_data = fb_filter_harms(fb_data, fb_header, f0[ii], nharm[ii], 
+                                      width[ii], numProcessors, 
+                                      backend=backend, memBudget=memBudget, 
+                                      lineSnr=lineSnr, logFile=logFile)
+        return fb_data
+    
+    comb = (nharm == -1)
+    for ii in np.where(comb)[0]:
+        fb_data = fb_filter_comb(fb_data, fb_header, f0[ii], width[ii], 
+                                 numProcessors, backend=backend, 
+                                 memBudget=memBudget, logFile=logFile)
+    
+    if not np.any(~comb):
+        return fb_data
+    
+    if (engine == "subtract"):
+        fb_data = fb_filter_common(fb_data, fb_header, f0[~comb], nharm[~comb], 
+                                   width[~comb], numProcessors, 
+                                   backend=backend, memBudget=memBudget, 
+                                   logFile=logFile)
+    elif (engine == "fft"):
+        fb_data = fb_filter_fft(fb_data, fb_header, f0[~comb], nharm[~comb], 
+                                width[~comb], numProcessors, 
+                                memBudget=memBudget, logFile=logFile)
+    else:
+        fb_data = fb_filter_fused(fb_data, fb_header, f0[~comb], nharm[~comb], 
+                                  width[~comb], numProcessors, 
+                                  backend=backend, memBudget=memBudget, 
+                                  precision=precision, 
+                                  precisionTol=precisionTol, 
+                                  lineSnr=lineSnr, logFile=logFile)
+    
+    return fb_data
+
+
+def settle_length(sos, tol=1e-10):
+    """
+    Number of samples for the impulse response of the SOS filter 
+    to fall (for good) below tol of its peak, i.e. how long an 
+    error in the filter state takes to die away.
+    """
+    nn = 4096
+    while True:
+        impulse = np.zeros(nn)
+        impulse[0] = 1.0
+        h = np.abs(signal.sosfilt(sos, impulse))
+        above = np.nonzero(h > tol * np.max(h))[0]
+        if (above[-1] < nn // 2) or (nn >= 2**26):
+            return int(above[-1] + 1)
+        nn *= 4
+
+
+class CombFilter(object):
+    """
+    An iircomb notch comb (taps at lags 0 and N only) for 
+    StreamingFiltFilt, run on chunks of any length.  As in 
+    comb_filtfilt, each chunk is laid out as rows of N samples and 
+    every column is filtered with the equivalent first order 
+    filter, which is O(1) per sample; the N column states (one for 
+    each of the next N samples) are carried from chunk to chunk.
+    """
+    def __init__(self, b_comb, a_comb):
+        self.N = len(b_comb) - 1
+        self.b1 = np.array([ b_comb[0], b_comb[self.N] ]) / a_comb[0]
+        self.a1 = np.array([ 1.0, a_comb[self.N] / a_comb[0] ])
+        self.zi = signal.lfilter_zi(self.b1, self.a1)[0]
+        
+        # A few time constants of the column filter, as comb_filtfilt
+        self.padlen = comb_padlen(b_comb, a_comb)
+    
+    def settle_length(self, tol=1e-10):
+        """
+        Samples for the comb's impulse response to fall below tol 
+        (see settle_length)
+        """
+        rows = np.log(tol) / np.log(max(abs(self.a1[1]), 1e-300))
+        return int(self.N * (np.ceil(rows) + 1))
+    
+    def initial(self, x0):
+        """
+        Column states for a steady input x0 ((nchans, 1)), as 
+        sosfilt_zi
+        """
+        return self.zi * np.repeat(x0, self.N, axis=1)
+    
+    def filt(self, x, z):
+        """
+        Filter the (nchans, nn) chunk x along axis 1 from the column 
+        states z.  Returns the output and the new states.
+        """
+        nchans, nn = x.shape
+        N = self.N
+        nfull = (nn // N) * N
+        y = np.empty_like(x)
+        
+        if nfull:
+            rows, zf = signal.lfilter(self.b1, self.a1, 
+                                      x[:, :nfull].reshape(nchans, -1, N), 
+                                      axis=1, zi=z[:, np.newaxis, :])
+            y[:, :nfull] = rows.reshape(nchans, nfull)
+            z = zf[:, 0, :]
+        
+        nrest = nn - nfull
+        if nrest:
+            y[:, nfull:] = self.b1[0] * x[:, nfull:] + z[:, :nrest]
+            z = np.concatenate((z[:, nrest:], self.b1[1] * x[:, nfull:] -\
+                                self.a1[1] * y[:, nfull:]), axis=1)
+        
+        return y, z
+
+
+class StreamingFiltFilt(object):
+    """
+    sosfiltfilt over very long channels, a chunk of time at a time.
+
+    read(lo, hi) must return spectra lo:hi of every channel as a 
+    float64 (nchans, hi - lo) array.  chunks() then yields the 
+    zero-phase filtered chunks in time order, holding only about 
+    chunk + overlap samples per channel at once.
+
+    The ends are handled exactly as in sosfiltfilt (odd extension 
+    by the default padlen, sosfilt_zi scaled initial conditions).  
+    The forward pass is carried from chunk to chunk in its filter 
+    state, so it is exact.  The backward pass for a chunk starts 
+    overlap samples past its end, from the steady state of the 
+    forward output there, and that starting error has died away 
+    (to tol, see settle_length) by the time it reaches the chunk.  
+    The last chunk's backward pass starts from the true end, so it 
+    is exact.  The channels are split between nthreads threads 
+    for the filtering.  Each pass runs the SOS cascade and then 
+    each of the CombFilters in combs, every one started from the 
+    steady state for its first input; the odd extension is the 
+    longest of their pads.
+    """
+    def __init__(self, sos, read, nspec, nchans, chunk, overlap=None, 
+                 nthreads=1, tol=1e-10, combs=()):
+        self.sos = sos
+        self.combs = list(combs)
+        self.read = read
+        self.nspec = int(nspec)
+        self.nchans = int(nchans)
+        self.chunk = int(chunk)
+        self.nthreads = max(int(nthreads), 1)
+        
+        # Same padding as sosfiltfilt's defaults
+        nzeros = min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum())
+        self.padlen = int(max([ 3 * (2 * len(sos) + 1 - nzeros) ] + 
+                              [ comb.padlen for comb in self.combs ]))
+        if (self.nspec <= self.padlen):
+            raise ValueError("Need more than %d spectra to filter" % self.padlen)
+        
+        if overlap is None:
+            overlap = settle_length(sos, tol=tol) +\
+                      sum([ comb.settle_length(tol=tol) for comb in self.combs ])
+        self.overlap = int(overlap)
+        self.zi = signal.sosfilt_zi(sos)
+        
+        self.x0 = read(0, 1)
+        self.xN = read(self.nspec - 1, self.nspec)
+    
+    def _ext(self, e0, e1):
+        """
+        Samples e0:e1 of the odd-extended channels.
+        """
+        nspec = self.nspec
+        idx = np.arange(e0, e1) - self.padlen
+        left = (idx < 0)
+        right = (idx >= nspec)
+        xidx = np.where(left, -idx, np.where(right, 2 * (nspec - 1) - idx, idx))
+        
+        lo = xidx.min()
+        seg = self.read(lo, xidx.max() + 1)
+        if (left.any() or right.any()):
+            seg = seg[:, xidx - lo]
+            seg[:, left] = 2 * self.x0 - seg[:, left]
+            seg[:, right] = 2 * self.xN - seg[:, right]
+        
+        return seg
+    
+    def _filt(self, x, state=None):
+        """
+        sosfilt and then each comb along axis 1, carrying on from 
+        the per-channel states in state (None: each filter starts 
+        from the steady state for its first input, as sosfiltfilt), 
+        with the channels split between the threads.  Returns the 
+        output and the new states.
+        """
+        y = np.empty_like(x)
+        if state is None:
+            state = [ None ] * (1 + len(self.combs))
+        zf = [ np.empty((len(self.sos), self.nchans, 2)) ] +\
+             [ np.empty((self.nchans, comb.N)) for comb in self.combs ]
+        bounds = np.linspace(0, self.nchans, 
+                             min(self.nthreads, self.nchans) + 1).astype(int)
+        
+        def worker(lochan, hichan):
+            xx = x[lochan:hichan]
+            if state[0] is None:
+                zi = self.zi[:, np.newaxis, :] * xx[np.newaxis, :, 0:1]
+            else:
+                zi = state[0][:, lochan:hichan]
+            xx, zf[0][:, lochan:hichan] = signal.sosfilt(self.sos, xx, 
+                                                         axis=1, zi=zi)
+            for icomb, comb in enumerate(self.combs):
+                if state[icomb + 1] is None:
+                    zc = comb.initial(xx[:, 0:1])
                 else:
-                    logFile.write("Filtering [%.1f Hz]: Channel %i [%3.2f%%]\n" %(\
-                          freq_centers[iFilter], nchans - ichan, progress))
+                    zc = state[icomb + 1][lochan:hichan]
+                xx, zf[icomb + 1][lochan:hichan] = comb.filt(xx, zc)
+            y[lochan:hichan] = xx
+        
+        threads = [ Thread(target=worker, args=(lochan, hichan)) 
+                    for lochan, hichan in zip(bounds[:-1], bounds[1:]) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        return y, zf
+    
+    def chunks(self):
+        """
+        Yield (lobin, hibin, filtered) for each chunk in turn, with 
+        filtered the (nchans, hibin - lobin) zero-phase output.
+        """
+        pad = self.padlen
+        next_ext = self.nspec + 2 * pad
+        
+        zf = None
+        yf = np.empty((self.nchans, 0))
+        yf_start = 0
+        yf_stop = 0
+        
+        for lobin in range(0, self.nspec, self.chunk):
+            hibin = min(lobin + self.chunk, self.nspec)
+            e_end = min(hibin + pad + self.overlap, next_ext)
             
-            for x in threads:
-                x.start()
+            # Carry the forward pass on as far as e_end
+            if (yf_stop < e_end):
+                seg = self._ext(yf_stop, e_end)
+                yseg, zf = self._filt(seg, zf)
+                yf = np.concatenate((yf, yseg), axis=1)
+                yf_stop = e_end
             
-            for x in threads:
-                x.join()
-        
-        if (nchans % numProcessors):
-            threads = []
-            for ichan2 in np.arange(ichan + 1, int(nchans), 1):
-                t = Thread(target=worker, args=(ichan2,))
-                threads.append(t)
-                
-                progress = 100.0 * ((ichan + 1.0) / nchans)
-                
-                if (logFile == ""):
-                    print("Filtering [%.1f Hz]: Channel %i [%3.2f%%]" %(\
-                        freq_centers[iFilter], nchans - ichan2, progress))
-                else:
-                    logFile.write("Filtering [%.1f Hz]: Channel %i [%3.2f%%]\n" %(\
-                           freq_centers[iFilter], nchans - ichan2, progress))
+            # Backward pass from e_end down to the start of the chunk
+            back = yf[:, lobin + pad - yf_start:e_end - yf_start][:, ::-1]
+            yb, zb = self._filt(np.ascontiguousarray(back))
+            filtered = yb[:, ::-1][:, :hibin - lobin]
             
-            for x in threads:
-                x.start()
+            yf = yf[:, hibin + pad - yf_start:]
+            yf_start = hibin + pad
             
-            for x in threads:
-                x.join()
+            yield lobin, hibin, filtered
+
+
+def fb_filter_stream(inputFilename, outputFilename, f0, nharms, width, 
+                     numProcessors, memBudget=None, logFile=""):
+    """
+    Notch filter a filterbank file straight into a new one, without 
+    a staging copy, using StreamingFiltFilt on the fused SOS cascade 
+    of every f0 / nharms / width set.  nharms = -1 sets use a 
+    CombFilter (as fb_filter_comb, with each channel's mean, from 
+    an extra read of the input, taken out and put back after), or 
+    are expanded into their separate harmonics if fs / f0 is not 
+    an integer (or the data are too short for the comb).
+
+    Memory is fixed by memBudget (default BATCH_BYTES), which holds 
+    a chunk plus the overlap the notches need, whatever the length 
+    of the observation.  Raises ValueError if memBudget cannot hold 
+    a chunk at least as long as the overlap.  The result matches the staged 
+    SOS engine (fb_filter_fused) to within tol of the settling 
+    (see StreamingFiltFilt).
+    """
+    mapFile = MappedFilterbank(inputFilename)
+    fb_header = mapFile.header
+    nchans = mapFile.nchans
+    nspec = mapFile.nspec
+    
+    timeRes = float(fb_header["tsamp"])
+    fs = 1.0 / timeRes
+    nyq = 0.5 * fs
+    
+    print("Time Resolution: %.6f s" % timeRes)
+    print("nsamples: %i" % nspec)
+    print("Duration: %.2f hr\n" % (nspec * timeRes / 3600.0))
+    
+    combs = []
+    notched = (nharms != -1)
+    for ii in np.where(nharms == -1)[0]:
+        coeffs = comb_coeffs(f0[ii], width[ii], fs, nspec=nspec, 
+                             logFile=logFile)
+        if coeffs is None:
+            notched[ii] = True
+        else:
+            combs.append(CombFilter(*coeffs))
+    
+    freq_starts, freq_stops = notch_bands(f0[notched], nharms[notched], 
+                                          width[notched], nyq)
+    if (len(freq_starts) == 0):
+        if not combs:
+            print("No notches to apply\n")
+        sos = np.array([[1.0, 0.0, 0.0, 1.0, 0.0, 0.0]])
+    else:
+        sos = fused_sos(nyq, freq_starts, freq_stops, order=3)
+        notch_attenuation(sos, fs, freq_starts, freq_stops, logFile=logFile)
+    
+    overlap = settle_length(sos) +\
+              sum([ comb.settle_length() for comb in combs ])
+    
+    # Per spectrum a chunk holds the forward output, the backward 
+    # input and output, the read block and the output block, and 
+    # the combs' work copies
+    specBytes = 8.0 * nchans * (5 + 2 * min(len(combs), 1))
+    if memBudget is None:
+        memBudget = BATCH_BYTES
+    
+    # A chunk shorter than the overlap would spend most of its 
+    # time re-filtering the overlap
+    minBudget = 2 * max(overlap, 1) * specBytes
+    if (memBudget < minBudget):
+        raise ValueError("memBudget of %.3g bytes cannot hold a chunk and overlap of %d spectra each (need %.3g bytes)" %(\
+                         memBudget, overlap, minBudget))
+    chunk = int(min(memBudget // specBytes - overlap, nspec))
+    
+    msg = "Stream plan: chunks of %d spectra, overlap %d spectra (%.1f MB)" %(\
+          chunk, overlap, (chunk + overlap) * specBytes / 2.0**20)
+    if (logFile == ""):
+        print(msg + "\n")
+    else:
+        logFile.write(msg + "\n\n")
+    
+    # The combs also notch 0 Hz, so the channel means are taken out 
+    # and put back after
+    chanMean = np.zeros(nchans)
+    if combs:
+        for lobin in range(0, nspec, int(BLOCKSIZE)):
+            hibin = min(lobin + int(BLOCKSIZE), nspec)
+            chanMean += np.sum(mapFile.spectra[lobin:hibin], axis=0, 
+                               dtype=np.float64)
+        chanMean /= nspec
+    
+    outfil = FilterbankWriter(outputFilename, fb_header, mapFile.nbits, nspec)
+    
+    def read(lobin, hibin):
+        block = np.empty((nchans, hibin - lobin))
+        transposeBlock(mapFile.spectra[lobin:hibin], block)
+        if combs:
+            block -= chanMean[:, np.newaxis]
+        return block
+    
+    stream = StreamingFiltFilt(sos, read, nspec, nchans, chunk, 
+                               overlap=overlap, nthreads=numProcessors, 
+                               combs=combs)
+    spectra = np.empty((chunk, nchans))
+    for lobin, hibin, filtered in stream.chunks():
+        transposeBlock(filtered, spectra[:hibin - lobin])
+        if combs:
+            spectra[:hibin - lobin] += chanMean
+        outfil.writeSpectra(spectra[:hibin - lobin], lobin)
         
+        progress = 100.0 * hibin / float(nspec)
         if (logFile == ""):
-            print("\n")
+            sys.stdout.write("Filtering [stream]... [%3.2f%%]\r" % progress)
+            sys.stdout.flush()
         else:
-            logFile.write("\n")
-        
-    return fb_data;
+            logFile.write("Filtering [stream]... [%3.2f%%]\n" % progress)
+    
+    outfil.close()
+    mapFile.close()
+    
+    if (logFile == ""):
+        print("\n")
+    else:
+        logFile.write("\n")
+    
+    return
 
 
 def usage():
@@ -199,7 +1641,11 @@ def usage():
                                (comma separated list)
      [-nharm]                : Number of harmonics beyond each fundamental 
                                (comma separated list)
-                               (0: only fundamental, -1: all up to Nyquist)
+                               (0: only fundamental, -1: all up to Nyquist, 
+                               removed with one comb filter if the 
+                               sampling rate / f0 is an integer, 
+                               else with the fft engine, or notches 
+                               with --stream)
      [-width]                : Widths (in Hz) of filters
                                (comma separated list)
      [--numProcessors]       : Number of processors to be used for 
@@ -211,6 +1657,73 @@ def usage():
                                analysis will be stored.
      [--logFile]             : Name of the log file to store the 
                                data reduction output.
+     [--memBudget]           : Memory (bytes) to use for the blocks 
+                               read from / written to the filterbank 
+                               files.  Default is BLOCKSIZE spectra.
+     [--prefetch]            : Number of blocks to read ahead / write 
+                               behind in a background thread. 
+                               Default is 0 (no overlap).
+     [--scratchDirs]         : Comma separated list of fast scratch 
+                               directories to try (in order) for the 
+                               .hdf5 staging file before the input 
+                               file's directory.
+     [--stagingDtype]        : dtype of the .hdf5 staging copy: 
+                               float32 (default) or native (keep the 
+                               input's dtype, e.g. 8-bit, and convert 
+                               each channel to float only while it is 
+                               filtered).  native is only used when 
+                               the data take a single filter pass 
+                               (float32 otherwise).
+     [--compression]         : Compress the .hdf5 staging copy: none 
+                               (default), lzf, or gzip (deflate + 
+                               shuffle, decompressed in parallel by 
+                               the channel workers).
+     [--stagingBackend]      : Staging store: hdf5 (default) or sharded 
+                               (a directory of channel-group files, 
+                               filled by numProcessors processes in 
+                               parallel and safe for several processes 
+                               to modify at once).
+     [--perHarmonic]         : Filter each harmonic in a separate pass 
+                               over the data (the old behaviour) 
+                               instead of one pass with all of the 
+                               notches cascaded.
+     [--engine]              : Notch engine: sos (default, Butterworth 
+                               bandstops run with sosfiltfilt), fft 
+                               (same notches applied with one FFT per 
+                               channel, faster for many notches), or 
+                               subtract (estimate the lines once from 
+                               the band average and subtract a scaled 
+                               copy from each channel; much cheaper, 
+                               but only for interference common to the 
+                               channels, see the residual it reports).
+     [--backend]             : How the channels are spread over the 
+                               numProcessors: batch (default, 2D 
+                               slabs of channels sized from 
+                               memBudget, split between threads), 
+                               thread (one thread per channel), or 
+                               process (a process pool working on 
+                               batches of channels in shared memory).
+     [--stream]              : Filter the input straight into the 
+                               output a chunk of time at a time (no 
+                               staging copy, memory fixed by 
+                               memBudget, default 1 GiB), with the 
+                               SOS cascade and the comb for 
+                               nharm = -1.  Only the 
+                               sos engine; --perHarmonic, --lineSnr, 
+                               --precision, --backend and the staging 
+                               options are ignored (with a warning).
+     [--precision]           : float64 (default) or float32 to run the 
+                               SOS cascade in float32, if a sample of 
+                               channels agrees with float64 to within 
+                               f32Tol (else float64 is used).
+     [--f32Tol]              : Allowed float32 error as a fraction of 
+                               the channel rms.  Default is 1e-3.
+     [--lineSnr]             : Only run each notch on the channels 
+                               where its line is detected at more 
+                               than lineSnr sigma, measured on a few 
+                               stretches of each channel (sos engine 
+                               and perHarmonic).  Default is to 
+                               filter every channel.
      [--clean]               : Flag to clean up intermediate reduction 
                                products.  Default is FALSE
      
@@ -268,10 +1781,27 @@ def main():
                   "numProcessors:" +\
                   "outputDir:" +\
                   "logFile:" +\
+                  "memBudget:" +\
+                  "prefetch:" +\
+                  "scratchDirs:" +\
+                  "stagingDtype:" +\
+                  "compression:" +\
+                  "stagingBackend:" +\
+                  "perHarmonic:" +\
+                  "engine:" +\
+                  "backend:" +\
+                  "stream:" +\
+                  "precision:" +\
+                  "f32Tol:" +\
+                  "lineSnr:" +\
                   "clean:" 
         long_opts = ["help", "inputFilename=", "outputFilename=",
                      "f0=", "nharm=", "width=", "numProcessors=", 
-                     "outputDir=", "logFile=", "clean"]
+                     "outputDir=", "logFile=", "memBudget=", "prefetch=", 
+                     "scratchDirs=", "stagingDtype=", "compression=", 
+                     "stagingBackend=", "perHarmonic", "engine=", 
+                     "backend=", "stream", "precision=", "f32Tol=", 
+                     "lineSnr=", "clean"]
         opts, args = getopt.getopt(sys.argv[1:], opt_str, long_opts)
         print(opts)
     
@@ -292,6 +1822,19 @@ def main():
     numProcessors=None
     outputDir=None
     logFile=None
+    memBudget=None
+    prefetch=0
+    scratchDirs=None
+    stagingDtype="float32"
+    compression=None
+    staging="hdf5"
+    perHarmonic=None
+    engine="sos"
+    backend="batch"
+    stream=None
+    precision="float64"
+    precisionTol=1e-3
+    lineSnr=None
     clean=None
     
     for o, a in opts:
@@ -315,6 +1858,32 @@ def main():
             outputDir = a
         if o in ("--logFile"):
             logFile = a
+        if o in ("--memBudget"):
+            memBudget = float(a)
+        if o in ("--prefetch"):
+            prefetch = int(a)
+        if o in ("--scratchDirs"):
+            scratchDirs = a.split(',')
+        if o in ("--stagingDtype"):
+            stagingDtype = a
+        if o in ("--compression"):
+            compression = a
+        if o in ("--stagingBackend"):
+            staging = a
+        if o in ("--perHarmonic"):
+            perHarmonic = True
+        if o in ("--engine"):
+            engine = a
+        if o in ("--backend"):
+            backend = a
+        if o in ("--stream"):
+            stream = True
+        if o in ("--precision"):
+            precision = a
+        if o in ("--f32Tol"):
+            precisionTol = float(a)
+        if o in ("--lineSnr"):
+            lineSnr = float(a)
         if o in ("--clean"):
             clean = True
     
@@ -322,6 +1891,15 @@ def main():
         usage()
         sys.exit()
     
+    for name, value, choices in [ ("engine", engine, ENGINES), 
+                                  ("backend", backend, BACKENDS), 
+                                  ("precision", precision, PRECISIONS) ]:
+        if value not in choices:
+            usage()
+            print("Unknown --%s %s (use one of %s)" %(\
+                  name, value, ", ".join(choices)))
+            sys.exit(2)
+    
     if (numProcessors != None):
         numProcessors = float(numProcessors)
     else:
@@ -350,16 +1928,70 @@ def main():
 
     Nsteps = len(f0)
     
+    # Native (integer) staging rounds the data after every pass, so 
+    # it is only kept when the data are filtered (and rounded) once
+    npass = filter_passes(nharm, perHarmonic=perHarmonic)
+    if (stagingDtype == "native") and (npass > 1) and not stream:
+        print("%d filter passes: staging as float32 instead of native "\
+              "so the data are only rounded once, when written" % npass)
+        stagingDtype = "float32"
+    
+    if stream and (engine != "sos"):
+        usage()
+        print("--stream only runs the sos engine, not --engine %s" % engine)
+        sys.exit(2)
+    
+    if stream:
+        outputPath = outputFilename
+        writeFile = ""
+        if (outputDir != None):
+            outputPath = "%s/%s" % (outputDir, outputFilename)
+            if (logFile != None):
+                writeFile = open("%s/%s" % (outputDir, logFile), "w")
+        
+        # Options the stream cannot honour
+        ignored = []
+        if perHarmonic:
+            ignored.append("--perHarmonic (the notches are fused)")
+        if (lineSnr != None):
+            ignored.append("--lineSnr (every channel is filtered)")
+        if (precision != "float64"):
+            ignored.append("--precision %s (filtering in float64)" % precision)
+        if (backend != "batch"):
+            ignored.append("--backend %s (channels split between threads)" % backend)
+        if ((stagingDtype != "float32") | (compression != None) | 
+            (staging != "hdf5") | (prefetch > 0)):
+            ignored.append("staging options (there is no staging copy)")
+        for msg in ignored:
+            if (writeFile == ""):
+                print("Warning: --stream ignores %s" % msg)
+            else:
+                writeFile.write("Warning: --stream ignores %s\n" % msg)
+        
+        fb_filter_stream(inputFilename, outputPath, f0, nharm, width, 
+                         numProcessors, memBudget=memBudget, 
+                         logFile=writeFile)
+        
+        if (writeFile != ""):
+            writeFile.close()
+        return
     
     if ((outputDir != None) & (logFile != None)):
         writeFile = open("%s/%s" % (outputDir, logFile), "w")
         fb_data, fb_header, fb_Nbits, h5pyFile =\
                  readFilterbank(inputFilename, logFile=writeFile, 
-                                BLOCKSIZE=BLOCKSIZE)
+                                BLOCKSIZE=BLOCKSIZE, memBudget=memBudget, 
+                                prefetch=prefetch, scratchDirs=scratchDirs, 
+                                dtype=stagingDtype, 
+                                compression=compression, staging=staging, 
+                                nproc=int(numProcessors))
         
-        for ii in range(Nsteps): 
-            fb_data = fb_filter_harms(fb_data, fb_header, f0[ii], nharm[ii], 
-                                      width[ii], numProcessors, logFile=writeFile)
+        fb_data = filter_all(fb_data, fb_header, f0, nharm, width, 
+                             numProcessors, engine=engine, 
+                             perHarmonic=perHarmonic, backend=backend, 
+                             memBudget=memBudget, precision=precision, 
+                             precisionTol=precisionTol, lineSnr=lineSnr, 
+                             logFile=writeFile)
 
         outputPath = "%s/%s" % (outputDir, outputFilename)
         
@@ -367,15 +1999,22 @@ def main():
              outputPath = outputFilename
         
         writeFilterbank(outputPath, fb_data, fb_header, fb_Nbits, 
-                        logFile=writeFile, BLOCKSIZE=BLOCKSIZE)
+                        logFile=writeFile, BLOCKSIZE=BLOCKSIZE, 
+                        memBudget=memBudget, prefetch=prefetch)
         writeFile.close()
     else:
         fb_data, fb_header, fb_Nbits, h5pyFile =\
-                 readFilterbank(inputFilename, BLOCKSIZE=BLOCKSIZE)
+                 readFilterbank(inputFilename, BLOCKSIZE=BLOCKSIZE, 
+                                memBudget=memBudget, prefetch=prefetch, 
+                                scratchDirs=scratchDirs, dtype=stagingDtype, 
+                                compression=compression, staging=staging, 
+                                nproc=int(numProcessors))
 
-        for ii in range(Nsteps):        
-            fb_data = fb_filter_harms(fb_data, fb_header, f0[ii], nharm[ii], 
-                                      width[ii], numProcessors)
+        fb_data = filter_all(fb_data, fb_header, f0, nharm, width, 
+                             numProcessors, engine=engine, 
+                             perHarmonic=perHarmonic, backend=backend, 
+                             memBudget=memBudget, precision=precision, 
+                             precisionTol=precisionTol, lineSnr=lineSnr)
 
         outputPath = "%s/%s" % (outputDir, outputFilename)
         
@@ -383,17 +2022,10 @@ def main():
              outputPath = outputFilename
         
         writeFilterbank(outputPath, fb_data, fb_header, fb_Nbits, 
-                        BLOCKSIZE=BLOCKSIZE)
-    
-    h5pyFile.close()
+                        BLOCKSIZE=BLOCKSIZE, memBudget=memBudget, 
+                        prefetch=prefetch)
     
-    if (clean == True):
-        h5_path = "%s.hdf5" %(inputFilename)
-        if os.path.exists(h5_path):
-            print("Removing %s" %h5_path)
-            os.remove(h5_path)
-        else: pass
-    else: pass
+    releaseStaging(h5pyFile, clean=(clean == True))
 
 
 debug = 0
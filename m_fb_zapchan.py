@@ -22,19 +22,18 @@ import h5py
 from scipy import signal
 from threading import Thread
 
-from fb_utils import readFilterbank, writeFilterbank
+from fb_utils import readFilterbank, writeFilterbank, releaseStaging
 
 BLOCKSIZE = 1e6
 
-def zapChannels(fb_data, fb_zap_string):
-    """ 
-    Zero a list of channels in a filterbank file.
-    Lowest channel index corresponds to the top of the 
-    band/highest frequency. 
+def zapChannelList(fb_zap_string):
+    """
+    Turn the zap string (e.g., 0:2,5,7:8) into an array of 
+    channel indices.  Channel limits are inclusive.
     """
     delimiter = ","
     zapList = fb_zap_string.split(delimiter)
-    nchans, nsamples = np.shape(fb_data)
+    zapChans = []
     
     for zapIndex in np.arange(0, len(zapList), 1):
         zapBand = zapList[zapIndex].split(":")
@@ -42,14 +41,15 @@ def zapChannels(fb_data, fb_zap_string):
         if (len(zapBand) == 2):
             zapStart = int(zapBand[0])
             zapEnd = int(zapBand[1]) + 1
-            nzapChannels = len(np.arange(zapStart, zapEnd, 1))
-            fb_data[zapStart : zapEnd] = np.zeros((nzapChannels, nsamples))
+            zapChans.extend(np.arange(zapStart, zapEnd, 1))
         
         if (len(zapBand) == 1):
-            zapChannel = int(zapBand[0])
-            fb_data[zapChannel] = np.zeros((1, nsamples))
+            zapChans.append(int(zapBand[0]))
+    
+    zapChans = np.unique(np.array(zapChans, dtype=int))
     
-    return fb_data;
+    return zapChans
+
 
 def usage():
     print("##################################")
@@ -70,6 +70,10 @@ def usage():
                                           i.e. --zapChan 0:2,5,7:8
         [--outputDir]                   : Output directory where the products of the data
                                           analysis will be stored
+        [--memBudget]                   : Memory (bytes) to use for the blocks written to
+                                          the output file. Default is BLOCKSIZE spectra.
+        [--prefetch]                    : Number of blocks to write behind in a background
+                                          thread. Default is 0 (no overlap).
         [--clean]                       : Flag to clean up intermediate reduction products.
                                           Default is FALSE
         
@@ -95,7 +99,7 @@ def main():
                                    "inputFilename:outputFilename:timeConstLong:timeConstShort:numProcessors:outputDir:logFile:clean:",
                                    ["help", "inputFilename=", "outputFilename=",
                                     "zapChan=", "outputDir=",
-                                    "clean"])
+                                    "memBudget=", "prefetch=", "clean"])
     
     except getopt.GetoptError:
         # Print help information and exit.
@@ -110,6 +114,8 @@ def main():
     outputFilename=None
     zapChan=None
     outputDir=None
+    memBudget=None
+    prefetch=0
     clean=None
     
     for o, a in opts:
@@ -125,33 +131,27 @@ def main():
             zapChan = a
         if o in ("--outputDir"):
             outputDir = a
+        if o in ("--memBudget"):
+            memBudget = float(a)
+        if o in ("--prefetch"):
+            prefetch = int(a)
         if o in ("--clean"):
             clean = True
     
     
     if (outputDir != None):
-        outputPathFilename = "%s/%s" % (outputDir, outputFilename)
-        fb_data, fb_header, fb_Nbits, h5pyFile = readFilterbank(inputFilename, 
-                                                           BLOCKSIZE=BLOCKSIZE)
-        fb_data = zapChannels(fb_data, zapChan)
-        writeFilterbank(outputPathFilename, fb_data, fb_header, fb_Nbits,
-                        BLOCKSIZE=BLOCKSIZE)
-        h5pyFile.close()
-    else:
-        fb_data, fb_header, fb_Nbits, h5pyFile = readFilterbank(inputFilename,
-                                                          BLOCKSIZE=BLOCKSIZE)
-        fb_data = zapChannels(fb_data, zapChan)
-        writeFilterbank(outputFilename, fb_data, fb_header, fb_Nbits, 
-                        BLOCKSIZE=BLOCKSIZE)
-        h5pyFile.close()
-
-    if (clean==True):
-        h5_path = "%s.hdf5" %(inputFilename)
-        if os.path.exists(h5_path):
-            print("Removing %s" %h5_path)
-            os.remove(h5_path)
-        else: pass
-    else: pass 
+        outputFilename = "%s/%s" % (outputDir, outputFilename)
+    
+    # Zapping never needs a writable copy of the data, so map 
+    # the input and zero the channels as the blocks are written
+    fb_data, fb_header, fb_Nbits, mapFile = readFilterbank(inputFilename, 
+                                                      BLOCKSIZE=BLOCKSIZE, 
+                                                      staging="mmap")
+    zapChans = zapChannelList(zapChan)
+    writeFilterbank(outputFilename, fb_data, fb_header, fb_Nbits, 
+                    BLOCKSIZE=BLOCKSIZE, zeroChans=zapChans, 
+                    memBudget=memBudget, prefetch=prefetch)
+    releaseStaging(mapFile, clean=(clean == True))
     
 if __name__ == "__main__":
     main()